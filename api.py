@@ -0,0 +1,318 @@
+"""Versioned JSON API for Warbler's feeds.
+
+Serves the same feeds.py queries as the HTML pages, for clients that want
+data rather than markup. Every list endpoint:
+
+- is cursor-paginated: pass the `next_cursor` from one page as `?cursor=`
+  to get the next (it's null on the last page)
+- takes `?limit=` (default 20, max MAX_LIMIT)
+- takes `?fields=id,text,...` to return only some fields of each item
+
+Responses are serialized item by item from a generator, so a page is never
+held in memory as one big JSON string. Authentication is the same session
+cookie the HTML site uses.
+
+POST /messages/batch takes up to MESSAGE_BATCH_MAX new messages at once,
+as JSON ({"messages": [{"text": ...}, ...]}) or as a form with repeated
+`text` fields (plus the usual csrf_token), and writes them in one INSERT.
+
+Message ids are 64-bit (see snowflake.py), too big for a JavaScript number,
+so ids beyond 2**53 are sent as strings.
+"""
+
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, current_app, g, jsonify, request, \
+    stream_with_context
+from flask_wtf.csrf import validate_csrf
+from sqlalchemy.exc import OperationalError
+from werkzeug.datastructures import MultiDict
+from wtforms import ValidationError
+
+from author_feeds import author_feeds
+import deadlines
+import feeds
+from forms import MessageForm
+from metrics import metrics
+from page_cache import page_cache
+from models import db, User, Message
+from shards import message_shards
+from snowflake import next_id
+import tags
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 200
+
+MAX_SAFE_INTEGER = 2 ** 53 - 1
+
+
+class APIError(Exception):
+    """Error to report to the client as a JSON body with this status."""
+
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.details = details
+
+
+@api.errorhandler(APIError)
+def handle_api_error(error):
+    """Report APIErrors as {"error": message, ...details}."""
+
+    return jsonify(error=error.message, **error.details), error.status
+
+
+@api.errorhandler(404)
+def handle_not_found(error):
+    """Keep 404s JSON inside the API."""
+
+    return jsonify(error="Not found"), 404
+
+
+def require_login():
+    """Raise a 401 unless someone is logged in."""
+
+    if not g.user:
+        raise APIError("Access unauthorized.", 401)
+
+
+def page_args(row_type):
+    """Parse and validate ?cursor, ?limit and ?fields for a list endpoint."""
+
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise APIError("limit must be an integer")
+
+    if not 1 <= limit <= MAX_LIMIT:
+        raise APIError(f"limit must be between 1 and {MAX_LIMIT}")
+
+    fields = request.args.get('fields')
+
+    if fields:
+        fields = fields.split(',')
+        unknown = set(fields) - set(row_type._fields)
+        if unknown:
+            raise APIError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    else:
+        fields = row_type._fields
+
+    return request.args.get('cursor'), limit, fields
+
+
+def json_safe(value):
+    """Send integers JavaScript can't represent exactly as strings."""
+
+    if isinstance(value, int) and abs(value) > MAX_SAFE_INTEGER:
+        return str(value)
+
+    return value
+
+
+def to_json(value):
+    """json.dumps fallback for the non-JSON types our rows hold."""
+
+    return value.isoformat()
+
+
+def stream_page(rows, fields, next_cursor):
+    """Stream {"data": [...], "next_cursor": ...} one item at a time."""
+
+    def generate():
+        yield '{"data":['
+
+        for i, row in enumerate(rows):
+            item = {field: json_safe(getattr(row, field)) for field in fields}
+            yield (',' if i else '') + json.dumps(item, default=to_json)
+
+        yield '],"next_cursor":' + json.dumps(next_cursor) + '}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+def message_page(user_ids):
+    """Stream a page of messages by any of `user_ids`."""
+
+    cursor, limit, fields = page_args(feeds.MessageRow)
+    messages = feeds.timeline_messages(user_ids, limit=limit, before=cursor)
+
+    return stream_page(messages, fields, feeds.message_cursor(messages, limit))
+
+
+def user_page(query, user_id):
+    """Stream a page of users from feeds.following/feeds.followers."""
+
+    require_login()
+    User.query.get_or_404(user_id)
+
+    cursor, limit, fields = page_args(feeds.UserRow)
+    users = query(user_id, after=cursor, limit=limit)
+    next_cursor = users[-1].username if len(users) == limit else None
+
+    return stream_page(users, fields, next_cursor)
+
+
+@api.route('/timeline')
+def timeline():
+    """Home timeline: messages by the logged-in user and who they follow."""
+
+    require_login()
+
+    following_ids = feeds.following_ids(g.user.id)
+    following_ids.add(g.user.id)
+
+    try:
+        return message_page(following_ids)
+    except OperationalError as exc:
+        if not deadlines.exceeded(exc):
+            raise
+        db.session.rollback()
+        raise APIError("Timeline took too long to load; try again shortly.",
+                       503)
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """Messages written by this user."""
+
+    User.query.get_or_404(user_id)
+
+    return message_page([user_id])
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users this user is following."""
+
+    return user_page(feeds.following, user_id)
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following this user."""
+
+    return user_page(feeds.followers, user_id)
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages this user has liked, most recently liked first."""
+
+    require_login()
+    User.query.get_or_404(user_id)
+
+    cursor, limit, fields = page_args(feeds.MessageRow)
+    page = feeds.liked_messages(user_id, before=cursor, limit=limit)
+
+    return stream_page(page.items, fields, page.next_cursor)
+
+
+@api.route('/users/<int:user_id>/mentions')
+def user_mentions(user_id):
+    """Messages that @mention this user."""
+
+    User.query.get_or_404(user_id)
+
+    cursor, limit, fields = page_args(feeds.MessageRow)
+    page = feeds.mention_messages(user_id, before=cursor, limit=limit)
+
+    return stream_page(page.items, fields, page.next_cursor)
+
+
+@api.route('/tags/<tag>/messages')
+def tag_messages(tag):
+    """Messages with this hashtag."""
+
+    cursor, limit, fields = page_args(feeds.MessageRow)
+    page = feeds.tag_messages(tag.lower(), before=cursor, limit=limit)
+
+    return stream_page(page.items, fields, page.next_cursor)
+
+
+@api.route('/notifications/unread')
+def unread_notifications():
+    """The logged-in user's unread notification count."""
+
+    require_login()
+
+    return jsonify(unread=g.user.unread_notifications)
+
+
+def batch_texts():
+    """The message texts posted to /messages/batch, JSON or form."""
+
+    if request.is_json:
+        body = request.get_json(silent=True)
+        messages = body.get('messages') if isinstance(body, dict) else None
+
+        if not isinstance(messages, list):
+            raise APIError('Expected {"messages": [{"text": ...}, ...]}')
+
+        return [item.get('text') if isinstance(item, dict) else None
+                for item in messages]
+
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+        try:
+            validate_csrf(request.form.get('csrf_token'))
+        except ValidationError as error:
+            raise APIError(str(error))
+
+    return request.form.getlist('text')
+
+
+@api.route('/messages/batch', methods=['POST'])
+def add_messages():
+    """Post several messages as the logged-in user, in one statement.
+
+    Every message must pass MessageForm's validation or none are saved;
+    errors come back keyed by the message's position in the batch.
+    """
+
+    require_login()
+
+    texts = batch_texts()
+    max_batch = current_app.config['MESSAGE_BATCH_MAX']
+
+    if not 1 <= len(texts) <= max_batch:
+        raise APIError(f"Send between 1 and {max_batch} messages")
+
+    errors = {}
+    for i, text in enumerate(texts):
+        if not isinstance(text, str):
+            errors[i] = ["Text must be a string."]
+            continue
+        form = MessageForm(formdata=MultiDict({'text': text}),
+                           meta={'csrf': False})
+        if not form.validate():
+            errors[i] = form.text.errors
+
+    if errors:
+        raise APIError("Some messages are invalid", errors=errors)
+
+    # Ids are taken in order, so the batch reads back in the order sent.
+    now = datetime.utcnow()
+    rows = [dict(id=next_id(), text=text, timestamp=now, user_id=g.user.id)
+            for text in texts]
+
+    if message_shards.enabled:
+        message_shards.insert_messages(g.user.id, rows)
+    else:
+        db.session.execute(Message.__table__.insert().values(rows))
+    tags.index_messages([(row['id'], row['text']) for row in rows])
+    db.session.commit()
+
+    page_cache.invalidate(f"user:{g.user.id}")
+    author_feeds.add_messages([
+        feeds.MessageRow(row['id'], row['text'], now, g.user.id,
+                         g.user.username, g.user.image_url)
+        for row in rows])
+    metrics.increment('warbler_messages_ingested_total',
+                      'Messages posted through the batch endpoint.',
+                      amount=len(rows))
+
+    return jsonify(data=[json_safe(row['id']) for row in rows]), 201
@@ -1,11 +1,42 @@
+import heapq
 import os
+from itertools import islice
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import Flask, render_template, request, flash, redirect, session, g, \
+    Response, abort, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import Likes, db, connect_db, User, Message
+from models import db, connect_db, User, Message, Follows, \
+    delete_message_rows
+from api import api
+import archive
+from bloom import user_filter
+from author_feeds import author_feeds, newest_first
+import deadlines
+from deadlines import query_deadlines
+import export
+import feeds
+from follow_graph import follow_graph
+from hot_cache import hot_cache
+import images
+import likes
+from likes import like_buffer
+from metrics import metrics
+import notifications
+from notifications import notifier
+from page_cache import page_cache
+import partitions
+from partitions import message_partitions
+from profiler import profiler
+from ratelimit import limiter
+import shards
+from shards import message_shards
+from slow_queries import slow_queries
+import tags
 
 CURR_USER_KEY = "curr_user"
 
@@ -20,8 +51,46 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['IMAGE_UPLOAD_FOLDER'] = (
+    os.environ.get('IMAGE_UPLOAD_FOLDER',
+                   os.path.join(app.root_path, 'static', 'uploads')))
+app.config['IMAGE_UPLOAD_URL'] = '/static/uploads'
+app.config['MAX_CONTENT_LENGTH'] = 8 * 1024 * 1024
+app.config['MESSAGE_BATCH_MAX'] = 100
+
+# Home timeline strategy: 'sql' (one IN query) or 'merge' (merge cached
+# per-author feeds; see author_feeds.py).
+app.config['TIMELINE_MODE'] = os.environ.get('TIMELINE_MODE', 'sql')
+
+# Per-user rate limits (ratelimit.py) read the user id from the session.
+app.config['RATELIMIT_SESSION_KEY'] = CURR_USER_KEY
 toolbar = DebugToolbarExtension(app)
 
+author_feeds.configure(app)
+app.add_template_filter(images.thumbnail)
+app.add_template_filter(tags.tag_links)
+app.register_blueprint(api)
+follow_graph.init_app(app)
+user_filter.init_app(app)
+like_buffer.init_app(app)
+notifier.init_app(app)
+# Before page_cache, whose hits skip the before_request hooks after it.
+metrics.init_app(app)
+profiler.init_app(app)
+page_cache.init_app(app)
+slow_queries.init_app(app)
+query_deadlines.init_app(app)
+message_partitions.init_app(app)
+message_shards.init_app(app)
+hot_cache.init_app(app)
+limiter.init_app(app)
+app.cli.add_command(export.export_user_command)
+app.cli.add_command(tags.backfill_tags_command)
+app.cli.add_command(archive.archive_messages_command)
+app.cli.add_command(partitions.create_partitions_command)
+app.cli.add_command(shards.create_shard_tables_command)
+app.cli.add_command(shards.rebalance_shards_command)
+
 connect_db(app) 
 
 
@@ -34,7 +103,7 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = hot_cache.user(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -53,6 +122,55 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def following_ids_for_g():
+    """Ids the logged-in user follows (for Follow/Unfollow buttons)."""
+
+    return feeds.following_ids(g.user.id) if g.user else set()
+
+
+def signup_conflict(username, email):
+    """Flash message if this username or email is taken, else None.
+
+    Only with the user filter, and then only queries (once) for whichever
+    of the two it can't rule out. Without it, the unique constraints are
+    the only check.
+    """
+
+    if not user_filter.enabled:
+        return None
+
+    maybe = []
+    if user_filter.might_exist('username', username):
+        maybe.append(User.username == username)
+    if user_filter.might_exist('email', email):
+        maybe.append(User.email == email)
+
+    if not maybe:
+        return None
+
+    taken = (db.session
+             .query(User.username, User.email)
+             .filter(or_(*maybe))
+             .all())
+
+    if any(row.username == username for row in taken):
+        return "Username already taken"
+
+    if any(row.email == email for row in taken):
+        return "Email already taken"
+
+    return None
+
+
+def save_image(file, kind):
+    """Save an uploaded image into the thumbnail cache; return its URL."""
+
+    return images.save_upload(file,
+                              kind,
+                              app.config['IMAGE_UPLOAD_FOLDER'],
+                              app.config['IMAGE_UPLOAD_URL'])
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -68,12 +186,26 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        conflict = signup_conflict(form.username.data, form.email.data)
+        if conflict:
+            flash(conflict, 'danger')
+            return render_template('users/signup.html', form=form)
+
+        image_url = form.image_url.data or User.image_url.default.arg
+
+        if form.image_file.data:
+            try:
+                image_url = save_image(form.image_file.data, 'avatar')
+            except ValueError:
+                flash("Couldn't read that image", 'danger')
+                return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=image_url,
             )
             db.session.commit()
 
@@ -81,6 +213,8 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        user_filter.add(user.username, user.email)
+
         do_login(user)
 
         return redirect("/")
@@ -130,31 +264,33 @@ def list_users():
     """
 
     search = request.args.get('q')
+    users = feeds.search_users(search)
+    following_ids = feeds.following_ids(g.user.id) if g.user else set()
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html',
+                           users=users,
+                           following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    page_cache.depends_on(f"user:{user_id}")
+    user = hot_cache.user(user_id)
+    if user is None:
+        abort(404)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    messages = feeds.user_messages(user_id)
     curr_user = g.user.id if g.user else None
-    return render_template('users/show.html', user=user, messages=messages, curr_user=curr_user)
+    return render_template('users/show.html',
+                           user=user,
+                           stats=feeds.user_stats(user_id),
+                           following_ids=following_ids_for_g(),
+                           messages=messages,
+                           like_states=feeds.like_states(
+                               [msg.id for msg in messages], curr_user),
+                           curr_user=curr_user)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -166,7 +302,11 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return render_template('users/following.html',
+                           user=user,
+                           stats=feeds.user_stats(user_id),
+                           following_ids=following_ids_for_g(),
+                           users=feeds.following(user_id))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -178,37 +318,76 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    return render_template('users/followers.html',
+                           user=user,
+                           stats=feeds.user_stats(user_id),
+                           following_ids=following_ids_for_g(),
+                           users=feeds.followers(user_id))
+
+
+def follow_statement(user_id, followed_id):
+    """Insert of a follow that does nothing if it's already there."""
+
+    row = dict(user_following_id=user_id, user_being_followed_id=followed_id)
+    table = Follows.__table__
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        return pg_insert(table).values(row).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE').values(row)
+    else:
+        return table.insert().prefix_with('IGNORE').values(row)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
+    """Add a follow for the currently-logged-in user.
+
+    Follow buttons come from the follow graph, which can be stale, so
+    following someone already followed just does nothing.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-        
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+
+    user_id = g.user.id
+    User.query.get_or_404(follow_id)
+    added = db.session.execute(follow_statement(user_id, follow_id)).rowcount
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}/following")
+    follow_graph.add(user_id, follow_id)
+    if added:
+        notifier.followed(user_id, follow_id)
+    page_cache.invalidate(f"user:{user_id}", f"user:{follow_id}")
+
+    return redirect(f"/users/{user_id}/following")
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
+    """Have currently-logged-in-user stop following this user.
+
+    Like following, a no-op if they weren't following (or there's no
+    such user).
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    user_id = g.user.id
+    follows = Follows.__table__
+    db.session.execute(follows.delete()
+                       .where(follows.c.user_following_id == user_id)
+                       .where(follows.c.user_being_followed_id == follow_id))
     db.session.commit()
 
-    return redirect(f"/users/{g.user.id}/following")
+    follow_graph.remove(user_id, follow_id)
+    page_cache.invalidate(f"user:{user_id}", f"user:{follow_id}")
+
+    return redirect(f"/users/{user_id}/following")
 
 
 @app.route('/users/profile', methods=["GET", "POST"])
@@ -225,13 +404,29 @@ def profile():
                                  form.password.data)
 
         if user:
+            try:
+                image_url = (save_image(form.image_file.data, 'avatar')
+                             if form.image_file.data
+                             else form.image_url.data)
+                header_image_url = (
+                    save_image(form.header_image_file.data, 'header')
+                    if form.header_image_file.data
+                    else form.header_image_url.data)
+            except ValueError:
+                flash("Couldn't read that image", 'danger')
+                return render_template("/users/edit.html", form=form)
+
             user.username = form.username.data
             user.email = form.email.data
-            user.image_url = form.image_url.data
-            user.header_image_url = form.header_image_url.data
+            user.image_url = image_url
+            user.header_image_url = header_image_url
             user.bio = form.bio.data
             db.session.add(user)
             db.session.commit()
+            author_feeds.invalidate(user.id)
+            page_cache.invalidate(f"user:{user.id}")
+            hot_cache.invalidate(f"user:{user.id}")
+            user_filter.add(user.username, user.email)
             
             flash("Profile updated!", "success")
             return redirect(f"/users/profile")
@@ -248,9 +443,73 @@ def user_show_likes(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.filter_by(id = user_id).first()
-    messages = user.likes
-    return render_template("/users/likes.html", messages=messages, user=user)
+    user = User.query.get_or_404(user_id)
+    page = feeds.liked_messages(user_id, before=request.args.get('before'))
+    return render_template("/users/likes.html",
+                           messages=page.items,
+                           next_cursor=page.next_cursor,
+                           user=user,
+                           stats=feeds.user_stats(user_id),
+                           following_ids=following_ids_for_g())
+
+
+@app.route('/users/<int:user_id>/mentions')
+def users_mentions(user_id):
+    """Show warbles that @mention this user, newest first."""
+
+    user = User.query.get_or_404(user_id)
+    page = feeds.mention_messages(user_id, before=request.args.get('before'))
+    return render_template('users/mentions.html',
+                           messages=page.items,
+                           next_cursor=page.next_cursor,
+                           user=user,
+                           stats=feeds.user_stats(user_id),
+                           following_ids=following_ids_for_g())
+
+
+@app.route('/notifications')
+def notifications_show():
+    """Show the logged-in user's like and follow digests; mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    page = notifications.notification_page(g.user.id,
+                                           before=request.args.get('before'))
+    if g.user.unread_notifications:
+        notifications.mark_read(g.user.id)
+
+    return render_template('notifications.html',
+                           notifications=page.items,
+                           next_cursor=page.next_cursor)
+
+
+@app.route('/users/export')
+def export_account():
+    """Download everything the current user has posted, liked and followed.
+
+    Streams NDJSON, or gzipped NDJSON with ?format=gzip.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    chunks = export.ndjson(g.user.id)
+    filename = f"warbler-{g.user.username}.ndjson"
+
+    if request.args.get('format') == 'gzip':
+        chunks = export.gzipped(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    else:
+        mimetype = 'application/x-ndjson'
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': export.content_disposition(filename)})
 
 
 @app.route('/users/delete', methods=["POST"])
@@ -263,8 +522,16 @@ def delete_user():
 
     do_logout()
 
+    if message_shards.enabled:
+        message_ids = message_shards.delete_user(g.user.id)
+        if message_ids:
+            delete_message_rows(db.session.connection(), message_ids)
     db.session.delete(g.user)
     db.session.commit()
+    author_feeds.invalidate(g.user.id)
+    follow_graph.remove_user(g.user.id)
+    page_cache.invalidate(f"user:{g.user.id}")
+    hot_cache.invalidate(f"user:{g.user.id}")
 
     return redirect("/signup")
 
@@ -286,27 +553,54 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        if message_shards.enabled:
+            msg = message_shards.add_message(g.user.id, form.text.data)
+        else:
+            msg = Message(text=form.text.data)
+            g.user.messages.append(msg)
+            db.session.flush()
+        tags.index_messages([(msg.id, msg.text)])
         db.session.commit()
+        page_cache.invalidate(f"user:{g.user.id}")
+        author_feeds.add_message(feeds.MessageRow(msg.id,
+                                                  msg.text,
+                                                  msg.timestamp,
+                                                  g.user.id,
+                                                  g.user.username,
+                                                  g.user.image_url))
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/tags/<tag>')
+def tag_show(tag):
+    """Show warbles with this hashtag, newest first."""
+
+    tag = tag.lower()
+    page = feeds.tag_messages(tag, before=request.args.get('before'))
+    return render_template('messages/tag.html',
+                           tag=tag,
+                           messages=page.items,
+                           next_cursor=page.next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    like_user_ids = [user.id for user in msg.likes]
+    msg = hot_cache.message(message_id)
+    if msg is None:
+        abort(404)
+
+    page_cache.depends_on(f"message:{message_id}", f"user:{msg.user_id}")
     curr_user = g.user.id if g.user else None
-    #import pdb; pdb.set_trace()
     return render_template('messages/show.html',
         message=msg,
         curr_user=curr_user,
-        like_user_ids=like_user_ids)
+        following_ids=following_ids_for_g(),
+        like_states=feeds.like_states([msg.id], curr_user))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -317,9 +611,19 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    msg = archive.find(message_id)
+    if msg is None:
+        abort(404)
+
+    if message_shards.enabled:
+        message_shards.delete_message(message_id)
+        delete_message_rows(db.session.connection(), [message_id])
+    else:
+        db.session.delete(msg)
     db.session.commit()
+    author_feeds.invalidate(msg.user_id)
+    page_cache.invalidate(f"user:{msg.user_id}", f"message:{message_id}")
+    hot_cache.invalidate(f"message:{message_id}")
 
     return redirect(f"/users/{g.user.id}")
 
@@ -330,12 +634,9 @@ def message_like_add(message_id):
     if not g.user or not request.form['curr_user'] or g.user.id != int(request.form['curr_user']):
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    new_like = Likes(
-        user_id=request.form['curr_user'],
-        message_id=message_id
-        )
-    db.session.add(new_like)
-    db.session.commit()
+    likes.like(g.user.id, message_id)
+    notifier.liked(g.user.id, message_id)
+    page_cache.invalidate(f"message:{message_id}", f"user:{g.user.id}")
     return redirect(f"/messages/{message_id}")
 
 
@@ -345,9 +646,8 @@ def message_like_delete(message_id):
     if not g.user or not request.form['curr_user'] or g.user.id != int(request.form['curr_user']):
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    del_like = Likes.query.filter(Likes.user_id == request.form['curr_user'], Likes.message_id == message_id).first()
-    db.session.delete(del_like)
-    db.session.commit()
+    likes.unlike(g.user.id, message_id)
+    page_cache.invalidate(f"message:{message_id}", f"user:{g.user.id}")
     return redirect(f"/messages/{message_id}")
 
 
@@ -355,6 +655,29 @@ def message_like_delete(message_id):
 # Homepage and error pages
 
 
+DEGRADED_TIMELINE_MESSAGE = ("Your timeline is taking longer than usual to "
+                             "load. Showing what we have for now.")
+
+
+def degraded_timeline(user_id, following_ids):
+    """Timeline to show when the real one ran out of time.
+
+    Whatever of it is in the author feed cache, plus the user's own
+    messages (a cheap indexed query), with a banner saying it's partial.
+    """
+
+    db.session.rollback()
+    metrics.increment('warbler_degraded_timelines_total',
+                      'Home timelines served from the degraded fallback.')
+    flash(DEGRADED_TIMELINE_MESSAGE, 'warning')
+
+    cached = author_feeds.cached_timeline(following_ids - {user_id})
+    own = feeds.user_messages(user_id)
+    merged = heapq.merge(cached, own, key=newest_first, reverse=True)
+
+    return list(islice(merged, 100))
+
+
 @app.route('/')
 def homepage():
     """Show homepage:
@@ -362,15 +685,23 @@ def homepage():
     - logged in: 100 most recent messages of followed_users
     """
     if g.user:
-        following_ids = [user.id for user in g.user.following]
-        following_ids.append(g.user.id)
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        return render_template('home.html', messages=messages, curr_user=g.user.id)
+        following_ids = feeds.following_ids(g.user.id)
+        following_ids.add(g.user.id)
+        try:
+            if app.config['TIMELINE_MODE'] == 'merge':
+                messages = author_feeds.timeline(following_ids)
+            else:
+                messages = feeds.timeline_messages(following_ids)
+        except OperationalError as exc:
+            if not deadlines.exceeded(exc):
+                raise
+            messages = degraded_timeline(g.user.id, following_ids)
+        return render_template('home.html',
+                               messages=messages,
+                               stats=feeds.user_stats(g.user.id),
+                               like_states=feeds.like_states(
+                                   [msg.id for msg in messages], g.user.id),
+                               curr_user=g.user.id)
 
     else:
         return render_template('home-anon.html')
@@ -0,0 +1,129 @@
+"""Cold archive tier for old messages.
+
+Profiles and timelines read the newest messages, but without this every
+message ever posted stays in `messages` and its indexes. The archiver moves
+messages older than a cutoff into `messages_archive` (same columns, its own
+(user_id, id) index), keeping the hot table and its indexes the size of the
+recent past:
+
+    FLASK_APP=app flask archive-messages --days 365
+
+Age is judged by message id, which is time-ordered (see snowflake.py), and
+messages move oldest first in batches of --batch, each its own
+transaction. So every archived id is lower than every id still in
+`messages`, and reads can treat the two tables as one id-ordered sequence:
+feeds.py reads the hot table first and continues into the archive only
+when a page runs out of hot rows (deep-history pages, or users who haven't
+posted in a while). Likes, tag and mention index entries and notifications
+stay where they are; they refer to messages by id in either table.
+
+Archived messages are never edited. Deleting one still works. With message
+shards (see shards.py) there's no archive tier, and the command refuses to
+run.
+"""
+
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, User, Message, ArchivedMessage
+from shards import message_shards
+from snowflake import id_for_datetime
+
+ARCHIVE_AFTER_DAYS = 365
+ARCHIVE_BATCH = 5000
+
+COLUMNS = ('id', 'text', 'timestamp', 'user_id')
+
+
+def cutoff_id(days):
+    """Lowest message id posted within the last `days` days."""
+
+    return id_for_datetime(datetime.utcnow() - timedelta(days=days))
+
+
+def archive_batch(before_id, batch=ARCHIVE_BATCH):
+    """Move up to `batch` of the oldest messages below `before_id`.
+
+    Returns how many moved (0 once there are none left).
+    """
+
+    ids = [message_id for (message_id,) in (db.session
+                                            .query(Message.id)
+                                            .filter(Message.id < before_id)
+                                            .order_by(Message.id)
+                                            .limit(batch))]
+    if not ids:
+        return 0
+
+    hot = Message.__table__
+    db.session.execute(
+        ArchivedMessage.__table__
+        .insert()
+        .from_select(COLUMNS,
+                     select([hot.c[name] for name in COLUMNS])
+                     .where(hot.c.id.in_(ids))))
+    db.session.execute(hot.delete().where(hot.c.id.in_(ids)))
+    db.session.commit()
+
+    return len(ids)
+
+
+def archive_messages(days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH,
+                     progress=None):
+    """Archive everything older than `days`; returns how many moved.
+
+    `progress`, if given, is called with the running total after each batch.
+    """
+
+    before_id = cutoff_id(days)
+    done = 0
+
+    while True:
+        moved = archive_batch(before_id, batch)
+        if not moved:
+            return done
+
+        done += moved
+        if progress:
+            progress(done)
+
+
+def find(message_id):
+    """The Message, or ArchivedMessage, with this id; None if neither.
+
+    With message shards (see shards.py) it's a detached Message from its
+    shard, with its `user` loaded from the main database.
+    """
+
+    if message_shards.enabled:
+        msg = message_shards.find(message_id)
+        if msg is not None:
+            set_committed_value(msg, 'user', User.query.get(msg.user_id))
+        return msg
+
+    return (Message.query.get(message_id)
+            or ArchivedMessage.query.get(message_id))
+
+
+@click.command('archive-messages')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help="Archive messages older than this many days.")
+@click.option('--batch', default=ARCHIVE_BATCH, show_default=True,
+              help="Messages moved per transaction.")
+@with_appcontext
+def archive_messages_command(days, batch):
+    """Move old messages from the hot table to the archive."""
+
+    if message_shards.enabled:
+        raise click.ClickException("Messages on MESSAGE_SHARDS can't be "
+                                   "archived.")
+
+    def progress(done):
+        click.echo(f"{done} messages...", err=True)
+
+    done = archive_messages(days, batch, progress)
+    click.echo(f"Archived {done} messages.")
@@ -0,0 +1,726 @@
+"""Optional ASGI entry point: async serving for the read-heavy pages.
+
+Under WSGI a worker is busy for the whole of every request, including the
+time spent waiting on Postgres, so concurrency tops out at the number of
+workers. Here the busiest read pages are served asynchronously:
+
+    GET /                   homepage
+    GET /users              list_users
+    GET /users/<id>         users_show
+    GET /messages/<id>      messages_show
+
+Their queries are built from the models.py tables (and feeds.py's column
+lists), compiled for Postgres and run through an asyncpg pool, and the
+templates are rendered with Jinja's async mode. Independent queries for a
+page run concurrently on separate connections.
+
+Everything else (forms, writes, the JSON API, static files, 404s, requests
+with flash messages waiting) goes to the Flask app on a thread pool, so one
+server still serves the whole site:
+
+    pip install asyncpg uvicorn
+    uvicorn asgi:application --workers 4
+
+The async pages skip the Flask-only extras: the page cache, /metrics
+timings, the debug toolbar and the in-memory follow graph. These still
+apply:
+
+- rate limits (RATELIMIT_PROXIES included)
+- QUERY_DEADLINES, as asyncpg's per-query timeout, which cancels the
+  statement on the server when it runs over; the homepage falls back to
+  the same partial timeline Flask shows
+- the hot row cache, for the logged-in user, profiles and message pages
+
+With TIMELINE_MODE=merge the homepage goes to Flask, which keeps the
+author feed cache, and with MESSAGE_SHARDS so does every page showing
+messages (see shards.py). HEAD requests get the GET response's headers only.
+"""
+
+import asyncio
+import heapq
+import re
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from http.cookies import CookieError, SimpleCookie
+from io import BytesIO
+from itertools import islice
+from math import ceil
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+
+import jinja2
+from itsdangerous import BadSignature
+from sqlalchemy import case, func, select
+from sqlalchemy.dialects import postgresql
+from werkzeug.exceptions import HTTPException
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from app import app as flask_app, CURR_USER_KEY, DEGRADED_TIMELINE_MESSAGE
+from author_feeds import author_feeds, newest_first
+from deadlines import query_deadlines
+import feeds
+from hot_cache import cached_columns, hot_cache
+import images
+from likes import like_buffer
+from metrics import metrics
+from models import User, Message, ArchivedMessage, Follows, Likes
+from ratelimit import limiter
+from shards import message_shards
+import tags
+
+# Compile with :1, :2... placeholders, then rewrite them to asyncpg's $1, $2.
+DIALECT = postgresql.dialect(paramstyle='numeric')
+PARAM_RE = re.compile(r'(?<!:):(\d+)')
+
+Profile = namedtuple(
+    'Profile',
+    ['id', 'username', 'image_url', 'header_image_url', 'bio', 'location',
+     'unread_notifications'])
+
+PROFILE_COLUMNS = (User.id,
+                   User.username,
+                   User.image_url,
+                   User.header_image_url,
+                   User.bio,
+                   User.location,
+                   User.unread_notifications)
+
+# The endpoint being served, for per-route query deadlines. Tasks started
+# by asyncio.gather() inherit it.
+current_endpoint = ContextVar('current_endpoint', default=None)
+
+HEADERS = [
+    (b'cache-control', b'public, max-age=0'),
+    (b'pragma', b'no-cache'),
+    (b'expires', b'0'),
+]
+
+
+def compile_statement(statement):
+    """(sql, params) for asyncpg from a SQLAlchemy Core statement."""
+
+    compiled = statement.compile(dialect=DIALECT)
+
+    return (PARAM_RE.sub(r'$\1', compiled.string),
+            [compiled.params[name] for name in compiled.positiontup])
+
+
+class Database:
+    """asyncpg connection pool that runs SQLAlchemy Core statements."""
+
+    def __init__(self, url, size):
+        # asyncpg takes plain postgresql:// DSNs, without a +driver.
+        self.dsn = re.sub(r'^postgres(ql)?(\+\w+)?://', 'postgresql://', url)
+        self.size = size
+        self.pool = None
+
+    async def connect(self):
+        if asyncpg is None:
+            raise RuntimeError("The ASGI app needs asyncpg: "
+                               "pip install asyncpg")
+
+        self.pool = await asyncpg.create_pool(self.dsn,
+                                              min_size=1,
+                                              max_size=self.size)
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+
+    async def fetch(self, statement):
+        """Rows of `statement`, within the current route's QUERY_DEADLINES.
+
+        A statement that runs over is cancelled and raises
+        asyncio.TimeoutError.
+        """
+
+        sql, params = compile_statement(statement)
+        endpoint = current_endpoint.get()
+        deadline = query_deadlines.deadlines.get(endpoint,
+                                                 query_deadlines.default)
+
+        try:
+            return await self.pool.fetch(
+                sql, *params, timeout=deadline / 1000 if deadline else None)
+        except asyncio.TimeoutError:
+            query_deadlines.record_exceeded(endpoint)
+            raise
+
+
+##############################################################################
+# Queries: async twins of the feeds.py functions these pages use
+
+
+def message_select(model=Message):
+    return (select(list(feeds.message_columns(model)))
+            .select_from(model.__table__.join(User.__table__,
+                                              model.user_id == User.id)))
+
+
+async def cached_row(key, load):
+    """hot_cache.fetch() for a coroutine load()."""
+
+    if not hot_cache.enabled:
+        return await load()
+
+    row, version = hot_cache.lookup(key)
+    if row is None:
+        row = await load()
+        hot_cache.save(key, row, version)
+
+    return row
+
+
+async def load_row(db, model, row_id):
+    """The hot cache's row for this User or message, from the database."""
+
+    columns = cached_columns(model)
+    rows = await db.fetch(select(columns).where(model.id == row_id))
+
+    if not rows:
+        return None
+
+    return model.__name__, dict(zip([column.key for column in columns],
+                                    rows[0]))
+
+
+async def profile(db, user_id):
+    if hot_cache.enabled:
+        row = await cached_row(f"user:{user_id}",
+                               lambda: load_row(db, User, user_id))
+        if row is None:
+            return None
+        _, columns = row
+        return Profile._make(columns[field] for field in Profile._fields)
+
+    rows = await db.fetch(select(list(PROFILE_COLUMNS))
+                          .where(User.id == user_id))
+
+    return Profile._make(rows[0]) if rows else None
+
+
+async def timeline_messages(db, user_ids, limit=100):
+    messages = []
+
+    for model, after_id, _ in feeds.message_ranges():
+        query = (message_select(model)
+                 .where(model.user_id.in_(user_ids))
+                 .order_by(model.id.desc())
+                 .limit(limit - len(messages)))
+        if after_id:
+            query = query.where(model.id >= after_id)
+
+        rows = await db.fetch(query)
+        messages += [feeds.MessageRow._make(row) for row in rows]
+        if len(messages) == limit:
+            break
+
+    return messages
+
+
+async def user_messages(db, user_id, limit=100):
+    return await timeline_messages(db, [user_id], limit)
+
+
+async def message(db, message_id):
+    if hot_cache.enabled:
+        return await cached_message(db, message_id)
+
+    for model in (Message, ArchivedMessage):
+        rows = await db.fetch(message_select(model)
+                              .where(model.id == message_id))
+        if rows:
+            return feeds.MessageRow._make(rows[0])
+
+    return None
+
+
+async def cached_message(db, message_id):
+    """message(), through the hot cache (as messages and as users)."""
+
+    async def load():
+        for model in (Message, ArchivedMessage):
+            row = await load_row(db, model, message_id)
+            if row is not None:
+                return row
+        return None
+
+    row = await cached_row(f"message:{message_id}", load)
+    if row is None:
+        return None
+
+    _, columns = row
+    author = await profile(db, columns['user_id'])
+
+    return feeds.MessageRow(columns['id'], columns['text'],
+                            columns['timestamp'], columns['user_id'],
+                            author.username, author.image_url)
+
+
+async def search_users(db, search=None):
+    query = select(list(feeds.USER_COLUMNS)).order_by(User.username)
+
+    if search:
+        query = query.where(User.username.like(f"%{search}%"))
+
+    return [feeds.UserRow._make(row) for row in await db.fetch(query)]
+
+
+async def following_ids(db, user_id):
+    if user_id is None:
+        return set()
+
+    rows = await db.fetch(select([Follows.user_being_followed_id])
+                          .where(Follows.user_following_id == user_id))
+
+    return {followed_id for (followed_id,) in rows}
+
+
+async def user_stats(db, user_id):
+    def count(column):
+        return (select([func.count()])
+                .select_from(column.table)
+                .where(column == user_id)
+                .as_scalar())
+
+    rows = await db.fetch(select([count(Message.user_id)
+                                  + count(ArchivedMessage.user_id),
+                                  count(Follows.user_following_id),
+                                  count(Follows.user_being_followed_id),
+                                  count(Likes.user_id)]))
+
+    return feeds.UserStats._make(rows[0])
+
+
+async def like_states(db, message_ids, viewer_id=None):
+    states = dict.fromkeys(message_ids, feeds.NOT_LIKED)
+
+    if not states:
+        return states
+
+    liked_by_viewer = func.max(case([(Likes.user_id == viewer_id, 1)], else_=0))
+    rows = await db.fetch(select([Likes.message_id, func.count(), liked_by_viewer])
+                          .where(Likes.message_id.in_(list(states)))
+                          .group_by(Likes.message_id))
+
+    for message_id, count, liked in rows:
+        states[message_id] = feeds.LikeState(count, bool(liked))
+
+    return like_buffer.overlay(states, viewer_id)
+
+
+##############################################################################
+# The ASGI application
+
+
+class PageRequest:
+    """What an async view knows about its request."""
+
+    __slots__ = ('endpoint', 'args', 'user', 'client', 'flashes')
+
+    def __init__(self, endpoint, args, user, client):
+        self.endpoint = endpoint
+        self.args = args
+        self.user = user
+        self.client = client
+        # Shown on this page only: nothing can be kept in the session here.
+        self.flashes = []
+
+
+class AsyncWarbler:
+    """ASGI app: async read pages, everything else through Flask."""
+
+    def __init__(self, wsgi_app):
+        config = wsgi_app.config
+        config.setdefault('ASYNC_POOL_SIZE', 20)
+        config.setdefault('ASYNC_WSGI_THREADS', 16)
+
+        self.wsgi_app = wsgi_app
+        self.db = Database(config['SQLALCHEMY_DATABASE_URI'],
+                           config['ASYNC_POOL_SIZE'])
+        self.executor = ThreadPoolExecutor(config['ASYNC_WSGI_THREADS'],
+                                           thread_name_prefix='warbler-wsgi')
+        self.views = {
+            'homepage': self.homepage,
+            'list_users': self.list_users,
+            'users_show': self.users_show,
+            'messages_show': self.messages_show,
+        }
+        # Pages that read messages or likes, which may be on shards.
+        self.message_views = {'homepage', 'users_show', 'messages_show'}
+
+        self.templates = jinja2.Environment(
+            loader=wsgi_app.jinja_loader,
+            autoescape=jinja2.select_autoescape(['html']),
+            enable_async=True)
+        self.templates.filters['thumbnail'] = images.thumbnail
+        self.templates.filters['tag_links'] = tags.tag_links
+        self.templates.globals.update(url_for=self.url_for)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        if scope['type'] != 'http':
+            return
+
+        endpoint, view_args = self.match(scope)
+        view = self.views.get(endpoint)
+
+        if message_shards.enabled and endpoint in self.message_views:
+            view = None
+
+        if view is not None:
+            session = self.load_session(scope)
+
+            if '_flashes' not in session:
+                response = await self.dispatch(view, endpoint, view_args,
+                                               scope, session)
+                if response is not None:
+                    await self.send_response(send, scope['method'], *response)
+                    return
+
+        await self.call_wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            event = await receive()
+
+            if event['type'] == 'lifespan.startup':
+                await self.db.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif event['type'] == 'lifespan.shutdown':
+                await self.db.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # Routing and sessions, borrowed from the Flask app
+
+    def match(self, scope):
+        """(endpoint, view args) for a GET we might serve, else (None, None)."""
+
+        if scope['method'] not in ('GET', 'HEAD'):
+            return None, None
+
+        adapter = self.wsgi_app.url_map.bind('localhost')
+
+        try:
+            return adapter.match(scope['path'], method='GET')
+        except HTTPException:
+            return None, None
+
+    def url_for(self, endpoint, **values):
+        return self.wsgi_app.url_map.bind('localhost').build(endpoint, values)
+
+    def load_session(self, scope):
+        """The Flask session from the request's cookie ({} if none/invalid)."""
+
+        cookie = SimpleCookie()
+
+        try:
+            for name, value in scope['headers']:
+                if name == b'cookie':
+                    cookie.load(value.decode('latin1'))
+        except CookieError:
+            return {}
+
+        morsel = cookie.get(self.wsgi_app.session_cookie_name)
+        if morsel is None:
+            return {}
+
+        serializer = (self.wsgi_app.session_interface
+                      .get_signing_serializer(self.wsgi_app))
+        max_age = int(self.wsgi_app.permanent_session_lifetime.total_seconds())
+
+        try:
+            return serializer.loads(morsel.value, max_age=max_age)
+        except BadSignature:
+            return {}
+
+    async def dispatch(self, view, endpoint, view_args, scope, session):
+        """Run an async view; (status, headers, body) or None for Flask."""
+
+        remote_addr = (scope.get('client') or ('', 0))[0]
+        forwarded_for = ','.join(value.decode('latin1')
+                                 for name, value in scope['headers']
+                                 if name == b'x-forwarded-for')
+        client = limiter.client_ip(remote_addr, forwarded_for)
+        user_id = session.get(CURR_USER_KEY)
+        current_endpoint.set(endpoint)
+
+        if limiter.rules:
+            wait = limiter.wait_time(endpoint, 'GET', client, user_id)
+            if wait:
+                retry_after = max(1, ceil(wait))
+                body = f"Too many requests. Try again in {retry_after} seconds."
+                return (429,
+                        [(b'content-type', b'text/plain; charset=utf-8'),
+                         (b'retry-after', str(retry_after).encode())],
+                        body.encode())
+
+        user = await profile(self.db, user_id) if user_id else None
+        args = dict(parse_qsl(scope['query_string'].decode('latin1')))
+        request = PageRequest(endpoint, args, user, client)
+
+        html = await view(request, **view_args)
+        if html is None:
+            return None
+
+        return 200, [(b'content-type', b'text/html; charset=utf-8')], html.encode()
+
+    async def render(self, template, request, **context):
+        # Pages with flashes waiting in the session are handed to Flask
+        # (which has to clear them), so only this page's own are shown.
+        def get_flashed_messages(with_categories=False, **kwargs):
+            if with_categories:
+                return request.flashes
+            return [message for _, message in request.flashes]
+
+        return await self.templates.get_template(template).render_async(
+            request=request,
+            g=SimpleNamespace(user=request.user),
+            get_flashed_messages=get_flashed_messages,
+            **context)
+
+    # Views
+
+    async def homepage(self, request):
+        user = request.user
+
+        if not user:
+            return await self.render('home-anon.html', request)
+
+        if self.wsgi_app.config['TIMELINE_MODE'] == 'merge':
+            return None  # Flask has the author feed cache
+
+        following = await following_ids(self.db, user.id)
+        following.add(user.id)
+
+        messages, stats = await asyncio.gather(
+            self.timeline(request, following),
+            user_stats(self.db, user.id))
+
+        return await self.render(
+            'home.html', request,
+            messages=messages,
+            stats=stats,
+            like_states=await like_states(
+                self.db, [msg.id for msg in messages], user.id),
+            curr_user=user.id)
+
+    async def timeline(self, request, following):
+        """timeline_messages(), or a degraded one if it runs out of time."""
+
+        try:
+            return await timeline_messages(self.db, following)
+        except asyncio.TimeoutError:
+            return await self.degraded_timeline(request, following)
+
+    async def degraded_timeline(self, request, following):
+        """app.degraded_timeline(), for a timeline that ran out of time."""
+
+        metrics.increment('warbler_degraded_timelines_total',
+                          'Home timelines served from the degraded fallback.')
+        request.flashes.append(('warning', DEGRADED_TIMELINE_MESSAGE))
+
+        cached = author_feeds.cached_timeline(following - {request.user.id})
+        own = await user_messages(self.db, request.user.id)
+        merged = heapq.merge(cached, own, key=newest_first, reverse=True)
+
+        return list(islice(merged, 100))
+
+    async def list_users(self, request):
+        viewer_id = request.user.id if request.user else None
+
+        users, following = await asyncio.gather(
+            search_users(self.db, request.args.get('q')),
+            following_ids(self.db, viewer_id))
+
+        return await self.render('users/index.html', request,
+                                 users=users,
+                                 following_ids=following)
+
+    async def users_show(self, request, user_id):
+        viewer_id = request.user.id if request.user else None
+
+        user, messages, stats, following = await asyncio.gather(
+            profile(self.db, user_id),
+            timeline_messages(self.db, [user_id]),
+            user_stats(self.db, user_id),
+            following_ids(self.db, viewer_id))
+
+        if user is None:
+            return None  # Flask renders the 404
+
+        return await self.render(
+            'users/show.html', request,
+            user=user,
+            stats=stats,
+            following_ids=following,
+            messages=messages,
+            like_states=await like_states(
+                self.db, [msg.id for msg in messages], viewer_id),
+            curr_user=viewer_id)
+
+    async def messages_show(self, request, message_id):
+        viewer_id = request.user.id if request.user else None
+
+        row, following, states = await asyncio.gather(
+            message(self.db, message_id),
+            following_ids(self.db, viewer_id),
+            like_states(self.db, [message_id], viewer_id))
+
+        if row is None:
+            return None
+
+        author = SimpleNamespace(id=row.user_id,
+                                 username=row.username,
+                                 image_url=row.image_url)
+
+        return await self.render(
+            'messages/show.html', request,
+            message=SimpleNamespace(user=author, **row._asdict()),
+            curr_user=viewer_id,
+            following_ids=following,
+            like_states=states)
+
+    # Responses
+
+    async def send_response(self, send, method, status, headers, body):
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': headers + HEADERS + [
+                        (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body',
+                    'body': body if method != 'HEAD' else b''})
+
+    # Everything else: the Flask app, on a worker thread
+
+    async def call_wsgi(self, scope, receive, send):
+        """Run the request through Flask, streaming its response back.
+
+        The whole WSGI call (including iterating a streamed response, which
+        may depend on thread-local request context) runs on one thread;
+        chunks come back through a small queue.
+        """
+
+        body = BytesIO()
+        more_body = True
+        while more_body:
+            event = await receive()
+            body.write(event.get('body', b''))
+            more_body = event.get('more_body', False)
+        body.seek(0)
+
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=8)
+        environ = wsgi_environ(scope, body)
+
+        worker = loop.run_in_executor(self.executor, run_wsgi,
+                                      self.wsgi_app, environ, loop, queue)
+
+        sending = True
+        while True:
+            item = await queue.get()
+
+            if item[0] == 'end':
+                break
+
+            if not sending:
+                continue  # client went away: drain so the thread can finish
+
+            try:
+                if item[0] == 'start':
+                    _, status, headers = item
+                    await send({'type': 'http.response.start',
+                                'status': int(status.split(' ', 1)[0]),
+                                'headers': [(k.lower().encode('latin1'),
+                                             v.encode('latin1'))
+                                            for k, v in headers]})
+                else:
+                    await send({'type': 'http.response.body',
+                                'body': item[1],
+                                'more_body': True})
+            except OSError:
+                sending = False
+
+        await worker
+
+        if sending:
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+def wsgi_environ(scope, body):
+    """A WSGI environ for an ASGI HTTP scope."""
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+        environ['REMOTE_PORT'] = str(client[1])
+
+    for name, value in scope['headers']:
+        name = name.decode('latin1')
+        value = value.decode('latin1')
+
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'content-length':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+    return environ
+
+
+def run_wsgi(wsgi_app, environ, loop, queue):
+    """Call a WSGI app on this thread, feeding its output into `queue`."""
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def start_response(status, headers, exc_info=None):
+        put(('start', status, headers))
+        return lambda data: put(('body', data))
+
+    try:
+        result = wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    put(('body', chunk))
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+    finally:
+        put(('end',))
+
+
+application = AsyncWarbler(flask_app)
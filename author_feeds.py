@@ -0,0 +1,195 @@
+"""Pull-model home timelines: merge cached per-author feeds.
+
+The default home timeline is one SQL query: the newest 100 messages whose
+author is in the viewer's following list. With TIMELINE_MODE = 'merge' we
+instead keep, per author, a short cached list of their newest messages and
+build each timeline by heap-merging the lists of everyone the viewer
+follows. A popular author's list is loaded once and shared by all of their
+followers' timelines.
+
+Cached feeds live in this process, are bounded in count (LRU) and age
+(FEED_CACHE_TTL), and are updated in place when we see a write. Writes made
+by other workers only show up here once the entry expires, so the TTL is
+the bound on cross-worker staleness.
+"""
+
+import heapq
+import threading
+from collections import OrderedDict
+from itertools import chain, islice
+from operator import itemgetter
+from time import monotonic
+
+from sqlalchemy import func
+
+from feeds import MessageRow, message_query, with_authors
+from models import db, Message
+from shards import message_shards
+
+
+def ranked_by_author():
+    """Each message's place among its author's, newest first, as `rank`."""
+
+    return (func.row_number()
+            .over(partition_by=Message.user_id,
+                  order_by=Message.id.desc())
+            .label('rank'))
+
+
+def newest_first(row):
+    """Sort key matching feeds.timeline_messages' ORDER BY."""
+
+    return row.id
+
+
+class AuthorFeedCache:
+    """LRU cache of author id -> tuple of their newest MessageRows."""
+
+    def __init__(self, depth=100, max_authors=10000, ttl=30):
+        self.depth = depth
+        self.max_authors = max_authors
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.feeds = OrderedDict()
+
+    def configure(self, app):
+        """Pick up FEED_CACHE_* settings from the app config."""
+
+        self.depth = app.config.setdefault('FEED_CACHE_DEPTH', self.depth)
+        self.max_authors = app.config.setdefault('FEED_CACHE_AUTHORS',
+                                                 self.max_authors)
+        self.ttl = app.config.setdefault('FEED_CACHE_TTL', self.ttl)
+
+    def timeline(self, author_ids, limit=100):
+        """Newest `limit` messages by any of `author_ids`, newest first."""
+
+        feeds = self.get_many(author_ids)
+        merged = heapq.merge(*feeds.values(), key=newest_first, reverse=True)
+
+        return list(islice(merged, min(limit, self.depth)))
+
+    def cached_timeline(self, author_ids, limit=100):
+        """Like timeline(), from whatever is cached (however old); no SQL."""
+
+        with self.lock:
+            feeds = [self.feeds[author_id][1] for author_id in author_ids
+                     if author_id in self.feeds]
+
+        merged = heapq.merge(*feeds, key=newest_first, reverse=True)
+
+        return list(islice(merged, min(limit, self.depth)))
+
+    def get_many(self, author_ids):
+        """Cached feeds for these authors, loading any missing in one query."""
+
+        now = monotonic()
+        found = {}
+
+        with self.lock:
+            for author_id in author_ids:
+                entry = self.feeds.get(author_id)
+                if entry is not None and now - entry[0] < self.ttl:
+                    self.feeds.move_to_end(author_id)
+                    found[author_id] = entry[1]
+
+        missing = [author_id for author_id in author_ids
+                   if author_id not in found]
+
+        if missing:
+            loaded = self.load(missing)
+            with self.lock:
+                for author_id, rows in loaded.items():
+                    self.store(author_id, rows, now)
+            found.update(loaded)
+
+        return found
+
+    def load(self, author_ids):
+        """Newest `depth` messages for each author: one windowed query."""
+
+        if message_shards.enabled:
+            rows = self.load_sharded(author_ids)
+        else:
+            ranked = (message_query()
+                      .add_columns(ranked_by_author())
+                      .filter(Message.user_id.in_(author_ids))
+                      .subquery())
+            rows = (db.session
+                    .query(*[ranked.c[name] for name in MessageRow._fields])
+                    .filter(ranked.c.rank <= self.depth)
+                    .order_by(ranked.c.user_id, ranked.c.id.desc()))
+
+        feeds = {author_id: [] for author_id in author_ids}
+        for row in rows:
+            feeds[row.user_id].append(MessageRow._make(row))
+
+        return {author_id: tuple(rows) for author_id, rows in feeds.items()}
+
+    def load_sharded(self, author_ids):
+        """load()'s rows from message shards: its query on each shard
+        holding any of these authors (see shards.py).
+        """
+
+        def newest(shard_author_ids):
+            def query(session):
+                ranked = (session
+                          .query(Message.id, Message.text, Message.timestamp,
+                                 Message.user_id, ranked_by_author())
+                          .filter(Message.user_id.in_(shard_author_ids))
+                          .subquery())
+                return (session
+                        .query(ranked.c.id, ranked.c.text,
+                               ranked.c.timestamp, ranked.c.user_id)
+                        .filter(ranked.c.rank <= self.depth)
+                        .all())
+
+            return query
+
+        results = message_shards.scatter(
+            {name: newest(shard_author_ids)
+             for name, shard_author_ids
+             in message_shards.by_author(author_ids).items()})
+
+        return with_authors(sorted(chain.from_iterable(results.values()),
+                                   key=itemgetter(3, 0), reverse=True))
+
+    def store(self, author_id, rows, loaded_at):
+        """Cache `rows` for this author, evicting the LRU author if full.
+
+        Caller holds the lock.
+        """
+
+        self.feeds[author_id] = (loaded_at, rows)
+        self.feeds.move_to_end(author_id)
+
+        while len(self.feeds) > self.max_authors:
+            self.feeds.popitem(last=False)
+
+    def add_message(self, row):
+        """Put a just-written MessageRow at the front of its author's feed."""
+
+        self.add_messages([row])
+
+    def add_messages(self, new_rows):
+        """Add a batch of just-written MessageRows (oldest first)."""
+
+        with self.lock:
+            for row in new_rows:
+                entry = self.feeds.get(row.user_id)
+                if entry is not None:
+                    loaded_at, rows = entry
+                    self.feeds[row.user_id] = (loaded_at,
+                                               ((row,) + rows)[:self.depth])
+
+    def invalidate(self, author_id):
+        """Forget this author's feed (deleted message, changed profile...)."""
+
+        with self.lock:
+            self.feeds.pop(author_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.feeds.clear()
+
+
+author_feeds = AuthorFeedCache()
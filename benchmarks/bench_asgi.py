@@ -0,0 +1,136 @@
+"""Benchmark the page endpoints under WSGI and ASGI serving.
+
+Seeds a throwaway database, starts the app twice with the same number of
+worker processes:
+
+- wsgi:  gunicorn app:app (sync workers, one request at a time each)
+- asgi:  uvicorn asgi:application
+
+and has CONCURRENCY_LEVELS simultaneous clients fetch random profile pages
+(GET /users/<id>) from each for DURATION seconds, reporting requests per
+second and p50/p99 latency. Needs gunicorn, uvicorn and asyncpg installed.
+Run from the project root:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_asgi
+"""
+
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+os.environ['PAGE_CACHE_ENABLED'] = '0'
+
+from app import app  # noqa: E402  (needs DATABASE_URL set first)
+from models import db, User, Message  # noqa: E402
+
+NUM_USERS = 1000
+MESSAGES_PER_USER = 20
+WORKERS = 4
+CONCURRENCY_LEVELS = (4, 16, 64, 256)
+DURATION = 10
+PORT = 8765
+
+SERVERS = {
+    'wsgi': ['gunicorn', '--workers', str(WORKERS),
+             '--bind', f'127.0.0.1:{PORT}', 'app:app'],
+    'asgi': ['uvicorn', '--workers', str(WORKERS), '--no-access-log',
+             '--port', str(PORT), 'asgi:application'],
+}
+
+
+def seed():
+    """Fill the database with users and their messages."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        dict(username=f"user{i}",
+             email=f"user{i}@example.com",
+             password="$2b$12$" + "x" * 53)
+        for i in range(NUM_USERS)
+    ])
+    db.session.bulk_insert_mappings(Message, [
+        dict(text=f"Warble {i}", user_id=i % NUM_USERS + 1)
+        for i in range(NUM_USERS * MESSAGES_PER_USER)
+    ])
+    db.session.commit()
+
+
+async def fetch(path):
+    """GET `path` over a fresh connection; seconds taken."""
+
+    start = time.perf_counter()
+
+    reader, writer = await asyncio.open_connection('127.0.0.1', PORT)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n"
+                 f"Connection: close\r\n\r\n".encode())
+    status = await reader.readline()
+    await reader.read()
+    writer.close()
+
+    if b' 200 ' not in status:
+        raise RuntimeError(f"{path}: {status.decode().strip()}")
+
+    return time.perf_counter() - start
+
+
+async def load(concurrency):
+    """(requests/s, p50 ms, p99 ms) with `concurrency` clients."""
+
+    latencies = []
+    deadline = time.perf_counter() + DURATION
+
+    async def client():
+        while time.perf_counter() < deadline:
+            user_id = random.randint(1, NUM_USERS)
+            latencies.append(await fetch(f"/users/{user_id}"))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return (len(latencies) / elapsed,
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000)
+
+
+async def wait_for_server():
+    for _ in range(100):
+        try:
+            await fetch("/users/1")
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server didn't start")
+
+
+def main():
+    seed()
+
+    print(f"{'server':<6} {'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+
+    for name, command in SERVERS.items():
+        server = subprocess.Popen(command, env=os.environ,
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=sys.stderr)
+        try:
+            asyncio.run(wait_for_server())
+            for concurrency in CONCURRENCY_LEVELS:
+                rate, p50, p99 = asyncio.run(load(concurrency))
+                print(f"{name:<6} {concurrency:>7} {rate:>8.0f} "
+                      f"{p50:>8.1f} {p99:>8.1f}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
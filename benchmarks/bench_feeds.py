@@ -0,0 +1,107 @@
+"""Benchmark feed reads: full ORM instances vs. feeds.py read-model rows.
+
+Seeds a throwaway database, then times (and measures peak Python memory of)
+loading a 100- and 1000-message timeline page both ways, touching the same
+attributes the templates render.
+
+Run from the project root:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_feeds
+"""
+
+import os
+import statistics
+import time
+import tracemalloc
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app  # noqa: E402  (needs DATABASE_URL set first)
+from models import db, User, Message  # noqa: E402
+import feeds  # noqa: E402
+
+NUM_AUTHORS = 50
+NUM_MESSAGES = 5000
+PAGE_SIZES = (100, 1000)
+REPEATS = 20
+
+
+def seed():
+    """Fill the database with authors and messages."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        dict(username=f"author{i}",
+             email=f"author{i}@example.com",
+             password="$2b$12$" + "x" * 53,
+             bio="Nothing to see here.")
+        for i in range(NUM_AUTHORS)
+    ])
+    db.session.bulk_insert_mappings(Message, [
+        dict(text=f"Warble number {i}", user_id=i % NUM_AUTHORS + 1)
+        for i in range(NUM_MESSAGES)
+    ])
+    db.session.commit()
+
+
+def orm_page(author_ids, limit):
+    """The pre-feeds.py path: Message instances + lazy-loaded authors."""
+
+    messages = (Message
+                .query
+                .filter(Message.user_id.in_(author_ids))
+                .order_by(Message.id.desc())
+                .limit(limit)
+                .all())
+
+    return [(m.id, m.text, m.timestamp, m.user.id, m.user.username,
+             m.user.image_url) for m in messages]
+
+
+def rows_page(author_ids, limit):
+    """The feeds.py path: one column-only query into namedtuples."""
+
+    messages = feeds.timeline_messages(author_ids, limit=limit)
+
+    return [(m.id, m.text, m.timestamp, m.user_id, m.username, m.image_url)
+            for m in messages]
+
+
+def measure(fn, *args):
+    """Return (median seconds, peak bytes) for fn(*args) on a fresh session."""
+
+    timings = []
+
+    for _ in range(REPEATS):
+        db.session.remove()
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+
+    db.session.remove()
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return statistics.median(timings), peak
+
+
+def main():
+    seed()
+    author_ids = list(range(1, NUM_AUTHORS + 1))
+
+    print(f"{'path':<6} {'rows':>5} {'median ms':>10} {'peak KiB':>10}")
+
+    for limit in PAGE_SIZES:
+        for name, fn in (("orm", orm_page), ("rows", rows_page)):
+            seconds, peak = measure(fn, author_ids, limit)
+            print(f"{name:<6} {limit:>5} {seconds * 1000:>10.2f} "
+                  f"{peak / 1024:>10.1f}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
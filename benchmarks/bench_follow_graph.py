@@ -0,0 +1,77 @@
+"""Benchmark the in-memory follow graph: lookup latency and memory per edge.
+
+Builds a synthetic graph (no database needed) of NUM_USERS users whose
+follow counts are heavy-tailed like a real social graph, then reports:
+
+- microseconds per follow check, count, id set and 50-id page
+- bytes held per million edges
+
+Run from the project root:
+
+    python -m benchmarks.bench_follow_graph
+"""
+
+import random
+import time
+
+from follow_graph import FollowGraph, adjacency
+
+NUM_USERS = 200_000
+NUM_EDGES = 2_000_000
+LOOKUPS = 100_000
+
+
+def synthetic_edges():
+    """NUM_EDGES distinct (follower, followed) pairs, popular users favored."""
+
+    edges = set()
+
+    while len(edges) < NUM_EDGES:
+        follower = random.randint(1, NUM_USERS)
+        followed = min(int(random.paretovariate(1.2)), NUM_USERS)
+        if follower != followed:
+            edges.add((follower, followed))
+
+    return edges
+
+
+def per_call_us(fn, args):
+    """Mean microseconds per fn(*a) over `args`."""
+
+    start = time.perf_counter()
+    for a in args:
+        fn(*a)
+    return (time.perf_counter() - start) / len(args) * 1e6
+
+
+def main():
+    edges = synthetic_edges()
+
+    start = time.perf_counter()
+    graph = FollowGraph()
+    graph.replace(adjacency(sorted(edges)),
+                  adjacency(sorted((b, a) for a, b in edges)))
+    build = time.perf_counter() - start
+
+    users = [(random.randint(1, NUM_USERS),) for _ in range(LOOKUPS)]
+    pairs = [(random.randint(1, NUM_USERS), random.randint(1, 100))
+             for _ in range(LOOKUPS)]
+
+    usage = graph.memory_usage()
+
+    print(f"{usage.edges:,} edges built in {build:.2f}s")
+    print(f"{usage.bytes / 2 ** 20:.1f} MiB total, "
+          f"{usage.bytes_per_million_edges / 2 ** 20:.1f} MiB per million edges")
+    print()
+    print(f"{'operation':<16} {'us/call':>8}")
+
+    for name, fn, args in (
+            ("is_following", graph.is_following, pairs),
+            ("counts", graph.counts, users),
+            ("following_ids", graph.following_ids, users),
+            ("followers_page", graph.followers_page, users)):
+        print(f"{name:<16} {per_call_us(fn, args):>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
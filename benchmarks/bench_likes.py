@@ -0,0 +1,115 @@
+"""Benchmark like/unlike write throughput under a viral-message load.
+
+Seeds a throwaway database, then has NUM_LIKERS users each like and unlike
+one hot message (TOGGLES times each) through:
+
+- orm:       the pre-likes.py path: Likes() + commit to like, SELECT then
+             DELETE + commit to unlike
+- upsert:    likes.like / likes.unlike, one idempotent statement each
+- buffered:  LikeBuffer.put for every toggle, plus the flushes that write
+             the coalesced result
+
+and reports toggles per second. Run from the project root:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_likes
+"""
+
+import os
+import time
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app  # noqa: E402  (needs DATABASE_URL set first)
+from models import db, User, Message, Likes  # noqa: E402
+import likes  # noqa: E402
+from likes import LikeBuffer  # noqa: E402
+
+NUM_LIKERS = 500
+TOGGLES = 4
+
+
+def seed():
+    """Fill the database with likers and one hot message."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        dict(username=f"liker{i}",
+             email=f"liker{i}@example.com",
+             password="$2b$12$" + "x" * 53)
+        for i in range(NUM_LIKERS)
+    ])
+    message = Message(text="Going viral", user_id=1)
+    db.session.add(message)
+    db.session.commit()
+
+    return message.id
+
+
+def orm_toggle(user_id, message_id, liked):
+    if liked:
+        db.session.add(Likes(user_id=user_id, message_id=message_id))
+    else:
+        like = Likes.query.filter(Likes.user_id == user_id,
+                                  Likes.message_id == message_id).first()
+        db.session.delete(like)
+    db.session.commit()
+
+
+def upsert_toggle(user_id, message_id, liked):
+    (likes.like if liked else likes.unlike)(user_id, message_id)
+
+
+def buffered():
+    """Toggle function writing through a LikeBuffer, and its flush."""
+
+    buffer = LikeBuffer()
+    buffer.app = app
+    buffer.enabled = True
+    buffer.max_pending = NUM_LIKERS
+    buffer.ensure_flusher = lambda: None
+
+    def toggle(user_id, message_id, liked):
+        buffer.put(user_id, message_id, liked)
+        if len(buffer.pending) >= buffer.max_pending:
+            buffer.flush()
+
+    return toggle, buffer.flush
+
+
+def run(toggle, message_id, finish=None):
+    """Toggles per second for every liker flipping TOGGLES times."""
+
+    Likes.query.delete()
+    db.session.commit()
+
+    start = time.perf_counter()
+    for round_number in range(TOGGLES):
+        liked = round_number % 2 == 0
+        for user_id in range(1, NUM_LIKERS + 1):
+            toggle(user_id, message_id, liked)
+    if finish:
+        finish()
+    elapsed = time.perf_counter() - start
+
+    assert Likes.query.count() == (NUM_LIKERS if TOGGLES % 2 else 0)
+
+    return NUM_LIKERS * TOGGLES / elapsed
+
+
+def main():
+    message_id = seed()
+    buffered_toggle, flush = buffered()
+
+    print(f"{'path':<9} {'toggles/s':>10}")
+
+    for name, toggle, finish in (("orm", orm_toggle, None),
+                                 ("upsert", upsert_toggle, None),
+                                 ("buffered", buffered_toggle, flush)):
+        print(f"{name:<9} {run(toggle, message_id, finish):>10.0f}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
@@ -0,0 +1,96 @@
+"""Benchmark home timeline assembly: SQL IN query vs. merged author feeds.
+
+Seeds a throwaway database, then for viewers following 10 to 1000 authors
+times building a 100-message timeline with:
+
+- sql:         feeds.timeline_messages (TIMELINE_MODE = 'sql')
+- merge-cold:  author_feeds.timeline with an empty cache
+- merge-warm:  author_feeds.timeline with every author already cached
+
+Run from the project root:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.bench_timeline
+"""
+
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler-bench")
+
+from app import app  # noqa: E402  (needs DATABASE_URL set first)
+from author_feeds import author_feeds  # noqa: E402
+from models import db, User, Message  # noqa: E402
+import feeds  # noqa: E402
+
+NUM_AUTHORS = 1000
+MESSAGES_PER_AUTHOR = 30
+FOLLOW_COUNTS = (10, 100, 300, 1000)
+REPEATS = 10
+
+
+def seed():
+    """Fill the database with authors and their messages."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        dict(username=f"author{i}",
+             email=f"author{i}@example.com",
+             password="$2b$12$" + "x" * 53)
+        for i in range(NUM_AUTHORS)
+    ])
+
+    start = datetime.utcnow() - timedelta(days=30)
+    db.session.bulk_insert_mappings(Message, [
+        dict(text=f"Warble {i}",
+             user_id=i % NUM_AUTHORS + 1,
+             timestamp=start + timedelta(seconds=random.randrange(30 * 86400)))
+        for i in range(NUM_AUTHORS * MESSAGES_PER_AUTHOR)
+    ])
+    db.session.commit()
+
+
+def timed(fn, setup=None):
+    """Median seconds of fn() over REPEATS runs, calling setup() before each."""
+
+    timings = []
+
+    for _ in range(REPEATS):
+        if setup:
+            setup()
+        db.session.remove()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+def main():
+    seed()
+
+    print(f"{'follows':>7} {'sql ms':>8} {'merge-cold ms':>14} {'merge-warm ms':>14}")
+
+    for count in FOLLOW_COUNTS:
+        author_ids = random.sample(range(1, NUM_AUTHORS + 1), count)
+
+        assert (author_feeds.timeline(author_ids)
+                == feeds.timeline_messages(author_ids))
+
+        sql = timed(lambda: feeds.timeline_messages(author_ids))
+        cold = timed(lambda: author_feeds.timeline(author_ids),
+                     setup=author_feeds.clear)
+        author_feeds.timeline(author_ids)
+        warm = timed(lambda: author_feeds.timeline(author_ids))
+
+        print(f"{count:>7} {sql * 1000:>8.2f} {cold * 1000:>14.2f} "
+              f"{warm * 1000:>14.2f}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
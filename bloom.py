@@ -0,0 +1,227 @@
+"""Bloom filter of taken usernames and emails.
+
+Signup used to find out a username was taken only from the IntegrityError
+after hashing the password and attempting the insert.
+
+With USER_FILTER_ENABLED, each worker keeps a Bloom filter of every
+username and email, built from the users table at its first request. A
+filter never says "absent" for something it holds, so signup only queries
+for a duplicate when the filter says "maybe", and then before spending any
+time on bcrypt.
+
+Filters can't forget, so deleted users and old usernames just read as
+"maybe" (which costs a query, never a wrong answer) until the next full
+rebuild, every USER_FILTER_REBUILD seconds on a background thread.
+
+Users created by other workers are picked up by a cheap `id >` query, run
+(at most every USER_FILTER_REFRESH seconds) before we answer "absent".
+That misses renames made by other workers and users whose lower id commits
+after a higher one, until the next rebuild, so "absent" is only a hint:
+signup then skips its pre-check and relies on the unique constraints.
+
+That's also why login doesn't consult the filter, though answering
+made-up usernames without a query was the other reason for it: a false
+"absent" there would lock a real user out, and making "absent" exact
+would mean tracking every rename and late commit across workers.
+"""
+
+import hashlib
+import os
+import threading
+from math import ceil, log
+from time import monotonic
+
+from sqlalchemy import func
+
+from models import db, User
+
+LOAD_BATCH = 10000
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter of strings."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(8, ceil(-capacity * log(error_rate) / log(2) ** 2))
+        self.num_hashes = max(1, round(self.size / capacity * log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        """Bit positions for `item` (Kirsch-Mitzenmacher double hashing)."""
+
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(h1 + i * h2) % self.size for i in range(self.num_hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.positions(item))
+
+
+class UserFilter:
+    """Flask extension: which usernames and emails might be taken."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.max_id = 0
+        self.pending = None
+        self.loaded_at = None
+        self.refreshed_at = None
+        self.rebuilding = False
+        self.capacity = 1_000_000
+        self.error_rate = 0.01
+        self.refresh_every = 1.0
+        self.rebuild_every = None
+        self.app = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('USER_FILTER_ENABLED',
+                          os.environ.get('USER_FILTER_ENABLED') == '1')
+        config.setdefault('USER_FILTER_CAPACITY', self.capacity)
+        config.setdefault('USER_FILTER_ERROR_RATE', self.error_rate)
+        config.setdefault('USER_FILTER_REFRESH', self.refresh_every)
+        config.setdefault('USER_FILTER_REBUILD', 600)
+
+        if not config['USER_FILTER_ENABLED']:
+            return
+
+        self.enabled = True
+        self.app = app
+        self.capacity = config['USER_FILTER_CAPACITY']
+        self.error_rate = config['USER_FILTER_ERROR_RATE']
+        self.refresh_every = config['USER_FILTER_REFRESH']
+        self.rebuild_every = config['USER_FILTER_REBUILD']
+
+        app.before_first_request(self.load)
+        app.before_request(self.check_age)
+
+    # Building
+
+    def load(self):
+        """(Re)build the filter from the users table.
+
+        Sized for twice the current user count if that's over
+        USER_FILTER_CAPACITY, so the error rate holds as we grow.
+        """
+
+        with self.lock:
+            self.pending = []
+
+        try:
+            count = db.session.query(func.count(User.id)).scalar()
+            bloom = BloomFilter(max(self.capacity, 2 * count), self.error_rate)
+            max_id = 0
+
+            rows = (db.session
+                    .query(User.id, User.username, User.email)
+                    .yield_per(LOAD_BATCH))
+            for user_id, username, email in rows:
+                add_user(bloom, username, email)
+                max_id = max(max_id, user_id)
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+
+        with self.lock:
+            for username, email in self.pending:
+                add_user(bloom, username, email)
+
+            self.bloom = bloom
+            self.max_id = max(self.max_id, max_id)
+            self.pending = None
+            self.loaded_at = self.refreshed_at = monotonic()
+
+    def check_age(self):
+        """Rebuild in the background once the filter is USER_FILTER_REBUILD old."""
+
+        with self.lock:
+            if (self.rebuild_every is None
+                    or self.loaded_at is None
+                    or self.rebuilding
+                    or monotonic() - self.loaded_at < self.rebuild_every):
+                return
+            self.rebuilding = True
+
+        threading.Thread(target=self.rebuild,
+                         name='warbler-user-filter',
+                         daemon=True).start()
+
+    def rebuild(self):
+        try:
+            with self.app.app_context():
+                self.load()
+        finally:
+            self.rebuilding = False
+
+    def catch_up(self):
+        """Add users created since we last looked (by any worker).
+
+        Rate-limited to once per USER_FILTER_REFRESH seconds; returns
+        whether it ran.
+        """
+
+        with self.lock:
+            if monotonic() - self.refreshed_at < self.refresh_every:
+                return False
+            self.refreshed_at = monotonic()
+            max_id = self.max_id
+
+        rows = (db.session
+                .query(User.id, User.username, User.email)
+                .filter(User.id > max_id)
+                .all())
+
+        with self.lock:
+            for user_id, username, email in rows:
+                add_user(self.bloom, username, email)
+                self.max_id = max(self.max_id, user_id)
+
+        return True
+
+    # Lookups and updates
+
+    def might_exist(self, field, value):
+        """False only if no user has this `field` ('username' or 'email')."""
+
+        if self.bloom is None:
+            return True
+
+        key = f"{field}:{value}"
+
+        if key in self.bloom:
+            return True
+
+        return self.catch_up() and key in self.bloom
+
+    def add(self, username, email):
+        """Record a username/email pair written by this worker."""
+
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((username, email))
+            if self.bloom is not None:
+                add_user(self.bloom, username, email)
+
+
+def add_user(bloom, username, email):
+    bloom.add(f"username:{username}")
+    bloom.add(f"email:{email}")
+
+
+user_filter = UserFilter()
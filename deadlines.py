@@ -0,0 +1,113 @@
+"""Per-route SQL statement deadlines.
+
+A request to a route listed in QUERY_DEADLINES (endpoint -> milliseconds)
+runs its SQL with PostgreSQL's `statement_timeout` set to that many
+milliseconds; every other statement runs with QUERY_DEADLINE_DEFAULT (None
+for no limit). A statement that runs over is cancelled by the server and
+raises OperationalError, which `exceeded()` recognizes, so a view can
+answer with something cheaper instead of holding the worker for seconds.
+
+The timeout is set on the connection itself, and only when it differs from
+what that connection already has, so most statements cost no extra round
+trip. Every deadline hit is counted in /metrics as
+warbler_query_deadline_exceeded_total{route}.
+
+Other databases (SQLite in development) have no statement timeout, and
+the deadlines are simply not applied there.
+"""
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import Pool
+
+from metrics import metrics
+
+DEFAULT_DEADLINES = {
+    'homepage': 1500,
+    'api.timeline': 1500,
+}
+
+# PostgreSQL's SQLSTATE for "canceling statement due to statement timeout".
+QUERY_CANCELED = '57014'
+
+
+def exceeded(exc):
+    """True if `exc` is a statement cancelled by its deadline."""
+
+    return (isinstance(exc, OperationalError)
+            and getattr(exc.orig, 'pgcode', None) == QUERY_CANCELED)
+
+
+class QueryDeadlines:
+    """Flask extension setting statement_timeout per route."""
+
+    def __init__(self, app=None):
+        self.deadlines = {}
+        self.default = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('QUERY_DEADLINES', DEFAULT_DEADLINES)
+        config.setdefault('QUERY_DEADLINE_DEFAULT', None)
+
+        self.deadlines = dict(config['QUERY_DEADLINES'])
+        self.default = config['QUERY_DEADLINE_DEFAULT']
+
+        if not self.deadlines and self.default is None:
+            return
+
+        event.listen(Engine, 'before_cursor_execute', self.apply)
+        event.listen(Engine, 'handle_error', self.count)
+        # A rolled-back SET is undone, so forget what we set.
+        event.listen(Engine, 'rollback', self.forget)
+        event.listen(Pool, 'reset', self.forget_record)
+
+    def current(self):
+        """Milliseconds allowed per statement right now (None: no limit)."""
+
+        if has_request_context():
+            return self.deadlines.get(request.endpoint, self.default)
+
+        return self.default
+
+    def apply(self, conn, cursor, statement, parameters, context, executemany):
+        if conn.dialect.name != 'postgresql':
+            return
+
+        timeout = int(self.current() or 0)
+
+        if conn.info.get('statement_timeout', 0) != timeout:
+            # A cursor of our own: `cursor` may be a server-side one, which
+            # can only run the statement it was opened for.
+            setter = conn.connection.cursor()
+            try:
+                setter.execute(f"SET statement_timeout = {timeout}")
+            finally:
+                setter.close()
+            conn.info['statement_timeout'] = timeout
+
+    def forget(self, conn):
+        conn.info.pop('statement_timeout', None)
+
+    def forget_record(self, dbapi_connection, connection_record):
+        connection_record.info.pop('statement_timeout', None)
+
+    def count(self, context):
+        if getattr(context.original_exception, 'pgcode', None) != QUERY_CANCELED:
+            return
+
+        self.record_exceeded(request.endpoint if has_request_context()
+                             else None)
+
+    def record_exceeded(self, route):
+        metrics.increment('warbler_query_deadline_exceeded_total',
+                          'SQL statements cancelled by their route deadline.',
+                          route=route or 'none')
+
+
+query_deadlines = QueryDeadlines()
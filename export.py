@@ -0,0 +1,164 @@
+"""Streaming account export: everything a user has put into Warbler.
+
+An export is newline-delimited JSON, one record per line:
+
+    {"type": "user", "id": 1, "username": ..., ...}
+    {"type": "message", "id": ..., "text": ..., "timestamp": ...}
+    {"type": "like", "message_id": ..., "created_at": ...}
+    {"type": "following", "user_id": ..., "username": ...}
+    {"type": "follower", "user_id": ..., "username": ...}
+
+optionally gzipped. Each section is read through a server-side cursor in
+chunks of EXPORT_BATCH rows and written out as it arrives, so memory use is
+the same for an account with ten messages or ten million. With message
+shards (see shards.py), messages and likes are streamed from every shard at
+once and merged.
+
+Served at /users/export for the logged-in user, and from the command line:
+
+    FLASK_APP=app flask export-user 42 -o user42.ndjson.gz --gzip
+"""
+
+import heapq
+import json
+import re
+import zlib
+from contextlib import ExitStack
+from operator import attrgetter
+from urllib.parse import quote
+
+import click
+from flask.cli import with_appcontext
+
+from api import json_safe, to_json
+from models import db, User, Message, ArchivedMessage, Follows, Likes
+from shards import message_shards
+
+EXPORT_BATCH = 1000
+
+# Level 6 is gzip's default; wbits=31 writes a gzip (not zlib) header.
+GZIP_LEVEL = 6
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def content_disposition(filename):
+    """Content-Disposition header value for downloading as `filename`.
+
+    Usernames can hold quotes, semicolons and non-ASCII characters, so
+    the plain `filename` gets a safe ASCII stand-in, and the real name goes
+    in RFC 5987's `filename*` for clients that read it.
+    """
+
+    fallback = re.sub(r'[^A-Za-z0-9._-]', '_', filename)
+
+    return (f'attachment; filename="{fallback}"; '
+            f"filename*=UTF-8''{quote(filename, safe='')}")
+
+
+def stream(query, batch=EXPORT_BATCH):
+    """Iterate `query` through a server-side cursor, `batch` rows at a time."""
+
+    return query.execution_options(stream_results=True).yield_per(batch)
+
+
+def sharded_stream(make_query, key, batch=EXPORT_BATCH):
+    """stream() make_query(session) on every shard, merged in `key` order
+    (which each shard's query must already be in).
+    """
+
+    with ExitStack() as stack:
+        streams = [stream(make_query(stack.enter_context(
+                              message_shards.session(name))), batch)
+                   for name in message_shards.ring.names]
+
+        yield from heapq.merge(*streams, key=key)
+
+
+def records(user_id):
+    """Every export record for this user, as dicts, in file order."""
+
+    user = (db.session
+            .query(User.id, User.username, User.email, User.image_url,
+                   User.header_image_url, User.bio, User.location)
+            .filter(User.id == user_id)
+            .one())
+
+    yield dict(type='user', **user._asdict())
+
+    def messages(session, model=Message):
+        return (session
+                .query(model.id, model.text, model.timestamp)
+                .filter(model.user_id == user_id)
+                .order_by(model.id))
+
+    def likes(session):
+        # On the (user_id, created_at, id) index.
+        return (session
+                .query(Likes.message_id, Likes.created_at)
+                .filter(Likes.user_id == user_id)
+                .order_by(Likes.created_at, Likes.id))
+
+    if message_shards.enabled:
+        message_rows = sharded_stream(messages, attrgetter('id'))
+        like_rows = sharded_stream(likes, attrgetter('created_at'))
+    else:
+        # Archived messages first: they're all older (see archive.py).
+        message_rows = (row for model in (ArchivedMessage, Message)
+                        for row in stream(messages(db.session, model)))
+        like_rows = stream(likes(db.session))
+
+    for row in message_rows:
+        yield dict(type='message', **row._asdict())
+
+    for row in like_rows:
+        yield dict(type='like', **row._asdict())
+
+    edges = (
+        ('following', Follows.user_following_id, Follows.user_being_followed_id),
+        ('follower', Follows.user_being_followed_id, Follows.user_following_id),
+    )
+    for kind, own_column, other_column in edges:
+        rows = (db.session
+                .query(User.id.label('user_id'), User.username)
+                .join(Follows, other_column == User.id)
+                .filter(own_column == user_id)
+                .order_by(User.id))
+        for row in stream(rows):
+            yield dict(type=kind, **row._asdict())
+
+
+def ndjson(user_id):
+    """The export as NDJSON text, one line per record."""
+
+    for record in records(user_id):
+        safe = {key: json_safe(value) for key, value in record.items()}
+        yield json.dumps(safe, default=to_json) + '\n'
+
+
+def gzipped(chunks):
+    """Gzip a stream of text chunks, yielding compressed bytes as they fill."""
+
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+
+    yield compressor.flush()
+
+
+@click.command('export-user')
+@click.argument('user_id', type=int)
+@click.option('-o', '--output', type=click.File('wb'), default='-',
+              help="File to write (default: stdout).")
+@click.option('--gzip', 'use_gzip', is_flag=True, help="Gzip the output.")
+@with_appcontext
+def export_user_command(user_id, output, use_gzip):
+    """Write USER_ID's account export as NDJSON."""
+
+    chunks = ndjson(user_id)
+    chunks = gzipped(chunks) if use_gzip else (c.encode() for c in chunks)
+
+    for chunk in chunks:
+        output.write(chunk)
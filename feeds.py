@@ -0,0 +1,530 @@
+"""Read-model queries for Warbler's feed pages.
+
+The timeline, profile, likes and follow pages only need a handful of columns
+to render each card. Loading full `User`/`Message` instances for them pulls
+every column (including password hashes), registers each row in the session's
+identity map and sets up change tracking we never use.
+
+The functions here select just the columns a card needs and return them as
+namedtuples, which are plain `__slots__` objects: cheap to build, cheap to
+hold, and invisible to the session.
+"""
+
+import heapq
+from collections import namedtuple
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from operator import itemgetter
+
+from sqlalchemy import case, func, tuple_
+
+from follow_graph import follow_graph
+from likes import like_buffer
+from models import db, User, Message, ArchivedMessage, Follows, Likes, \
+    MessageTag, MessageMention
+from shards import message_shards
+from snowflake import datetime_of, id_for_datetime
+
+MessageRow = namedtuple(
+    'MessageRow',
+    ['id', 'text', 'timestamp', 'user_id', 'username', 'image_url'])
+
+UserRow = namedtuple(
+    'UserRow',
+    ['id', 'username', 'image_url', 'header_image_url', 'bio'])
+
+UserStats = namedtuple(
+    'UserStats',
+    ['messages', 'following', 'followers', 'likes'])
+
+LikeState = namedtuple('LikeState', ['count', 'liked'])
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+PAGE_SIZE = 50
+
+# How far back the first, partition-pruned query of a page looks.
+RECENT_WINDOW = timedelta(days=30)
+
+NOT_LIKED = LikeState(0, False)
+
+
+def message_columns(model):
+    """MessageRow's columns, from Message or ArchivedMessage."""
+
+    return (model.id,
+            model.text,
+            model.timestamp,
+            model.user_id,
+            User.username,
+            User.image_url)
+
+
+MESSAGE_COLUMNS = message_columns(Message)
+
+USER_COLUMNS = (User.id,
+                User.username,
+                User.image_url,
+                User.header_image_url,
+                User.bio)
+
+
+def message_query(model=Message):
+    """Base query for message cards: message columns joined to author."""
+
+    return (db.session
+            .query(*message_columns(model))
+            .join(User, model.user_id == User.id))
+
+
+def message_ranges(before_id=None):
+    """(model, after_id, before_id) ranges a newest-first page reads, in order.
+
+    First the RECENT_WINDOW before the page starts, bounded below so that
+    on a partitioned messages table (see partitions.py) the planner only
+    visits the newest partitions; then the rest of the hot table; then the
+    archive, whose ids are all older (see archive.py). Either bound may be
+    None.
+    """
+
+    start = datetime_of(before_id) if before_id else datetime.utcnow()
+    floor = id_for_datetime(start - RECENT_WINDOW)
+
+    return [(Message, floor, before_id),
+            (Message, None, floor),
+            (ArchivedMessage, None, before_id)]
+
+
+def id_range(rows, column, after_id, before_id):
+    """`rows` filtered to after_id <= column < before_id."""
+
+    if after_id:
+        rows = rows.filter(column >= after_id)
+    if before_id:
+        rows = rows.filter(column < before_id)
+
+    return rows
+
+
+def timeline_messages(user_ids, limit=100, before=None):
+    """Most recent messages written by any of `user_ids`.
+
+    Message ids are time-ordered, so newest-first is just id order and
+    `before` (from `message_cursor()`) is the last id of the previous page.
+    A page that runs short in one of the `message_ranges()` continues into
+    the next.
+    """
+
+    if message_shards.enabled:
+        return sharded_timeline(user_ids, limit, decode_message_cursor(before))
+
+    messages = []
+
+    for model, after_id, before_id in message_ranges(
+            decode_message_cursor(before)):
+        rows = id_range(message_query(model)
+                        .filter(model.user_id.in_(user_ids))
+                        .order_by(model.id.desc()),
+                        model.id, after_id, before_id)
+
+        messages += [MessageRow._make(row)
+                     for row in rows.limit(limit - len(messages))]
+        if len(messages) == limit:
+            break
+
+    return messages
+
+
+def sharded_timeline(user_ids, limit, before_id):
+    """timeline_messages() from message shards (see shards.py).
+
+    Each shard holding any of these authors returns its newest `limit`; the
+    (already newest-first) results are merged and cut to `limit`, and
+    their authors' names and avatars come from the main database.
+    """
+
+    def newest(author_ids):
+        def query(session):
+            rows = (session
+                    .query(Message.id, Message.text, Message.timestamp,
+                           Message.user_id)
+                    .filter(Message.user_id.in_(author_ids))
+                    .order_by(Message.id.desc()))
+            if before_id:
+                rows = rows.filter(Message.id < before_id)
+
+            return rows.limit(limit).all()
+
+        return query
+
+    results = message_shards.scatter(
+        {name: newest(author_ids)
+         for name, author_ids in message_shards.by_author(user_ids).items()})
+
+    return with_authors(islice(heapq.merge(*results.values(),
+                                           key=itemgetter(0), reverse=True),
+                               limit))
+
+
+def with_authors(rows):
+    """MessageRows for shard rows of (id, text, timestamp, user_id).
+
+    Authors' names and avatars come from the main database, in one query;
+    rows whose author is gone are dropped.
+    """
+
+    rows = list(rows)
+    if not rows:
+        return []
+
+    authors = {author.id: author
+               for author in (db.session
+                              .query(User.id, User.username, User.image_url)
+                              .filter(User.id.in_({row[3] for row in rows})))}
+
+    return [MessageRow(*row[:4],
+                       authors[row[3]].username,
+                       authors[row[3]].image_url)
+            for row in rows if row[3] in authors]
+
+
+def user_messages(user_id, limit=100, before=None):
+    """Most recent messages written by this user."""
+
+    return timeline_messages([user_id], limit=limit, before=before)
+
+
+def message_cursor(messages, limit):
+    """Cursor for the page after `messages`, or None if that was the last."""
+
+    if len(messages) < limit:
+        return None
+
+    return str(messages[-1].id)
+
+
+def decode_message_cursor(cursor):
+    """Message id from a `message_cursor()`; None if missing or garbled."""
+
+    try:
+        return int(cursor)
+    except (TypeError, ValueError):
+        return None
+
+
+def indexed_messages(index_column, value, before=None, limit=PAGE_SIZE):
+    """A page of messages from a tags.py index, newest first.
+
+    Walks the index's (value, message_id) primary key, so a page costs the
+    same however many messages carry the tag or mention.
+    """
+
+    if message_shards.enabled:
+        return sharded_indexed_messages(index_column, value,
+                                        decode_message_cursor(before), limit)
+
+    table = index_column.table
+    messages = []
+
+    # Like timeline_messages(). The range is applied to both sides of the
+    # join: the index's, to seek in it, and the message's, for pruning.
+    for model, after_id, before_id in message_ranges(
+            decode_message_cursor(before)):
+        rows = (message_query(model)
+                .join(table, table.c.message_id == model.id)
+                .filter(index_column == value)
+                .order_by(table.c.message_id.desc()))
+        rows = id_range(rows, table.c.message_id, after_id, before_id)
+        rows = id_range(rows, model.id, after_id, before_id)
+
+        messages += [MessageRow._make(row)
+                     for row in rows.limit(limit - len(messages))]
+        if len(messages) == limit:
+            break
+
+    return Page(messages, message_cursor(messages, limit))
+
+
+def sharded_indexed_messages(index_column, value, before_id, limit):
+    """indexed_messages() when the messages are on shards (see shards.py).
+
+    The index is on the main database: a page of its message ids is read
+    there, and those messages are fetched from the shards.
+    """
+
+    table = index_column.table
+    ids = (db.session
+           .query(table.c.message_id)
+           .filter(index_column == value)
+           .order_by(table.c.message_id.desc()))
+    if before_id:
+        ids = ids.filter(table.c.message_id < before_id)
+    ids = [message_id for (message_id,) in ids.limit(limit)]
+
+    rows = sorted(message_shards.messages(ids, Message.id, Message.text,
+                                          Message.timestamp, Message.user_id),
+                  key=itemgetter(0), reverse=True)
+
+    # The cursor follows the index, even if a message has gone missing.
+    return Page(with_authors(rows),
+                str(ids[-1]) if len(ids) == limit else None)
+
+
+def tag_messages(tag, before=None, limit=PAGE_SIZE):
+    """A page of messages with this hashtag (lowercase, no '#')."""
+
+    return indexed_messages(MessageTag.tag, tag, before, limit)
+
+
+def mention_messages(user_id, before=None, limit=PAGE_SIZE):
+    """A page of messages that @mention this user."""
+
+    return indexed_messages(MessageMention.user_id, user_id, before, limit)
+
+
+def liked_messages(user_id, before=None, limit=PAGE_SIZE):
+    """A page of messages this user has liked, most recently liked first.
+
+    `before` is the `next_cursor` of the previous page. Seeks on the
+    (user_id, created_at, id) index, so deep pages cost the same as the first.
+    Each liked message is looked up in both the hot table and the archive.
+    """
+
+    if message_shards.enabled:
+        return sharded_liked_messages(user_id, decode_cursor(before), limit)
+
+    def either(column):
+        return func.coalesce(getattr(Message, column),
+                             getattr(ArchivedMessage, column))
+
+    rows = (db.session
+            .query(Likes.message_id,
+                   either('text'),
+                   either('timestamp'),
+                   User.id,
+                   User.username,
+                   User.image_url,
+                   Likes.created_at,
+                   Likes.id)
+            .select_from(Likes)
+            .outerjoin(Message, Likes.message_id == Message.id)
+            .outerjoin(ArchivedMessage, Likes.message_id == ArchivedMessage.id)
+            .join(User, either('user_id') == User.id)
+            .filter(Likes.user_id == user_id)
+            .order_by(Likes.created_at.desc(), Likes.id.desc()))
+
+    position = decode_cursor(before)
+    if position:
+        rows = rows.filter(tuple_(Likes.created_at, Likes.id) < position)
+
+    rows = rows.limit(limit + 1).all()
+    next_cursor = encode_cursor(*rows[limit - 1][-2:]) if len(rows) > limit else None
+
+    return Page([MessageRow._make(row[:-2]) for row in rows[:limit]],
+                next_cursor)
+
+
+def sharded_liked_messages(user_id, position, limit):
+    """liked_messages() from message shards (see shards.py).
+
+    This user's likes are on the shards of the messages they liked: each
+    shard returns its most recent `limit` + 1, and those are merged.
+    """
+
+    def newest(session):
+        rows = (session
+                .query(Message.id, Message.text, Message.timestamp,
+                       Message.user_id, Likes.created_at, Likes.id)
+                .join(Likes, Likes.message_id == Message.id)
+                .filter(Likes.user_id == user_id)
+                .order_by(Likes.created_at.desc(), Likes.id.desc()))
+        if position:
+            rows = rows.filter(tuple_(Likes.created_at, Likes.id) < position)
+
+        return rows.limit(limit + 1).all()
+
+    rows = list(islice(heapq.merge(*message_shards.everywhere(newest).values(),
+                                   key=itemgetter(4, 5), reverse=True),
+                       limit + 1))
+    next_cursor = encode_cursor(*rows[limit - 1][-2:]) if len(rows) > limit else None
+
+    return Page(with_authors(rows[:limit]), next_cursor)
+
+
+def encode_cursor(timestamp, row_id):
+    """Opaque-enough cursor for keyset pagination on (timestamp, id)."""
+
+    return f"{timestamp.isoformat()}~{row_id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, id); None if missing or garbled."""
+
+    try:
+        timestamp, row_id = cursor.split('~')
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def user_page(rows, after=None, limit=None):
+    """Order user rows by username, starting after `after` (a username)."""
+
+    rows = rows.order_by(User.username)
+
+    if after:
+        rows = rows.filter(User.username > after)
+    if limit:
+        rows = rows.limit(limit)
+
+    return [UserRow._make(row) for row in rows]
+
+
+def following(user_id, after=None, limit=None):
+    """Users this user is following."""
+
+    rows = (db.session
+            .query(*USER_COLUMNS)
+            .join(Follows, Follows.user_being_followed_id == User.id)
+            .filter(Follows.user_following_id == user_id))
+
+    return user_page(rows, after, limit)
+
+
+def followers(user_id, after=None, limit=None):
+    """Users following this user."""
+
+    rows = (db.session
+            .query(*USER_COLUMNS)
+            .join(Follows, Follows.user_following_id == User.id)
+            .filter(Follows.user_being_followed_id == user_id))
+
+    return user_page(rows, after, limit)
+
+
+def search_users(search=None):
+    """All users, or those whose username contains `search`."""
+
+    rows = db.session.query(*USER_COLUMNS).order_by(User.username)
+
+    if search:
+        rows = rows.filter(User.username.like(f"%{search}%"))
+
+    return [UserRow._make(row) for row in rows]
+
+
+def following_ids(user_id):
+    """Set of ids this user is following."""
+
+    if follow_graph.ready:
+        return follow_graph.following_ids(user_id)
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id))
+
+    return {followed_id for (followed_id,) in rows}
+
+
+def user_stats(user_id):
+    """Message/following/follower/like counts for the profile header.
+
+    One round trip of scalar subqueries, instead of loading each whole
+    relationship just to take its length. Follow counts come from the
+    in-memory follow graph when it's loaded.
+    """
+
+    def count(column, match):
+        return (db.session
+                .query(func.count())
+                .select_from(column.table)
+                .filter(column == match)
+                .as_scalar())
+
+    if message_shards.enabled:
+        messages, likes = sharded_counts(user_id)
+        following, followers = (follow_graph.counts(user_id)
+                                if follow_graph.ready else
+                                db.session.query(
+                                    count(Follows.user_following_id, user_id),
+                                    count(Follows.user_being_followed_id,
+                                          user_id),
+                                ).one())
+        return UserStats(messages, following, followers, likes)
+
+    # Archived messages are still theirs.
+    message_count = (count(Message.user_id, user_id)
+                     + count(ArchivedMessage.user_id, user_id))
+
+    if follow_graph.ready:
+        messages, likes = db.session.query(
+            message_count,
+            count(Likes.user_id, user_id),
+        ).one()
+        return UserStats(messages, *follow_graph.counts(user_id), likes)
+
+    row = db.session.query(
+        message_count,
+        count(Follows.user_following_id, user_id),
+        count(Follows.user_being_followed_id, user_id),
+        count(Likes.user_id, user_id),
+    ).one()
+
+    return UserStats._make(row)
+
+
+def sharded_counts(user_id):
+    """(messages written, messages liked) by this user, from the shards.
+
+    Their messages are on their shard (or, mid-rebalance, partly on their
+    old one); their likes are wherever the messages they liked are.
+    """
+
+    def counts(session):
+        def count(column):
+            return (session
+                    .query(func.count())
+                    .select_from(column.table)
+                    .filter(column == user_id)
+                    .as_scalar())
+
+        return session.query(count(Message.user_id), count(Likes.user_id)).one()
+
+    results = message_shards.everywhere(counts).values()
+
+    return (sum(messages for messages, _ in results),
+            sum(likes for _, likes in results))
+
+
+def like_states(message_ids, viewer_id=None):
+    """Like count and "liked by viewer" flag for a page of messages.
+
+    Returns {message_id: LikeState} with an entry for every id asked about,
+    answered by a single grouped query however long the page is. The
+    viewer's own likes still waiting in the like buffer are included.
+    """
+
+    states = dict.fromkeys(message_ids, NOT_LIKED)
+
+    if not states:
+        return states
+
+    liked_by_viewer = func.max(case([(Likes.user_id == viewer_id, 1)], else_=0))
+
+    def grouped(session):
+        return (session
+                .query(Likes.message_id, func.count(), liked_by_viewer)
+                .filter(Likes.message_id.in_(list(states)))
+                .group_by(Likes.message_id)
+                .all())
+
+    if message_shards.enabled:
+        # Each message's likes are all on its shard.
+        rows = chain.from_iterable(message_shards.everywhere(grouped).values())
+    else:
+        rows = grouped(db.session)
+
+    for message_id, count, liked in rows:
+        states[message_id] = LikeState(count, bool(liked))
+
+    return like_buffer.overlay(states, viewer_id)
@@ -0,0 +1,284 @@
+"""In-memory follow graph: who follows whom, without asking the database.
+
+Nearly every page needs the viewer's following ids (Follow/Unfollow buttons,
+the home timeline) and most show following/follower counts. With
+FOLLOW_GRAPH_ENABLED, each worker loads the whole `follows` table at startup
+into two adjacency maps:
+
+    following[user_id] -> sorted array('i') of the ids they follow
+    followers[user_id] -> sorted array('i') of the ids following them
+
+An array of 32-bit ints costs 4 bytes per id, so an edge costs 8 bytes plus
+the per-user array and dict overhead (see `memory_usage()`). Membership is a
+binary search, counts are `len()` and neighbor pages are slices.
+
+Writes made through this worker (add_follow, stop_following, delete_user)
+update the maps as they happen. Arrays are replaced, never changed in place,
+so readers don't need the lock. Other workers' writes show up at the next
+reload, every FOLLOW_GRAPH_RELOAD seconds, on a background thread.
+"""
+
+import os
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from time import monotonic
+
+from models import db, Follows
+
+MemoryUsage = namedtuple('MemoryUsage',
+                         ['edges', 'bytes', 'bytes_per_million_edges'])
+
+LOAD_BATCH = 10000
+
+EMPTY = array('i')
+
+
+def contains(ids, item):
+    """Is `item` in the sorted array `ids`?"""
+
+    i = bisect_left(ids, item)
+    return i < len(ids) and ids[i] == item
+
+
+def with_id(ids, item):
+    """Copy of sorted `ids` with `item` added (`ids` itself if present)."""
+
+    i = bisect_left(ids, item)
+    if i < len(ids) and ids[i] == item:
+        return ids
+
+    return ids[:i] + array('i', (item,)) + ids[i:]
+
+
+def without_id(ids, item):
+    """Copy of sorted `ids` with `item` removed (`ids` itself if absent)."""
+
+    i = bisect_left(ids, item)
+    if i < len(ids) and ids[i] == item:
+        return ids[:i] + ids[i + 1:]
+
+    return ids
+
+
+def adjacency(pairs):
+    """{a: sorted array of b} from (a, b) pairs already sorted by (a, b)."""
+
+    result = {}
+    current = None
+
+    for a, b in pairs:
+        if a != current:
+            current = a
+            ids = result[a] = array('i')
+        ids.append(b)
+
+    return result
+
+
+class FollowGraph:
+    """Flask extension holding the follows table as sorted id arrays."""
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.following = {}
+        self.followers = {}
+        self.ready = False
+        self.loaded_at = None
+        self.reloading = False
+        self.reload_every = None
+        self.pending = None
+        self.app = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('FOLLOW_GRAPH_ENABLED',
+                          os.environ.get('FOLLOW_GRAPH_ENABLED') == '1')
+        config.setdefault('FOLLOW_GRAPH_RELOAD', 300)
+
+        if not config['FOLLOW_GRAPH_ENABLED']:
+            return
+
+        self.app = app
+        self.reload_every = config['FOLLOW_GRAPH_RELOAD']
+
+        app.before_first_request(self.load)
+        app.before_request(self.check_age)
+
+    # Loading
+
+    def edges(self, source, target):
+        """Stream (source, target) id pairs from follows, sorted."""
+
+        return (db.session
+                .query(source, target)
+                .order_by(source, target)
+                .yield_per(LOAD_BATCH))
+
+    def load(self):
+        """(Re)build both maps from the follows table.
+
+        Writes seen while the table is being read are replayed on top, so
+        a follow made mid-load isn't lost until the next reload.
+        """
+
+        with self.lock:
+            self.pending = []
+
+        try:
+            following = adjacency(self.edges(Follows.user_following_id,
+                                             Follows.user_being_followed_id))
+            followers = adjacency(self.edges(Follows.user_being_followed_id,
+                                             Follows.user_following_id))
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+
+        self.replace(following, followers)
+
+    def replace(self, following, followers):
+        """Swap in freshly built maps (see `adjacency()`)."""
+
+        with self.lock:
+            self.following = following
+            self.followers = followers
+
+            for apply, args in self.pending or ():
+                apply(*args)
+
+            self.pending = None
+            self.loaded_at = monotonic()
+            self.ready = True
+
+    def check_age(self):
+        """Reload in the background once the maps are FOLLOW_GRAPH_RELOAD old."""
+
+        with self.lock:
+            if (self.reload_every is None
+                    or self.loaded_at is None
+                    or self.reloading
+                    or monotonic() - self.loaded_at < self.reload_every):
+                return
+            self.reloading = True
+
+        threading.Thread(target=self.reload,
+                         name='warbler-follow-graph',
+                         daemon=True).start()
+
+    def reload(self):
+        try:
+            with self.app.app_context():
+                self.load()
+        finally:
+            self.reloading = False
+
+    # Reads
+
+    def is_following(self, user_id, other_id):
+        """Does `user_id` follow `other_id`?"""
+
+        return contains(self.following.get(user_id, EMPTY), other_id)
+
+    def following_ids(self, user_id):
+        """Set of ids this user is following."""
+
+        return set(self.following.get(user_id, EMPTY))
+
+    def follower_ids(self, user_id):
+        """Set of ids following this user."""
+
+        return set(self.followers.get(user_id, EMPTY))
+
+    def counts(self, user_id):
+        """(following, followers) counts for this user."""
+
+        return (len(self.following.get(user_id, EMPTY)),
+                len(self.followers.get(user_id, EMPTY)))
+
+    def following_page(self, user_id, after=None, limit=50):
+        """Up to `limit` ids this user follows, in id order, after `after`."""
+
+        return self.page(self.following.get(user_id, EMPTY), after, limit)
+
+    def followers_page(self, user_id, after=None, limit=50):
+        """Up to `limit` ids following this user, in id order, after `after`."""
+
+        return self.page(self.followers.get(user_id, EMPTY), after, limit)
+
+    def page(self, ids, after, limit):
+        start = bisect_right(ids, after) if after is not None else 0
+        return ids[start:start + limit].tolist()
+
+    # Writes
+
+    def add(self, user_id, followed_id):
+        """Record that `user_id` now follows `followed_id`."""
+
+        self.write(self._add, user_id, followed_id)
+
+    def remove(self, user_id, followed_id):
+        """Record that `user_id` no longer follows `followed_id`."""
+
+        self.write(self._remove, user_id, followed_id)
+
+    def remove_user(self, user_id):
+        """Drop a deleted user and every edge touching them."""
+
+        self.write(self._remove_user, user_id)
+
+    def write(self, apply, *args):
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append((apply, args))
+            if self.ready:
+                apply(*args)
+
+    def _add(self, user_id, followed_id):
+        self.following[user_id] = with_id(
+            self.following.get(user_id, EMPTY), followed_id)
+        self.followers[followed_id] = with_id(
+            self.followers.get(followed_id, EMPTY), user_id)
+
+    def _remove(self, user_id, followed_id):
+        self.discard(self.following, user_id, followed_id)
+        self.discard(self.followers, followed_id, user_id)
+
+    def _remove_user(self, user_id):
+        for followed_id in self.following.pop(user_id, EMPTY):
+            self.discard(self.followers, followed_id, user_id)
+        for follower_id in self.followers.pop(user_id, EMPTY):
+            self.discard(self.following, follower_id, user_id)
+
+    def discard(self, adjacency_map, key, item):
+        ids = without_id(adjacency_map.get(key, EMPTY), item)
+
+        if ids:
+            adjacency_map[key] = ids
+        else:
+            adjacency_map.pop(key, None)
+
+    # Reporting
+
+    def memory_usage(self):
+        """Edges held and bytes used by both maps (dicts, keys and arrays)."""
+
+        with self.lock:
+            maps = (self.following, self.followers)
+            edges = sum(len(ids) for ids in self.following.values())
+            size = sum(sys.getsizeof(adjacency_map)
+                       + sum(sys.getsizeof(key) + sys.getsizeof(ids)
+                             for key, ids in adjacency_map.items())
+                       for adjacency_map in maps)
+
+        per_million = round(size * 1_000_000 / edges) if edges else 0
+
+        return MemoryUsage(edges, size, per_million)
+
+
+follow_graph = FollowGraph()
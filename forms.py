@@ -1,11 +1,14 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
+IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp']
+
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
 
-    text = TextAreaField('text', validators=[DataRequired()])
+    text = TextAreaField('text', validators=[DataRequired(), Length(max=140)])
 
 
 class UserAddForm(FlaskForm):
@@ -15,11 +18,15 @@ class UserAddForm(FlaskForm):
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
+    image_file = FileField('(Optional) Upload Image',
+                           validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')])
 
 class UserEditForm(UserAddForm):
     """Form for editing user profile"""
 
     header_image_url = StringField('(Optional) Header Image URL')
+    header_image_file = FileField('(Optional) Upload Header Image',
+                                  validators=[FileAllowed(IMAGE_EXTENSIONS, 'Images only!')])
     bio = StringField('(Optional) Bio')
 
 
@@ -0,0 +1,372 @@
+"""Hot user and message rows, shared by every worker on the host.
+
+Every request loads the logged-in user's row for `g.user`, and profile
+and message pages load one more user or message by id. Caching those in
+each worker's memory would keep a copy per worker and warm each one
+separately, so with HOT_CACHE_ENABLED they go in one memory-mapped file
+that all workers map: HOT_CACHE_PATH, by default `hot-cache` in the app's
+instance folder (a tmpfs such as /dev/shm is faster, in a directory only
+we can write to). The file must be a regular file owned by us with mode 0600, or
+it isn't used: anyone who can write it decides what every worker reads.
+
+The file is a fixed-size table: HOT_CACHE_SETS sets of WAYS slots of
+HOT_CACHE_SLOT_BYTES each. A key hashes to one set; within it, a new entry
+replaces the same key, an empty slot, or the least recently used one.
+Rows are column values stored as JSON (never pickle, which would run
+whatever code the file held), so a hit costs no query, and is turned
+back into a User (attached to the session, as `g.user` must be) or a
+detached Message. Rows too big for a slot just aren't cached.
+
+Invalidation is by version, as in page_cache.py, except the versions are
+shared too: a counter per key (keys may share one, which only costs the
+odd extra miss) kept in the file. `hot_cache.invalidate('user:5')` from
+any worker bumps it, and entries stored under the old version are never
+served again. A miss reads the version before loading the row, so a write
+that lands in between leaves the entry already stale. Entries also expire
+after HOT_CACHE_TTL seconds, bounding anything written behind our back.
+
+Workers on one host coordinate with fcntl locks on the file's byte ranges,
+one per set and one per counter. Hits and misses are counted in /metrics as
+warbler_hot_cache_requests_total{result}.
+"""
+
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import stat
+import struct
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from time import time
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+import archive
+from metrics import metrics
+from models import db, User, Message, ArchivedMessage
+
+WAYS = 4
+COUNTERS = 4096
+
+MAGIC = b'WRBLHOT1'
+HEADER = struct.Struct('<8sIII')  # magic, counters, sets, slot bytes
+SLOT = struct.Struct('<QQddI')    # key hash, version, stored at, used at, length
+COUNTER = struct.Struct('<Q')
+
+MODELS = {model.__name__: model for model in (User, Message, ArchivedMessage)}
+
+
+def encode(key, value):
+    """JSON bytes of (key, value); datetimes are tagged ISO strings."""
+
+    def tag(obj):
+        if isinstance(obj, datetime):
+            return {'$datetime': obj.isoformat()}
+        raise TypeError(f"Can't cache {type(obj).__name__}")
+
+    return json.dumps([key, value], default=tag,
+                      separators=(',', ':')).encode()
+
+
+def decode(payload):
+    """(key, value) from encode()'s bytes."""
+
+    def untag(obj):
+        if obj.keys() == {'$datetime'}:
+            return datetime.fromisoformat(obj['$datetime'])
+        return obj
+
+    key, value = json.loads(payload.decode(), object_hook=untag)
+
+    return key, value
+
+
+def key_hash(key):
+    """64-bit hash of a cache key; never 0, which marks an empty slot."""
+
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') | 1
+
+
+class SharedStore:
+    """Versioned LRU key/value table in a memory-mapped file."""
+
+    def __init__(self, path, sets, slot_bytes, ttl, counters=COUNTERS):
+        self.path = path
+        self.sets = sets
+        self.slot_bytes = slot_bytes
+        self.ttl = ttl
+        self.counters = counters
+        self.counters_at = HEADER.size
+        self.slots_at = self.counters_at + counters * COUNTER.size
+        self.size = self.slots_at + sets * WAYS * slot_bytes
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def open(self):
+        """Map the file, (re)creating it if its layout doesn't match ours.
+
+        Refuses (RuntimeError) a symlink, or a file that isn't ours alone.
+        """
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+
+        info = os.fstat(fd)
+        if (not stat.S_ISREG(info.st_mode)
+                or info.st_uid != os.getuid()
+                or stat.S_IMODE(info.st_mode) != 0o600):
+            os.close(fd)
+            raise RuntimeError(f"{self.path} must be a regular file owned by "
+                               f"this user with mode 0600")
+
+        header = HEADER.pack(MAGIC, self.counters, self.sets, self.slot_bytes)
+
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if (os.fstat(fd).st_size != self.size
+                    or os.pread(fd, HEADER.size, 0) != header):
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+                os.pwrite(fd, header, 0)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+
+        self.fd = fd
+        self.map = mmap.mmap(fd, self.size)
+        self.pid = os.getpid()
+
+    @contextmanager
+    def locked(self, offset, length):
+        """Hold this byte range against other threads and processes."""
+
+        # Opened lazily, so each forked worker has its own descriptor.
+        if self.pid != os.getpid():
+            self.open()
+
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+
+    def counter_at(self, hashed):
+        return self.counters_at + hashed % self.counters * COUNTER.size
+
+    def set_at(self, hashed):
+        return self.slots_at + hashed % self.sets * WAYS * self.slot_bytes
+
+    # Versions
+
+    def version(self, key):
+        """Current version of `key`; pass it to set() after loading."""
+
+        at = self.counter_at(key_hash(key))
+        with self.locked(at, COUNTER.size):
+            return COUNTER.unpack_from(self.map, at)[0]
+
+    def invalidate(self, key):
+        at = self.counter_at(key_hash(key))
+        with self.locked(at, COUNTER.size):
+            (version,) = COUNTER.unpack_from(self.map, at)
+            COUNTER.pack_into(self.map, at, version + 1)
+
+    # Entries
+
+    def get(self, key):
+        """The value stored for `key`, or None if missing, stale or expired."""
+
+        hashed = key_hash(key)
+        base = self.set_at(hashed)
+        version = self.version(key)
+
+        with self.locked(base, WAYS * self.slot_bytes):
+            for way in range(WAYS):
+                at = base + way * self.slot_bytes
+                stored_hash, stored_version, stored_at, _, length = \
+                    SLOT.unpack_from(self.map, at)
+
+                if stored_hash != hashed or not length:
+                    continue
+                if stored_version != version or time() - stored_at > self.ttl:
+                    return None
+
+                payload = self.map[at + SLOT.size:at + SLOT.size + length]
+                SLOT.pack_into(self.map, at, stored_hash, stored_version,
+                               stored_at, time(), length)
+                break
+            else:
+                return None
+
+        stored_key, value = decode(payload)
+        return value if stored_key == key else None
+
+    def set(self, key, value, version):
+        """Store `value`, as of `version`. Returns False if it's too big."""
+
+        payload = encode(key, value)
+        if SLOT.size + len(payload) > self.slot_bytes:
+            return False
+
+        hashed = key_hash(key)
+        base = self.set_at(hashed)
+
+        with self.locked(base, WAYS * self.slot_bytes):
+            slots = [SLOT.unpack_from(self.map, base + way * self.slot_bytes)
+                     for way in range(WAYS)]
+            # This key's old slot, else an empty one, else the LRU one.
+            way = min(range(WAYS), key=lambda way: (slots[way][0] != hashed,
+                                                    slots[way][4] != 0,
+                                                    slots[way][3]))
+
+            at = base + way * self.slot_bytes
+            now = time()
+            self.map[at + SLOT.size:at + SLOT.size + len(payload)] = payload
+            SLOT.pack_into(self.map, at, hashed, version, now, now,
+                           len(payload))
+
+        return True
+
+
+def cached_columns(model):
+    """The attributes row_of() keeps for instances of `model`."""
+
+    return [getattr(model, attribute.key)
+            for attribute in inspect(model).column_attrs]
+
+
+def row_of(instance):
+    """(model name, {column: value}) of a loaded User or message."""
+
+    columns = {attribute.key: getattr(instance, attribute.key)
+               for attribute in inspect(instance).mapper.column_attrs}
+
+    return type(instance).__name__, columns
+
+
+def from_row(row):
+    """A detached instance with the columns of a row_of()."""
+
+    model, columns = row
+    instance = MODELS[model](**columns)
+    make_transient_to_detached(instance)
+
+    return instance
+
+
+class HotCache:
+    """Flask extension caching hot user and message rows across workers."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.store = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('HOT_CACHE_ENABLED',
+                          os.environ.get('HOT_CACHE_ENABLED') == '1')
+        config.setdefault('HOT_CACHE_PATH',
+                          os.environ.get('HOT_CACHE_PATH',
+                                         os.path.join(app.instance_path,
+                                                      'hot-cache')))
+        config.setdefault('HOT_CACHE_SETS', 4096)
+        config.setdefault('HOT_CACHE_SLOT_BYTES', 1024)
+        config.setdefault('HOT_CACHE_TTL', 300)
+
+        if not config['HOT_CACHE_ENABLED']:
+            return
+
+        os.makedirs(os.path.dirname(config['HOT_CACHE_PATH']), 0o700,
+                    exist_ok=True)
+        self.store = SharedStore(config['HOT_CACHE_PATH'],
+                                 config['HOT_CACHE_SETS'],
+                                 config['HOT_CACHE_SLOT_BYTES'],
+                                 config['HOT_CACHE_TTL'])
+        self.enabled = True
+
+    def fetch(self, key, load):
+        """Cached row for `key`, or load() it (a row, or None) and cache it."""
+
+        row, version = self.lookup(key)
+        if row is None:
+            row = load()
+            self.save(key, row, version)
+
+        return row
+
+    def lookup(self, key):
+        """(row, None) on a hit; (None, version to save() under) on a miss.
+
+        For callers that load rows themselves, like the ASGI app.
+        """
+
+        row = self.store.get(key)
+        metrics.increment('warbler_hot_cache_requests_total',
+                          'Hot cache lookups, by result.',
+                          result='hit' if row is not None else 'miss')
+        if row is not None:
+            return row, None
+
+        return None, self.store.version(key)
+
+    def save(self, key, row, version):
+        if row is not None:
+            self.store.set(key, row, version)
+
+    def invalidate(self, *keys):
+        """Make every worker reload these ('user:5', 'message:9')."""
+
+        if not self.enabled:
+            return
+
+        for key in keys:
+            self.store.invalidate(key)
+
+    # Rows
+
+    def user(self, user_id):
+        """User with this id, attached to the session; None if none."""
+
+        if not self.enabled:
+            return User.query.get(user_id)
+
+        def load():
+            user = User.query.get(user_id)
+            return row_of(user) if user is not None else None
+
+        row = self.fetch(f"user:{user_id}", load)
+        if row is None:
+            return None
+
+        # No query: the row is taken to be what the database has.
+        return db.session.merge(from_row(row), load=False)
+
+    def message(self, message_id):
+        """archive.find(message_id), its `user` loaded; detached if cached."""
+
+        if not self.enabled:
+            return archive.find(message_id)
+
+        def load():
+            msg = archive.find(message_id)
+            return row_of(msg) if msg is not None else None
+
+        row = self.fetch(f"message:{message_id}", load)
+        if row is None:
+            return None
+
+        msg = from_row(row)
+        set_committed_value(msg, 'user', self.user(msg.user_id))
+
+        return msg
+
+
+hot_cache = HotCache()
@@ -0,0 +1,142 @@
+"""Image uploads and thumbnail cache for Warbler.
+
+Uploaded avatars and header images are stored in a content-addressed cache
+on disk: the SHA-256 of the uploaded bytes names a directory holding one
+pre-resized JPEG per variant in THUMBNAIL_SIZES. Identical uploads hash to
+the same directory, so they're only resized (and stored) once.
+
+The URL saved on the user points at the largest variant; templates ask for
+the size they actually render with the `thumbnail` filter.
+"""
+
+import hashlib
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Image.LANCZOS is deprecated (removed in Pillow 10) for Image.Resampling,
+# which older Pillows don't have.
+LANCZOS = getattr(Image, 'Resampling', Image).LANCZOS
+
+# Variant name -> (width, height). Sizes are 2x the CSS box they fill.
+THUMBNAIL_SIZES = {
+    'avatar-sm': (96, 96),      # .timeline-image, navbar
+    'avatar-md': (140, 140),    # .card-image
+    'avatar-lg': (400, 400),    # #profile-avatar
+    'header-sm': (600, 200),    # .card-hero
+    'header-lg': (1600, 400),   # #warbler-hero
+}
+
+IMAGE_KINDS = ('avatar', 'header')
+
+JPEG_QUALITY = 85
+
+UPLOAD_URL_RE = re.compile(
+    r'^(?P<base>.*/[0-9a-f]{64})/(?P<kind>[a-z]+)-[a-z]+\.jpg$')
+
+_pool = None
+
+
+def get_pool():
+    """Return the shared thread pool used for resizing.
+
+    Pillow releases the GIL while resampling, so threads give real
+    parallelism here without the cost of shipping pixels between processes.
+    """
+
+    global _pool
+
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 2)
+
+    return _pool
+
+
+def variants_for(kind):
+    """Names of the thumbnail variants generated for this kind of image."""
+
+    return [name for name in THUMBNAIL_SIZES if name.startswith(f"{kind}-")]
+
+
+def save_upload(file, kind, folder, url_prefix):
+    """Store an uploaded image and its thumbnails; return its URL.
+
+    `file` is a file-like object (e.g. a werkzeug FileStorage). Thumbnails are
+    written to `folder`, which must be served at `url_prefix`.
+
+    Raises ValueError if the upload isn't a readable image.
+    """
+
+    if kind not in IMAGE_KINDS:
+        raise ValueError(f"Unknown image kind: {kind}")
+
+    data = file.read()
+    digest = hashlib.sha256(data).hexdigest()
+    rel_dir = os.path.join(digest[:2], digest)
+    out_dir = os.path.join(folder, rel_dir)
+    names = variants_for(kind)
+
+    # dedup: someone already uploaded these exact bytes as this kind
+    missing = [name for name in names
+               if not os.path.exists(os.path.join(out_dir, f"{name}.jpg"))]
+
+    if missing:
+        img = open_image(data)
+        os.makedirs(out_dir, exist_ok=True)
+
+        futures = [get_pool().submit(write_variant, img, name, out_dir)
+                   for name in missing]
+        for future in futures:
+            future.result()
+
+    largest = names[-1]
+    return f"{url_prefix}/{digest[:2]}/{digest}/{largest}.jpg"
+
+
+def open_image(data):
+    """Decode image bytes into an RGB Pillow image, upright per EXIF."""
+
+    try:
+        img = Image.open(BytesIO(data))
+        img = ImageOps.exif_transpose(img)
+        img.load()
+    except (OSError, Image.DecompressionBombError) as exc:
+        raise ValueError("Upload is not a valid image") from exc
+
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    return img
+
+
+def write_variant(img, name, out_dir):
+    """Resize `img` to the `name` variant and write it into `out_dir`.
+
+    Writes to a temp file then renames, so a concurrent upload of the same
+    image never sees a half-written thumbnail.
+    """
+
+    thumb = ImageOps.fit(img, THUMBNAIL_SIZES[name], LANCZOS)
+    path = os.path.join(out_dir, f"{name}.jpg")
+    tmp_path = f"{path}.{os.getpid()}.{id(thumb)}.tmp"
+
+    thumb.save(tmp_path, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    os.replace(tmp_path, path)
+
+
+def thumbnail(url, variant):
+    """Jinja filter: URL of the `variant` thumbnail for an image URL.
+
+    Remote URLs (and the default images) can't be resized by us, so they're
+    returned unchanged.
+    """
+
+    match = UPLOAD_URL_RE.match(url or '')
+
+    if not match or not variant.startswith(f"{match.group('kind')}-"):
+        return url
+
+    return f"{match.group('base')}/{variant}.jpg"
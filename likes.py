@@ -0,0 +1,377 @@
+"""Like and unlike writes.
+
+Both are idempotent single statements: a like is an insert that does
+nothing if the (user, message) pair already exists, an unlike is a plain
+DELETE. A double-click is harmless and neither needs a SELECT first.
+
+With LIKE_BUFFER_ENABLED, writes go to a per-worker write-behind buffer
+instead. It keeps only the latest state per (user, message), so a burst of
+like/unlike/like toggles becomes one row. Every LIKE_BUFFER_WINDOW seconds
+(or once LIKE_BUFFER_MAX pairs are waiting) a background thread writes the
+lot in one transaction: one multi-row insert and one delete.
+
+Until a buffered like is flushed, `like_buffer.overlay()` patches it into
+the like counts and flags this worker shows, so people see their own likes
+straight away.
+
+The buffer lives in memory. If LIKE_BUFFER_LOG is set, each write is also
+appended to that file (with "{worker_id}" replaced by the snowflake worker
+id, so workers don't share a file). A flush swaps the log for a fresh one
+and removes the old file only after its transaction commits. Whatever is
+left in these files is replayed, in order, when the worker next starts.
+"""
+
+import os
+import threading
+from datetime import datetime
+from time import sleep, time_ns
+
+from sqlalchemy import exists, literal, or_, select, tuple_, union_all
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Likes, Message, ArchivedMessage
+from shards import message_shards
+from snowflake import default_worker_id
+
+
+def insert_likes(rows):
+    """Insert like rows (dicts), skipping pairs that already exist.
+
+    Likes of messages that don't exist (deleted since) are dropped, by the
+    insert itself. On PostgreSQL, returns the message ids it inserted likes
+    of; any others were already liked or are gone. With message shards,
+    each shard's rows are committed there straight away.
+    """
+
+    if not rows:
+        return None
+
+    if message_shards.enabled:
+        insert_sharded_likes(rows)
+        return None
+
+    dialect = db.session.get_bind().dialect.name
+    result = db.session.execute(insert_statement(dialect, rows,
+                                                 existing_only=True))
+
+    if dialect == 'postgresql':
+        return {message_id for (message_id,) in result}
+
+    return None
+
+
+def insert_statement(dialect, rows, existing_only=False):
+    """Multi-row insert of like rows that skips pairs already there.
+
+    With `existing_only`, it's an INSERT ... SELECT of the rows whose
+    message is in messages or the archive, so no separate lookup (and no
+    window for the message to go in between). On PostgreSQL that one
+    RETURNs the message ids inserted.
+    """
+
+    table = Likes.__table__
+
+    if existing_only:
+        source = new_rows(rows)
+        values = (select([source.c.user_id,
+                          source.c.message_id,
+                          source.c.created_at])
+                  .where(or_(exists().where(Message.id == source.c.message_id),
+                             exists().where(ArchivedMessage.id
+                                            == source.c.message_id))))
+    else:
+        values = rows
+
+    if dialect == 'postgresql':
+        statement = pg_insert(table)
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE')
+    else:
+        statement = table.insert().prefix_with('IGNORE')
+
+    if existing_only:
+        statement = statement.from_select(
+            ['user_id', 'message_id', 'created_at'], values)
+    else:
+        statement = statement.values(values)
+
+    if dialect == 'postgresql':
+        statement = statement.on_conflict_do_nothing(
+            index_elements=['user_id', 'message_id'])
+        if existing_only:
+            statement = statement.returning(table.c.message_id)
+
+    return statement
+
+
+def new_rows(rows):
+    """Like rows (dicts) as a subquery of literal SELECTs."""
+
+    table = Likes.__table__
+    names = ('user_id', 'message_id', 'created_at')
+    selects = [select([literal(row[name], table.c[name].type).label(name)
+                       for name in names])
+               for row in rows]
+
+    if len(selects) == 1:
+        return selects[0].alias('new_likes')
+
+    return union_all(*selects).alias('new_likes')
+
+
+def insert_sharded_likes(rows):
+    """insert_likes() onto each liked message's shard (see shards.py)."""
+
+    shard_of = message_shards.locate({row['message_id'] for row in rows})
+    by_shard = {}
+    for row in rows:
+        if row['message_id'] in shard_of:
+            by_shard.setdefault(shard_of[row['message_id']], []).append(row)
+
+    def insert(shard_rows):
+        return lambda session: session.execute(
+            insert_statement(session.get_bind().dialect.name, shard_rows))
+
+    message_shards.scatter({name: insert(shard_rows)
+                            for name, shard_rows in by_shard.items()})
+
+
+def delete_likes(pairs):
+    """Delete the likes for these (user_id, message_id) pairs.
+
+    With message shards, the deletes are committed on each shard.
+    """
+
+    if not pairs:
+        return
+
+    statement = (Likes.__table__
+                 .delete()
+                 .where(tuple_(Likes.user_id, Likes.message_id).in_(pairs)))
+
+    if message_shards.enabled:
+        message_shards.everywhere(lambda session: session.execute(statement))
+    else:
+        db.session.execute(statement)
+
+
+def like(user_id, message_id):
+    """Record that this user likes this message (idempotent)."""
+
+    if like_buffer.enabled:
+        like_buffer.put(user_id, message_id, True)
+        return
+
+    insert_likes([dict(user_id=user_id,
+                       message_id=message_id,
+                       created_at=datetime.utcnow())])
+    db.session.commit()
+
+
+def unlike(user_id, message_id):
+    """Record that this user no longer likes this message (idempotent)."""
+
+    if like_buffer.enabled:
+        like_buffer.put(user_id, message_id, False)
+        return
+
+    delete_likes([(user_id, message_id)])
+    db.session.commit()
+
+
+class LikeBuffer:
+    """Flask extension coalescing like/unlike toggles and writing in bulk."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = {}
+        self.thread = None
+        self.log = None
+        self.log_path = None
+        self.flushing_paths = []
+        self.app = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('LIKE_BUFFER_ENABLED',
+                          os.environ.get('LIKE_BUFFER_ENABLED') == '1')
+        config.setdefault('LIKE_BUFFER_WINDOW', 0.5)
+        config.setdefault('LIKE_BUFFER_MAX', 5000)
+        config.setdefault('LIKE_BUFFER_LOG', None)
+
+        if not config['LIKE_BUFFER_ENABLED']:
+            return
+
+        self.app = app
+        self.window = config['LIKE_BUFFER_WINDOW']
+        self.max_pending = config['LIKE_BUFFER_MAX']
+        self.enabled = True
+
+        if config['LIKE_BUFFER_LOG']:
+            self.log_path = config['LIKE_BUFFER_LOG'].format(
+                worker_id=default_worker_id())
+            self.replay()
+            self.log = open(self.log_path, 'a')
+
+    # Writes
+
+    def put(self, user_id, message_id, liked):
+        """Buffer the latest like state for (user_id, message_id)."""
+
+        with self.lock:
+            if self.log is not None:
+                self.log.write(f"{user_id} {message_id} {int(liked)}\n")
+                self.log.flush()
+
+            self.pending[(user_id, message_id)] = (liked, datetime.utcnow())
+            full = len(self.pending) >= self.max_pending
+
+        self.ensure_flusher()
+        if full:
+            self.wake.set()
+
+    def ensure_flusher(self):
+        """Start the flush thread (lazily, so it survives forking servers)."""
+
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run,
+                                           name='warbler-like-buffer',
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.window)
+            self.wake.clear()
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                # Keep the thread alive; the batch was put back by flush().
+                sleep(self.window)
+
+    def flush(self):
+        """Write everything buffered so far in one transaction."""
+
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                self.rotate_log()
+
+            if not batch:
+                return
+
+            try:
+                self.write(batch)
+            except Exception:
+                db.session.rollback()
+                with self.lock:
+                    # Newer toggles made while we were writing win.
+                    batch.update(self.pending)
+                    self.pending = batch
+                raise
+
+            # Logs of earlier failed flushes are covered too: their
+            # batches were put back into this one.
+            for path in self.flushing_paths:
+                os.remove(path)
+            self.flushing_paths = []
+
+    def write(self, batch):
+        likes = [dict(user_id=user_id, message_id=message_id, created_at=at)
+                 for (user_id, message_id), (liked, at) in batch.items()
+                 if liked]
+        unlikes = [pair for pair, (liked, _) in batch.items() if not liked]
+
+        try:
+            delete_likes(unlikes)
+            insert_likes(likes)
+            db.session.commit()
+        except IntegrityError:
+            # A user in the batch was deleted meanwhile: save the rest
+            # one by one and drop the rows that can't be written.
+            db.session.rollback()
+            for row in likes:
+                try:
+                    insert_likes([row])
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+            delete_likes(unlikes)
+            db.session.commit()
+
+    # Crash recovery
+
+    def rotate_log(self):
+        """Move the log aside for the batch being flushed. Caller holds lock."""
+
+        if self.log is None or self.log.tell() == 0:
+            return
+
+        self.log.close()
+        flushing_path = f"{self.log_path}.{time_ns()}.flushing"
+        os.replace(self.log_path, flushing_path)
+        self.flushing_paths.append(flushing_path)
+        self.log = open(self.log_path, 'a')
+
+    def replay(self):
+        """Load writes left in this worker's logs by a previous run."""
+
+        directory, name = os.path.split(os.path.abspath(self.log_path))
+        os.makedirs(directory, exist_ok=True)
+
+        leftovers = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                           if f.startswith(name + '.') and f.endswith('.flushing'))
+        if os.path.exists(self.log_path):
+            leftovers.append(self.log_path)
+
+        for path in leftovers:
+            with open(path) as log:
+                for line in log:
+                    try:
+                        user_id, message_id, liked = map(int, line.split())
+                    except ValueError:
+                        continue  # torn last line from a crash
+                    self.pending[(user_id, message_id)] = (bool(liked),
+                                                           datetime.utcnow())
+
+        # Rewrite what we replayed into the live log, then drop the rest.
+        with open(self.log_path + '.replay', 'w') as log:
+            for (user_id, message_id), (liked, _) in self.pending.items():
+                log.write(f"{user_id} {message_id} {int(liked)}\n")
+        os.replace(self.log_path + '.replay', self.log_path)
+        for path in leftovers:
+            if path != self.log_path:
+                os.remove(path)
+
+    # Reads
+
+    def overlay(self, states, viewer_id):
+        """Patch this viewer's unflushed toggles into feeds.like_states()."""
+
+        if not self.pending or viewer_id is None:
+            return states
+
+        with self.lock:
+            toggles = [(message_id, self.pending[(viewer_id, message_id)][0])
+                       for message_id in states
+                       if (viewer_id, message_id) in self.pending]
+
+        for message_id, liked in toggles:
+            state = states[message_id]
+            if liked != state.liked:
+                states[message_id] = state._replace(
+                    count=state.count + (1 if liked else -1),
+                    liked=liked)
+
+        return states
+
+
+like_buffer = LikeBuffer()
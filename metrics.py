@@ -0,0 +1,279 @@
+"""Request, SQL and template timing for Warbler, exposed at /metrics.
+
+Hooks into:
+
+- SQLAlchemy cursor execution (query count and DB time)
+- Flask's template signals (Jinja render time)
+- every request (latency histogram by route, method and status)
+
+and serves the totals in Prometheus text format. Per-request numbers are
+accumulated on `flask.g` and folded into the shared registry once, at the
+end of the request, so the hot path is a couple of `perf_counter()` calls
+and no locking.
+
+Each worker process keeps its own registry; scrape every worker (or run
+Prometheus' multi-target setup) to see the whole deployment.
+
+Route names, timings and (via slow_queries.py) SQL aren't for the public,
+so /metrics answers 403 unless the request carries
+`Authorization: Bearer <METRICS_TOKEN>` or comes straight from one of
+METRICS_ALLOWED_IPS (the connection's own address: X-Forwarded-For is
+ignored, since any client can send it). Both are empty by default, so
+set one of them for the scraper.
+"""
+
+import hmac
+import os
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+from flask import Response, abort, current_app, g, has_app_context, request, \
+    template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (seconds) of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class RequestStats:
+    """What one request spent, accumulated on `g` as it runs."""
+
+    __slots__ = ('start', 'queries', 'db_time', 'template_time',
+                 'template_start')
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_start = None
+
+
+class RouteStats:
+    """Running totals for one (route, method)."""
+
+    __slots__ = ('buckets', 'count', 'duration', 'queries', 'db_time',
+                 'template_time', 'statuses')
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.statuses = {}
+
+
+class Metrics:
+    """Flask extension collecting per-route timings.
+
+    Other modules can add their own counters with `increment()`.
+    """
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.counters = {}
+        self.help = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('METRICS_TOKEN', os.environ.get('METRICS_TOKEN'))
+        config.setdefault('METRICS_ALLOWED_IPS',
+                          [ip.strip() for ip in
+                           os.environ.get('METRICS_ALLOWED_IPS', '').split(',')
+                           if ip.strip()])
+
+        if not config.setdefault('METRICS_ENABLED', True):
+            return
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+
+        before_render_template.connect(self.start_template, app)
+        template_rendered.connect(self.finish_template, app)
+
+        # Engine-class events, so this works whichever engine(s) get created.
+        event.listen(Engine, 'before_cursor_execute', self.start_query)
+        event.listen(Engine, 'after_cursor_execute', self.finish_query)
+        event.listen(Engine, 'handle_error', self.query_failed)
+
+        app.add_url_rule(app.config.get('METRICS_URL', '/metrics'),
+                         'metrics',
+                         self.render)
+
+    # Per-request hooks
+
+    def start_request(self):
+        g.request_stats = RequestStats()
+
+    def finish_request(self, response):
+        self.record(response.status_code)
+        return response
+
+    def teardown_request(self, exc):
+        # Only reached without a response when the view raised.
+        if exc is not None:
+            self.record(500)
+
+    def start_template(self, app, template, context):
+        stats = g.get('request_stats')
+        if stats is not None:
+            stats.template_start = perf_counter()
+
+    def finish_template(self, app, template, context):
+        stats = g.get('request_stats')
+        if stats is not None and stats.template_start is not None:
+            stats.template_time += perf_counter() - stats.template_start
+            stats.template_start = None
+
+    def start_query(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        conn.info.setdefault('query_start', []).append(perf_counter())
+
+    def finish_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        elapsed = perf_counter() - conn.info['query_start'].pop()
+
+        if not has_app_context():
+            return
+
+        stats = g.get('request_stats')
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += elapsed
+
+    def query_failed(self, context):
+        """Drop a failed statement's start time (there's no finish_query)."""
+
+        if context.connection is not None:
+            starts = context.connection.info.get('query_start')
+            if starts:
+                starts.pop()
+
+    def record(self, status):
+        """Fold this request's stats into the route totals (once)."""
+
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return
+
+        duration = perf_counter() - stats.start
+        rule = request.url_rule
+        key = (rule.rule if rule else 'unmatched', request.method)
+
+        with self.lock:
+            route = self.routes.get(key)
+            if route is None:
+                route = self.routes[key] = RouteStats()
+
+            route.buckets[bisect_left(LATENCY_BUCKETS, duration)] += 1
+            route.count += 1
+            route.duration += duration
+            route.queries += stats.queries
+            route.db_time += stats.db_time
+            route.template_time += stats.template_time
+            route.statuses[status] = route.statuses.get(status, 0) + 1
+
+    # Extra counters
+
+    def increment(self, name, help_text, amount=1, **labels):
+        """Add `amount` to counter `name` with these labels."""
+
+        key = (name, tuple(sorted(labels.items())))
+
+        with self.lock:
+            self.help.setdefault(name, help_text)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    # Exposition
+
+    def render(self):
+        """The /metrics view: everything so far, in Prometheus text format."""
+
+        check_access()
+        return Response(self.exposition(), content_type=CONTENT_TYPE)
+
+    def exposition(self):
+        with self.lock:
+            routes = sorted(self.routes.items())
+            counters = sorted(self.counters.items())
+
+        lines = []
+
+        def header(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        header('warbler_request_duration_seconds', 'histogram',
+               'Request latency by route.')
+        for (rule, method), route in routes:
+            labels = f'route="{rule}",method="{method}"'
+            cumulative = 0
+            for bound, hits in zip(LATENCY_BUCKETS, route.buckets):
+                cumulative += hits
+                lines.append(f'warbler_request_duration_seconds_bucket'
+                             f'{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'warbler_request_duration_seconds_bucket'
+                         f'{{{labels},le="+Inf"}} {route.count}')
+            lines.append(f'warbler_request_duration_seconds_sum'
+                         f'{{{labels}}} {route.duration:.6f}')
+            lines.append(f'warbler_request_duration_seconds_count'
+                         f'{{{labels}}} {route.count}')
+
+        totals = (
+            ('warbler_requests_total', 'Requests by route and status.', None),
+            ('warbler_db_queries_total', 'SQL statements run.', 'queries'),
+            ('warbler_db_duration_seconds_total', 'Time spent in SQL.',
+             'db_time'),
+            ('warbler_template_duration_seconds_total',
+             'Time spent rendering templates.', 'template_time'),
+        )
+        for name, help_text, attr in totals:
+            header(name, 'counter', help_text)
+            for (rule, method), route in routes:
+                labels = f'route="{rule}",method="{method}"'
+                if attr is None:
+                    for status, hits in sorted(route.statuses.items()):
+                        lines.append(f'{name}{{{labels},status="{status}"}} {hits}')
+                else:
+                    lines.append(f'{name}{{{labels}}} {round(getattr(route, attr), 6)}')
+
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                header(name, 'counter', self.help[name])
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{name}{{{label_text}}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def check_access():
+    """403 unless this request may read metrics (see the module docstring)."""
+
+    config = current_app.config
+    token = config.get('METRICS_TOKEN')
+    header = request.headers.get('Authorization', '')
+
+    if token and hmac.compare_digest(header.encode(),
+                                     f"Bearer {token}".encode()):
+        return
+
+    if request.remote_addr in config.get('METRICS_ALLOWED_IPS', ()):
+        return
+
+    abort(403)
+
+
+metrics = Metrics()
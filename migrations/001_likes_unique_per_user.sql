@@ -0,0 +1,18 @@
+-- Allow more than one user to like a message.
+--
+-- likes.message_id used to be UNIQUE on its own, so each message could only
+-- ever be liked once. Uniqueness is per (user, message) instead, with a plain
+-- index on message_id for the per-page like-count query.
+--
+-- Run with:
+--
+--    psql warbler -f migrations/001_likes_unique_per_user.sql
+
+BEGIN;
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key;
+ALTER TABLE likes ADD CONSTRAINT likes_user_id_message_id_key
+    UNIQUE (user_id, message_id);
+CREATE INDEX IF NOT EXISTS ix_likes_message_id ON likes (message_id);
+
+COMMIT;
@@ -0,0 +1,19 @@
+-- Record when each like happened, for cursor-paginating /users/<id>/likes.
+--
+-- Existing likes get the migration time: we never recorded the real one.
+--
+-- Run with:
+--
+--    psql warbler -f migrations/002_likes_created_at.sql
+
+BEGIN;
+
+ALTER TABLE likes ADD COLUMN IF NOT EXISTS created_at TIMESTAMP;
+UPDATE likes SET created_at = (NOW() AT TIME ZONE 'utc') WHERE created_at IS NULL;
+ALTER TABLE likes ALTER COLUMN created_at SET NOT NULL;
+
+COMMIT;
+
+-- Outside the transaction so it doesn't lock writes on a big table.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_likes_user_id_created_at
+    ON likes (user_id, created_at, id);
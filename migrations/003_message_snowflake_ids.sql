@@ -0,0 +1,47 @@
+-- Switch messages.id from a serial to time-ordered 64-bit snowflake ids.
+--
+-- New ids are generated by the app (snowflake.py). Existing messages get the
+-- id they would have had if posted at their timestamp: milliseconds since
+-- 2015-01-01 in the top 41 bits and, in the low 22 bits (worker + sequence),
+-- their rank among messages from the same millisecond. Ranking by old id
+-- keeps the existing order for rows that share a (stale) timestamp.
+--
+-- Likes are re-pointed at the new ids. Feeds now order by id, so this also
+-- adds the (user_id, id) index they use.
+--
+-- Run with:
+--
+--    psql warbler -f migrations/003_message_snowflake_ids.sql
+
+BEGIN;
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey;
+
+ALTER TABLE messages ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE messages ALTER COLUMN id TYPE BIGINT;
+ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT;
+DROP SEQUENCE IF EXISTS messages_id_seq;
+
+CREATE TEMPORARY TABLE message_new_ids ON COMMIT DROP AS
+SELECT id AS old_id,
+       ((floor(extract(epoch FROM timestamp) * 1000)::BIGINT - 1420070400000) << 22)
+       | (row_number() OVER (PARTITION BY floor(extract(epoch FROM timestamp) * 1000)
+                             ORDER BY id) - 1) AS new_id
+FROM messages;
+
+UPDATE likes
+SET message_id = ids.new_id
+FROM message_new_ids ids
+WHERE likes.message_id = ids.old_id;
+
+UPDATE messages
+SET id = ids.new_id
+FROM message_new_ids ids
+WHERE messages.id = ids.old_id;
+
+ALTER TABLE likes ADD CONSTRAINT likes_message_id_fkey
+    FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE;
+
+CREATE INDEX ix_messages_user_id_id ON messages (user_id, id);
+
+COMMIT;
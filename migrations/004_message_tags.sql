@@ -0,0 +1,32 @@
+-- Index hashtags and @mentions, for the tag and mention timelines.
+--
+-- The primary keys are the timelines' access path: one tag's (or one
+-- user's) messages, newest id first. message_id gets its own index so
+-- deleting a message doesn't scan these tables for its rows.
+--
+-- Existing messages are indexed afterwards by `flask backfill-tags`.
+--
+-- Run with:
+--
+--    psql warbler -f migrations/004_message_tags.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS message_tags (
+    tag VARCHAR(100) NOT NULL,
+    message_id BIGINT NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    PRIMARY KEY (tag, message_id)
+);
+
+CREATE TABLE IF NOT EXISTS message_mentions (
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    message_id BIGINT NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+    PRIMARY KEY (user_id, message_id)
+);
+
+CREATE INDEX IF NOT EXISTS ix_message_tags_message_id
+    ON message_tags (message_id);
+CREATE INDEX IF NOT EXISTS ix_message_mentions_message_id
+    ON message_mentions (message_id);
+
+COMMIT;
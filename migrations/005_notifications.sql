@@ -0,0 +1,31 @@
+-- Like and follow notification digests, and each user's unread count.
+--
+-- The partial index finds a user's unread digest for a message (or their
+-- unread follow digest) when a batch of new events is folded in.
+--
+-- Run with:
+--
+--    psql warbler -f migrations/005_notifications.sql
+
+BEGIN;
+
+ALTER TABLE users
+    ADD COLUMN IF NOT EXISTS unread_notifications INTEGER NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS notifications (
+    id SERIAL PRIMARY KEY,
+    recipient_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    kind VARCHAR(10) NOT NULL,
+    message_id BIGINT REFERENCES messages (id) ON DELETE CASCADE,
+    actor_id INTEGER REFERENCES users (id) ON DELETE SET NULL,
+    actor_count INTEGER NOT NULL,
+    unread BOOLEAN NOT NULL,
+    updated_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS ix_notifications_recipient_id_updated_at
+    ON notifications (recipient_id, updated_at, id);
+CREATE INDEX IF NOT EXISTS ix_notifications_unread
+    ON notifications (recipient_id, kind, message_id) WHERE unread;
+
+COMMIT;
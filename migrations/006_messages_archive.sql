@@ -0,0 +1,33 @@
+-- Cold archive tier for old messages (see archive.py).
+--
+-- Likes, tag and mention index rows and notifications can refer to a
+-- message in either messages or messages_archive, so their foreign keys to
+-- messages are dropped; models.py deletes their rows when a message (or
+-- its author) is deleted instead.
+--
+-- Old messages are moved afterwards by `flask archive-messages`.
+--
+-- Run with:
+--
+--    psql warbler -f migrations/006_messages_archive.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS messages_archive (
+    id BIGINT PRIMARY KEY,
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS ix_messages_archive_user_id_id
+    ON messages_archive (user_id, id);
+
+ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey;
+ALTER TABLE message_tags DROP CONSTRAINT IF EXISTS message_tags_message_id_fkey;
+ALTER TABLE message_mentions
+    DROP CONSTRAINT IF EXISTS message_mentions_message_id_fkey;
+ALTER TABLE notifications
+    DROP CONSTRAINT IF EXISTS notifications_message_id_fkey;
+
+COMMIT;
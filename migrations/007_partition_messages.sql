@@ -0,0 +1,77 @@
+-- Range-partition messages by id, one partition per month (PostgreSQL 11+).
+--
+-- Message ids are snowflakes (see 003), so a month's id range is
+-- [ms of its first instant - 2015-01-01) << 22, same for the next month).
+-- Partitions are named messages_YYYY_MM, as partitions.py creates them.
+--
+-- The old table is renamed aside, the partitioned table is created with the
+-- same columns and indexes, partitions are created from the month of the
+-- oldest message through three months from now, and the rows are copied
+-- over. Nothing else references messages by foreign key (see 006), so the
+-- old table can simply be dropped. This rewrites the whole table under an
+-- exclusive lock: run it in a maintenance window, after archiving old
+-- messages (`flask archive-messages`) to keep the copy small.
+--
+-- Afterwards `flask create-partitions` (or the app itself) keeps future
+-- months' partitions ahead of time.
+--
+-- Run with:
+--
+--    psql warbler -f migrations/007_partition_messages.sql
+
+BEGIN;
+
+LOCK TABLE messages IN ACCESS EXCLUSIVE MODE;
+
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER TABLE messages_unpartitioned
+    RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+ALTER INDEX IF EXISTS ix_messages_user_id_id
+    RENAME TO ix_messages_unpartitioned_user_id_id;
+
+CREATE TABLE messages (
+    id BIGINT NOT NULL,
+    text VARCHAR(140) NOT NULL,
+    timestamp TIMESTAMP NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    PRIMARY KEY (id)
+) PARTITION BY RANGE (id);
+
+CREATE INDEX ix_messages_user_id_id ON messages (user_id, id);
+
+DO $$
+DECLARE
+    partition_month TIMESTAMP;
+    last_month TIMESTAMP := date_trunc('month', now() AT TIME ZONE 'UTC')
+                            + INTERVAL '3 months';
+BEGIN
+    SELECT date_trunc('month', to_timestamp(((min(id) >> 22) + 1420070400000)
+                                            / 1000.0) AT TIME ZONE 'UTC')
+    INTO partition_month
+    FROM messages_unpartitioned;
+
+    partition_month := least(coalesce(partition_month, last_month),
+                             date_trunc('month', now() AT TIME ZONE 'UTC'));
+
+    WHILE partition_month <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%s) TO (%s)',
+            'messages_' || to_char(partition_month, 'YYYY_MM'),
+            (floor(extract(epoch FROM partition_month) * 1000)::BIGINT
+             - 1420070400000) << 22,
+            (floor(extract(epoch FROM partition_month + INTERVAL '1 month')
+                   * 1000)::BIGINT - 1420070400000) << 22);
+        partition_month := partition_month + INTERVAL '1 month';
+    END LOOP;
+END
+$$;
+
+INSERT INTO messages (id, text, timestamp, user_id)
+SELECT id, text, timestamp, user_id
+FROM messages_unpartitioned;
+
+DROP TABLE messages_unpartitioned;
+
+ANALYZE messages;
+
+COMMIT;
@@ -0,0 +1,24 @@
+-- Who has been counted in each notification digest, so a person who likes
+-- the same message again (after unliking it, or twice before the like
+-- buffer catches up) isn't counted again in a later batch.
+--
+-- Existing digests only know their latest actor, who is recorded here;
+-- their counts are left as they are.
+--
+-- Run with:
+--
+--    psql warbler -f migrations/008_notification_actors.sql
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS notification_actors (
+    notification_id INTEGER REFERENCES notifications (id) ON DELETE CASCADE,
+    actor_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+    PRIMARY KEY (notification_id, actor_id)
+);
+
+INSERT INTO notification_actors (notification_id, actor_id)
+    SELECT id, actor_id FROM notifications WHERE actor_id IS NOT NULL
+    ON CONFLICT DO NOTHING;
+
+COMMIT;
@@ -4,6 +4,9 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, select
+
+from snowflake import next_id
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -30,7 +33,11 @@ class Follows(db.Model):
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+        db.Index('ix_likes_user_id_created_at', 'user_id', 'created_at', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -42,10 +49,137 @@ class Likes(db.Model):
         db.ForeignKey('users.id', ondelete='cascade')
     )
 
+    # No foreign key: the message may be in messages or messages_archive.
+    # Rows go when their message is deleted (see delete_message_rows).
+    message_id = db.Column(
+        db.BigInteger,
+        index=True,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class MessageTag(db.Model):
+    """A hashtag used in a message (see tags.py)."""
+
+    __tablename__ = 'message_tags'
+
+    # Lowercased, without the '#'.
+    tag = db.Column(
+        db.String(100),
+        primary_key=True,
+    )
+
     message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        index=True,
+    )
+
+
+class MessageMention(db.Model):
+    """A user @mentioned in a message (see tags.py)."""
+
+    __tablename__ = 'message_mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        index=True,
+    )
+
+
+class Notification(db.Model):
+    """A digest of likes or follows for one user (see notifications.py).
+
+    One row stands for `actor_count` people's events of the same kind
+    (and, for likes, on the same message); `actor_id` is the most recent
+    actor. Who's been counted is kept in NotificationActor.
+    """
+
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_recipient_id_updated_at',
+                 'recipient_id', 'updated_at', 'id'),
+        db.Index('ix_notifications_unread',
+                 'recipient_id', 'kind', 'message_id',
+                 postgresql_where=db.text('unread')),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recipient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # 'like' or 'follow'
+    kind = db.Column(
+        db.String(10),
+        nullable=False,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='set null'),
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    unread = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class NotificationActor(db.Model):
+    """Someone already counted in a digest's actor_count.
+
+    Lets later batches count each person once, however many times they
+    like (or unlike and like again) the same message.
+    """
+
+    __tablename__ = 'notification_actors'
+
+    notification_id = db.Column(
+        db.Integer,
+        db.ForeignKey('notifications.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    actor_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
 
@@ -94,6 +228,14 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Maintained by notifications.py, so page views needn't COUNT(*).
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -112,7 +254,9 @@ class User(db.Model):
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        primaryjoin="User.id == foreign(Likes.user_id)",
+        secondaryjoin="Message.id == foreign(Likes.message_id)",
     )
 
     def __repr__(self):
@@ -121,13 +265,13 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`? Returns Boolean"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
+        found_user_list = [user for user in self.followers if user.id == other_user.id]
         return len(found_user_list) == 1
 
     def is_following(self, other_user):
         """Is this user following `other_use`? Returns Boolean"""
 
-        found_user_list = [user for user in self.following if user == other_user]
+        found_user_list = [user for user in self.following if user.id == other_user.id]
         return len(found_user_list) == 1
 
     @classmethod
@@ -174,10 +318,18 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
 
+    # Time-ordered snowflake ids (see snowflake.py): newest = highest id,
+    # so feeds order and paginate on the primary key alone. On PostgreSQL
+    # the table is range-partitioned by month of id (see partitions.py).
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=next_id,
     )
 
     text = db.Column(
@@ -188,7 +340,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -201,9 +353,76 @@ class Message(db.Model):
 
     likes = db.relationship(
         'User',
-        secondary="likes"
+        secondary="likes",
+        primaryjoin="Message.id == foreign(Likes.message_id)",
+        secondaryjoin="User.id == foreign(Likes.user_id)",
     )
 
+
+class ArchivedMessage(db.Model):
+    """A message moved out of `messages` by the archiver (see archive.py).
+
+    Same columns as Message. Archived messages are read-only, except that
+    they can still be deleted.
+    """
+
+    __tablename__ = 'messages_archive'
+    __table_args__ = (
+        db.Index('ix_messages_archive_user_id_id', 'user_id', 'id'),
+    )
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    text = db.Column(
+        db.String(140),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    user = db.relationship('User')
+
+
+def delete_message_rows(connection, message_ids):
+    """Delete likes, index entries and notifications of these messages.
+
+    `message_ids` is a list or a subquery. This stands in for ON DELETE
+    CASCADE, which can't be used since a message may live in either
+    messages or messages_archive.
+    """
+
+    for model in (Likes, MessageTag, MessageMention, Notification):
+        connection.execute(model.__table__.delete()
+                           .where(model.message_id.in_(message_ids)))
+
+
+@event.listens_for(Message, 'after_delete')
+@event.listens_for(ArchivedMessage, 'after_delete')
+def message_deleted(mapper, connection, target):
+    delete_message_rows(connection, [target.id])
+
+
+@event.listens_for(User, 'before_delete')
+def user_deleting(mapper, connection, target):
+    # Their messages go by ON DELETE CASCADE, without passing through here.
+    for model in (Message, ArchivedMessage):
+        delete_message_rows(connection,
+                            select([model.id])
+                            .where(model.user_id == target.id))
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,365 @@
+"""Like and follow notifications, written in batches as digests.
+
+Liking a warble or following someone just appends a tiny event tuple to an
+in-memory buffer; the request does no notification SQL at all. Every
+NOTIFICATIONS_WINDOW seconds a background thread writes the buffer in one
+transaction, collapsing it into digests as it goes: all the likes of one
+message (or all the new followers of one user) become a single row,
+"12 people liked your warble", and land on the recipient's existing unread
+digest for the same thing if there is one. A digest remembers who it has
+counted (notification_actors), so liking the same warble again, in a later
+batch or after unliking it, doesn't count twice.
+
+Each user's unread count is a maintained counter, users.unread_notifications,
+bumped by the flush when it creates a new unread digest and reset when the
+notifications page is viewed. It's on the users row that every request
+loads for `g.user` anyway, so showing the count costs no query.
+
+Events waiting in a worker's buffer are lost if it crashes; for
+notifications, that's an acceptable trade for keeping writes off the
+like and follow paths.
+"""
+
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+from time import sleep
+
+from sqlalchemy import bindparam, func, tuple_
+from sqlalchemy.orm import aliased
+
+from feeds import PAGE_SIZE, Page, decode_cursor, encode_cursor
+from hot_cache import hot_cache
+from models import db, User, Message, ArchivedMessage, Notification, \
+    NotificationActor
+from shards import message_shards
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+Event = namedtuple('Event', ['kind', 'actor_id', 'recipient_id', 'message_id',
+                             'at'])
+
+NotificationRow = namedtuple(
+    'NotificationRow',
+    ['id', 'kind', 'actor_count', 'unread', 'updated_at', 'message_id',
+     'message_text', 'actor_id', 'actor_username', 'actor_image_url'])
+
+
+def collapse(events, authors):
+    """Group events into {(recipient, kind, message_id): (actors, actor, at)}.
+
+    `actors` is the set of people who acted; `actor` and `at` are the
+    latest of them. `authors` maps message id to author, for likes (whose
+    recipient isn't known when they happen). Events on deleted messages
+    and people's own actions are dropped.
+    """
+
+    actors = {}
+    latest = {}
+
+    for kind, actor_id, recipient_id, message_id, at in events:
+        if kind == LIKE:
+            recipient_id = authors.get(message_id)
+        if recipient_id is None or recipient_id == actor_id:
+            continue
+
+        key = (recipient_id, kind, message_id)
+        actors.setdefault(key, set()).add(actor_id)
+        latest[key] = (actor_id, at)
+
+    return {key: (actors[key],) + latest[key] for key in actors}
+
+
+def unread_digests(keys):
+    """{(recipient, kind, message_id): id} of existing unread digests."""
+
+    like_pairs = [(recipient_id, message_id)
+                  for recipient_id, kind, message_id in keys if kind == LIKE]
+    followed = [recipient_id
+                for recipient_id, kind, _ in keys if kind == FOLLOW]
+
+    found = {}
+    columns = (Notification.id, Notification.recipient_id,
+               Notification.kind, Notification.message_id)
+
+    if like_pairs:
+        rows = (db.session
+                .query(*columns)
+                .filter(Notification.unread,
+                        Notification.kind == LIKE,
+                        tuple_(Notification.recipient_id,
+                               Notification.message_id).in_(like_pairs)))
+        found.update(((r, k, m), i) for i, r, k, m in rows)
+
+    if followed:
+        rows = (db.session
+                .query(*columns)
+                .filter(Notification.unread,
+                        Notification.kind == FOLLOW,
+                        Notification.recipient_id.in_(followed)))
+        found.update(((r, k, m), i) for i, r, k, m in rows)
+
+    return found
+
+
+def counted_actors(digest_ids):
+    """{(digest id, actor id)} of people these digests already count."""
+
+    if not digest_ids:
+        return set()
+
+    return set(db.session
+               .query(NotificationActor.notification_id,
+                      NotificationActor.actor_id)
+               .filter(NotificationActor.notification_id.in_(digest_ids)))
+
+
+def write(events):
+    """Fold a batch of events into the notifications table. Commits."""
+
+    liked = {event.message_id for event in events if event.kind == LIKE}
+    authors = {}
+    if liked and message_shards.enabled:
+        authors.update(message_shards.messages(liked, Message.id,
+                                               Message.user_id))
+    elif liked:
+        for model in (Message, ArchivedMessage):
+            authors.update(db.session
+                           .query(model.id, model.user_id)
+                           .filter(model.id.in_(liked)))
+
+    digests = collapse(events, authors)
+    if not digests:
+        return
+
+    # Lock the recipients' counters (in id order, so flushes from several
+    # workers can't deadlock) before touching their digests; mark_read()
+    # takes the same lock first, so it can't land in between.
+    recipients = sorted({recipient_id for recipient_id, _, _ in digests})
+    (db.session
+     .query(User.id)
+     .filter(User.id.in_(recipients))
+     .order_by(User.id)
+     .with_for_update()
+     .all())
+
+    existing = unread_digests(digests)
+    counted = counted_actors(list(existing.values()))
+    table = Notification.__table__
+    updates = []
+    inserts = []
+    actor_rows = []
+    new_unread = {}
+
+    for key, (actors, actor_id, at) in digests.items():
+        recipient_id, kind, message_id = key
+
+        if key in existing:
+            digest_id = existing[key]
+            new_actors = [actor for actor in actors
+                          if (digest_id, actor) not in counted]
+            if not new_actors:
+                continue
+            updates.append(dict(digest_id=digest_id, count=len(new_actors),
+                                latest_actor=actor_id, at=at))
+            actor_rows += [dict(notification_id=digest_id, actor_id=actor)
+                           for actor in new_actors]
+        else:
+            inserts.append(dict(recipient_id=recipient_id, kind=kind,
+                                message_id=message_id, actor_id=actor_id,
+                                actor_count=len(actors), unread=True,
+                                updated_at=at))
+            new_unread[recipient_id] = new_unread.get(recipient_id, 0) + 1
+
+    if updates:
+        db.session.execute(
+            table.update()
+            .where(table.c.id == bindparam('digest_id'))
+            .values(actor_count=table.c.actor_count + bindparam('count'),
+                    actor_id=bindparam('latest_actor'),
+                    updated_at=bindparam('at')),
+            updates)
+
+    if inserts:
+        db.session.execute(table.insert().values(inserts))
+
+        # Still holding the recipients' locks, so these are the rows
+        # just inserted.
+        created = unread_digests([(row['recipient_id'], row['kind'],
+                                   row['message_id']) for row in inserts])
+        actor_rows += [dict(notification_id=digest_id, actor_id=actor)
+                       for key, digest_id in created.items()
+                       for actor in digests[key][0]]
+
+        users = User.__table__
+        db.session.execute(
+            users.update()
+            .where(users.c.id == bindparam('recipient_id'))
+            .values(unread_notifications=(users.c.unread_notifications
+                                          + bindparam('new'))),
+            [dict(recipient_id=recipient_id, new=new)
+             for recipient_id, new in new_unread.items()])
+
+    if actor_rows:
+        db.session.execute(NotificationActor.__table__.insert(), actor_rows)
+
+    db.session.commit()
+    hot_cache.invalidate(*(f"user:{recipient_id}"
+                           for recipient_id in new_unread))
+
+
+def mark_read(user_id):
+    """Mark all of this user's notifications read and zero their count."""
+
+    users = User.__table__
+    db.session.execute(users.update()
+                       .where(users.c.id == user_id)
+                       .values(unread_notifications=0))
+    db.session.execute(Notification.__table__.update()
+                       .where(Notification.recipient_id == user_id)
+                       .where(Notification.unread)
+                       .values(unread=False))
+    db.session.commit()
+    hot_cache.invalidate(f"user:{user_id}")
+
+
+def notification_page(user_id, before=None, limit=PAGE_SIZE):
+    """A page of this user's digests, most recently updated first."""
+
+    actor = aliased(User)
+    rows = (db.session
+            .query(Notification.id,
+                   Notification.kind,
+                   Notification.actor_count,
+                   Notification.unread,
+                   Notification.updated_at,
+                   Notification.message_id,
+                   func.coalesce(Message.text, ArchivedMessage.text),
+                   actor.id,
+                   actor.username,
+                   actor.image_url)
+            .outerjoin(Message, Notification.message_id == Message.id)
+            .outerjoin(ArchivedMessage,
+                       Notification.message_id == ArchivedMessage.id)
+            .outerjoin(actor, Notification.actor_id == actor.id)
+            .filter(Notification.recipient_id == user_id)
+            .order_by(Notification.updated_at.desc(), Notification.id.desc()))
+
+    position = decode_cursor(before)
+    if position:
+        rows = rows.filter(tuple_(Notification.updated_at,
+                                  Notification.id) < position)
+
+    rows = [NotificationRow._make(row) for row in rows.limit(limit + 1)]
+    next_cursor = (encode_cursor(rows[limit - 1].updated_at, rows[limit - 1].id)
+                   if len(rows) > limit else None)
+
+    if message_shards.enabled:
+        # The join above found no messages on the main database.
+        texts = dict(message_shards.messages(
+            {row.message_id for row in rows if row.message_id},
+            Message.id, Message.text))
+        rows = [row._replace(message_text=texts.get(row.message_id))
+                for row in rows]
+
+    return Page(rows[:limit], next_cursor)
+
+
+class Notifier:
+    """Flask extension buffering notification events and flushing them."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.pending = []
+        self.thread = None
+        self.app = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('NOTIFICATIONS_ENABLED',
+                          os.environ.get('NOTIFICATIONS_ENABLED', '1') == '1')
+        config.setdefault('NOTIFICATIONS_WINDOW', 2.0)
+        config.setdefault('NOTIFICATIONS_MAX', 10000)
+
+        if not config['NOTIFICATIONS_ENABLED']:
+            return
+
+        self.app = app
+        self.window = config['NOTIFICATIONS_WINDOW']
+        self.max_pending = config['NOTIFICATIONS_MAX']
+        self.enabled = True
+
+    # Events
+
+    def liked(self, actor_id, message_id):
+        """`actor_id` liked this message (its author gets notified)."""
+
+        self.put(Event(LIKE, actor_id, None, message_id, datetime.utcnow()))
+
+    def followed(self, actor_id, user_id):
+        """`actor_id` started following `user_id`."""
+
+        self.put(Event(FOLLOW, actor_id, user_id, None, datetime.utcnow()))
+
+    def put(self, event):
+        if not self.enabled:
+            return
+
+        with self.lock:
+            self.pending.append(event)
+            full = len(self.pending) >= self.max_pending
+
+        self.ensure_flusher()
+        if full:
+            self.wake.set()
+
+    # Flushing
+
+    def ensure_flusher(self):
+        """Start the flush thread (lazily, so it survives forking servers)."""
+
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run,
+                                           name='warbler-notifier',
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.window)
+            self.wake.clear()
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                # Keep the thread alive; the batch was put back by flush().
+                sleep(self.window)
+
+    def flush(self):
+        """Write everything buffered so far in one transaction."""
+
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+
+            if not batch:
+                return
+
+            try:
+                write(batch)
+            except Exception:
+                db.session.rollback()
+                with self.lock:
+                    self.pending[:0] = batch
+                raise
+
+
+notifier = Notifier()
@@ -0,0 +1,214 @@
+"""Full-page cache for anonymous visitors.
+
+Someone without a session (not logged in, no flash messages waiting) sees
+exactly the same `/`, `/users/<id>` and `/messages/<id>` as every other
+anonymous visitor. With PAGE_CACHE_ENABLED we keep the rendered responses
+of those endpoints (PAGE_CACHE_ENDPOINTS), keyed by URL, and hand them
+straight back next time, skipping the view, its queries and the template.
+
+Invalidation is by version. Views declare what a page shows with
+`page_cache.depends_on('user:5', 'message:9')`, and writes call
+`page_cache.invalidate('user:5')`. A cached page is served only while
+nothing it depends on has been invalidated since it was rendered, and for
+at most PAGE_CACHE_TTL seconds. The TTL bounds what we don't track: like
+counts on profile pages, and writes made by other workers (versions are
+per process).
+
+Entries are evicted least-recently-used once they add up to more than
+PAGE_CACHE_MAX_BYTES. When a hot page needs rendering again, only one
+request in this worker renders it. The others get the stale copy if there
+is one, or wait up to PAGE_CACHE_WAIT seconds for the new one.
+"""
+
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from itertools import count
+from time import monotonic
+
+from flask import Response, g, request, session
+
+Entry = namedtuple('Entry', ['body', 'status', 'mimetype', 'generation',
+                             'dependencies', 'stored_at'])
+
+
+class PageCache:
+    """Flask extension caching whole anonymous GET responses."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.versions = {}
+        self.generations = count(1)
+        self.generation = 0
+        self.filling = {}
+        self.endpoints = frozenset()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('PAGE_CACHE_ENABLED',
+                          os.environ.get('PAGE_CACHE_ENABLED') == '1')
+        config.setdefault('PAGE_CACHE_TTL', 30)
+        config.setdefault('PAGE_CACHE_MAX_BYTES', 64 * 1024 * 1024)
+        config.setdefault('PAGE_CACHE_WAIT', 5.0)
+        config.setdefault('PAGE_CACHE_ENDPOINTS',
+                          ('homepage', 'users_show', 'messages_show'))
+
+        if not config['PAGE_CACHE_ENABLED']:
+            return
+
+        self.enabled = True
+        self.ttl = config['PAGE_CACHE_TTL']
+        self.max_bytes = config['PAGE_CACHE_MAX_BYTES']
+        self.wait = config['PAGE_CACHE_WAIT']
+        self.endpoints = frozenset(config['PAGE_CACHE_ENDPOINTS'])
+
+        app.before_request(self.serve)
+        app.after_request(self.store)
+        app.teardown_request(self.teardown_request)
+
+    # Versions
+
+    def depends_on(self, *scopes):
+        """Declare that the page being rendered shows these scopes."""
+
+        if 'page_cache_key' in g:
+            g.page_cache_dependencies.update(scopes)
+
+    def invalidate(self, *scopes):
+        """Mark everything rendered from these scopes as out of date."""
+
+        if not self.enabled:
+            return
+
+        with self.lock:
+            generation = next(self.generations)
+            self.generation = generation
+            for scope in scopes:
+                self.versions[scope] = generation
+
+    def is_current(self, entry):
+        return all(self.versions.get(scope, 0) <= entry.generation
+                   for scope in entry.dependencies)
+
+    # Request hooks
+
+    def serve(self):
+        """Answer from the cache, or claim the right to render this page."""
+
+        if (request.method != 'GET'
+                or request.endpoint not in self.endpoints
+                or session):
+            return None
+
+        key = request.full_path
+        claimed = False
+
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                fresh = (entry is not None
+                         and self.is_current(entry)
+                         and monotonic() - entry.stored_at < self.ttl)
+
+                if fresh:
+                    self.entries.move_to_end(key)
+                    return self.response(entry, 'HIT')
+
+                filling = self.filling.get(key)
+                if filling is None:
+                    self.filling[key] = threading.Event()
+                    claimed = True
+                generation = self.generation
+
+            if claimed:
+                break
+            if entry is not None:
+                return self.response(entry, 'STALE')
+            if not filling.wait(self.wait):
+                break  # Render it ourselves rather than wait any longer.
+
+        g.page_cache_key = key
+        g.page_cache_claimed = claimed
+        g.page_cache_generation = generation
+        g.page_cache_dependencies = set()
+
+        return None
+
+    def store(self, response):
+        """Keep the response we just rendered, if it's safe to share."""
+
+        key = g.pop('page_cache_key', None)
+        if key is None:
+            return response
+
+        if (response.status_code == 200
+                and not response.direct_passthrough
+                and not session
+                and 'Set-Cookie' not in response.headers):
+            body = response.get_data()
+            entry = Entry(body,
+                          response.status_code,
+                          response.mimetype,
+                          g.page_cache_generation,
+                          frozenset(g.page_cache_dependencies),
+                          monotonic())
+
+            with self.lock:
+                old = self.entries.pop(key, None)
+                if old is not None:
+                    self.size -= len(old.body)
+
+                # Written to while we rendered: don't keep the result.
+                if self.is_current(entry):
+                    self.entries[key] = entry
+                    self.size += len(body)
+                    self.evict()
+
+            response.headers['X-Cache'] = 'MISS'
+
+        self.release(key)
+        return response
+
+    def teardown_request(self, exc):
+        key = g.pop('page_cache_key', None)
+        if key is not None:
+            self.release(key)
+
+    def release(self, key):
+        """Let requests waiting on our render of `key` go ahead."""
+
+        if not g.pop('page_cache_claimed', False):
+            return
+
+        with self.lock:
+            filling = self.filling.pop(key, None)
+        if filling is not None:
+            filling.set()
+
+    def evict(self):
+        """Drop least recently used entries until under budget. Holds lock."""
+
+        while self.size > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= len(entry.body)
+
+    def response(self, entry, status):
+        response = Response(entry.body,
+                            status=entry.status,
+                            mimetype=entry.mimetype)
+        response.headers['X-Cache'] = status
+        return response
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+page_cache = PageCache()
@@ -0,0 +1,176 @@
+"""Monthly range partitions of the messages table (PostgreSQL).
+
+Migration 007 turns `messages` into a table partitioned by RANGE (id), one
+partition per calendar month: messages_2026_10 holds the ids of messages
+posted in October 2026. Message ids are time-ordered (see snowflake.py), so
+a month's bounds are just the ids of its first millisecond and the next
+month's, and partitioning by id rather than timestamp lets both the primary
+key and the feeds' (user_id, id) index be partitioned too. Each partition's
+indexes only cover one month, so inserts maintain small indexes and old
+months' pages stay cold.
+
+Feed queries bound the id range they read (see feeds.message_ranges()), so
+the planner prunes a first page to the newest partitions instead of
+walking every month's index.
+
+An insert with no partition for its id fails, so partitions must exist
+ahead of time. The MessagePartitions extension makes sure the current
+month and the next MESSAGE_PARTITIONS_AHEAD months exist: once when the
+first request comes in and again when the month turns over. The same can
+be done from cron or a deploy script with
+
+    FLASK_APP=app flask create-partitions --ahead 3
+
+On other databases, or before the migration has run, this does nothing.
+"""
+
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from models import db
+from snowflake import id_for_datetime
+
+PARTITIONS_AHEAD = 3
+
+# pg_advisory_xact_lock() key serializing partition creation across workers.
+LOCK_KEY = 0x7761726231  # "warb1"
+
+
+def month_start(when):
+    """Midnight on the first of `when`'s month."""
+
+    return datetime(when.year, when.month, 1)
+
+
+def add_months(month, months):
+    """The first of the month `months` after `month` (a month_start())."""
+
+    year, index = divmod(month.month - 1 + months, 12)
+    return datetime(month.year + year, index + 1, 1)
+
+
+def month_bounds(month):
+    """[low, high) message ids of messages posted in this month."""
+
+    return id_for_datetime(month), id_for_datetime(add_months(month, 1))
+
+
+def partition_name(month, table='messages'):
+    return f"{table}_{month:%Y_%m}"
+
+
+def is_partitioned(connection, table='messages'):
+    """True if `table` is a partitioned table on this PostgreSQL database."""
+
+    if connection.dialect.name != 'postgresql':
+        return False
+
+    return connection.execute(
+        text("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p "
+             "JOIN pg_class c ON c.oid = p.partrelid "
+             "WHERE c.relname = :table AND pg_table_is_visible(c.oid))"),
+        table=table).scalar()
+
+
+def partition_names(connection, table='messages'):
+    """Names of `table`'s existing partitions."""
+
+    return {name for (name,) in connection.execute(
+        text("SELECT child.relname FROM pg_inherits i "
+             "JOIN pg_class child ON child.oid = i.inhrelid "
+             "JOIN pg_class parent ON parent.oid = i.inhparent "
+             "WHERE parent.relname = :table "
+             "AND pg_table_is_visible(parent.oid)"),
+        table=table)}
+
+
+def create_partitions(connection, first, last, table='messages'):
+    """Create any missing monthly partitions from `first` through `last`.
+
+    Takes an advisory lock for the rest of the transaction, so workers
+    racing to create the same month queue up instead of failing. Returns
+    the names of the partitions created.
+    """
+
+    connection.execute(text("SELECT pg_advisory_xact_lock(:key)"),
+                       key=LOCK_KEY)
+    existing = partition_names(connection, table)
+    created = []
+
+    month = first
+    while month <= last:
+        name = partition_name(month, table)
+        if name not in existing:
+            low, high = month_bounds(month)
+            connection.execute(f"CREATE TABLE {name} PARTITION OF {table} "
+                               f"FOR VALUES FROM ({low}) TO ({high})")
+            created.append(name)
+        month = add_months(month, 1)
+
+    return created
+
+
+def ensure_partitions(ahead=PARTITIONS_AHEAD, now=None):
+    """Make sure this month's and the next `ahead` months' partitions exist.
+
+    Returns the names created, or None if `messages` isn't partitioned.
+    """
+
+    this_month = month_start(now or datetime.utcnow())
+
+    with db.engine.begin() as connection:
+        if not is_partitioned(connection):
+            return None
+
+        return create_partitions(connection, this_month,
+                                 add_months(this_month, ahead))
+
+
+class MessagePartitions:
+    """Flask extension creating message partitions before they're needed."""
+
+    def __init__(self, app=None):
+        self.ahead = PARTITIONS_AHEAD
+        self.checked_month = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MESSAGE_PARTITIONS_AHEAD', PARTITIONS_AHEAD)
+
+        self.ahead = app.config['MESSAGE_PARTITIONS_AHEAD']
+        app.before_request(self.check)
+
+    def check(self):
+        """Ensure partitions once per worker per month; free otherwise."""
+
+        this_month = month_start(datetime.utcnow())
+        if this_month == self.checked_month:
+            return
+
+        ensure_partitions(self.ahead, this_month)
+        self.checked_month = this_month
+
+
+message_partitions = MessagePartitions()
+
+
+@click.command('create-partitions')
+@click.option('--ahead', default=PARTITIONS_AHEAD, show_default=True,
+              help="Months of partitions to create past the current one.")
+@with_appcontext
+def create_partitions_command(ahead):
+    """Create upcoming monthly partitions of the messages table."""
+
+    created = ensure_partitions(ahead)
+
+    if created is None:
+        click.echo("messages isn't partitioned; nothing to do.")
+    else:
+        for name in created:
+            click.echo(f"Created {name}.")
+        click.echo(f"Created {len(created)} partitions.")
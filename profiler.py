@@ -0,0 +1,219 @@
+"""Opt-in sampling profiler for slow Warbler requests.
+
+While enabled, a background thread wakes every PROFILE_INTERVAL seconds and
+records the Python stack of every thread that's serving a request. When a
+request finishes, its samples are written out if either:
+
+- it was picked at random (PROFILE_SAMPLE_RATE of requests), or
+- it took at least PROFILE_SLOW_MS milliseconds
+
+and thrown away otherwise. Sampling every request is what lets us keep the
+profile of a request we only find out afterwards was slow.
+
+Each capture is two files in PROFILE_DIR, named after the time, endpoint
+and duration:
+
+- `<name>.folded`: collapsed stacks ("a;b;c 12" per line), ready for
+  flamegraph.pl or speedscope
+- `<name>.sql`: the SQL statements the request ran, with their timings
+  (not their parameters, which can hold emails and password hashes)
+
+Only the newest PROFILE_KEEP captures are kept.
+"""
+
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from glob import glob
+from time import perf_counter, sleep
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class Capture:
+    """Stack samples and SQL for one in-flight request."""
+
+    __slots__ = ('start', 'sampled', 'stacks', 'statements')
+
+    def __init__(self, sampled):
+        self.start = perf_counter()
+        self.sampled = sampled
+        self.stacks = Counter()
+        self.statements = []
+
+
+def frame_name(frame):
+    """Collapsed-stack name for a frame: func (dir/file.py:line)."""
+
+    code = frame.f_code
+    path = code.co_filename.replace(';', ':')
+    short_path = os.path.join(os.path.basename(os.path.dirname(path)),
+                              os.path.basename(path))
+
+    return f"{code.co_name} ({short_path}:{code.co_firstlineno})"
+
+
+def collapse(frame):
+    """The stack ending at `frame`, root first, joined with ';'."""
+
+    names = []
+
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+class Profiler:
+    """Flask extension that samples request threads and saves slow ones."""
+
+    def __init__(self, app=None):
+        self.active = {}
+        self.thread = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('PROFILE_ENABLED',
+                          os.environ.get('PROFILE_ENABLED') == '1')
+        config.setdefault('PROFILE_SAMPLE_RATE', 0.01)
+        config.setdefault('PROFILE_SLOW_MS', 1000)
+        config.setdefault('PROFILE_INTERVAL', 0.005)
+        config.setdefault('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+        config.setdefault('PROFILE_KEEP', 100)
+
+        if not config['PROFILE_ENABLED']:
+            return
+
+        self.sample_rate = config['PROFILE_SAMPLE_RATE']
+        self.slow_seconds = config['PROFILE_SLOW_MS'] / 1000
+        self.interval = config['PROFILE_INTERVAL']
+        self.directory = config['PROFILE_DIR']
+        self.keep = config['PROFILE_KEEP']
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        app.teardown_request(self.teardown_request)
+
+        event.listen(Engine, 'before_cursor_execute', self.start_query)
+        event.listen(Engine, 'after_cursor_execute', self.finish_query)
+        event.listen(Engine, 'handle_error', self.query_failed)
+
+    # Sampler thread
+
+    def ensure_sampler(self):
+        """Start the sampler thread (lazily, so it survives forking servers)."""
+
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run,
+                                           name='warbler-profiler',
+                                           daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            frames = sys._current_frames()
+
+            for thread_id, capture in list(self.active.items()):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    capture.stacks[collapse(frame)] += 1
+
+    # Request hooks
+
+    def start_request(self):
+        self.ensure_sampler()
+        capture = Capture(sampled=random.random() < self.sample_rate)
+        g.profile_capture = capture
+        self.active[threading.get_ident()] = capture
+
+    def finish_request(self, response):
+        self.finish(response.status_code)
+        return response
+
+    def teardown_request(self, exc):
+        if exc is not None:
+            self.finish(500)
+
+    def finish(self, status):
+        capture = g.pop('profile_capture', None)
+        self.active.pop(threading.get_ident(), None)
+
+        if capture is None:
+            return
+
+        duration = perf_counter() - capture.start
+
+        if capture.sampled or duration >= self.slow_seconds:
+            self.save(capture, duration, status)
+
+    # SQL capture
+
+    def start_query(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        conn.info.setdefault('profile_query_start', []).append(perf_counter())
+
+    def finish_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        elapsed = perf_counter() - conn.info['profile_query_start'].pop()
+        capture = self.active.get(threading.get_ident())
+
+        if capture is not None:
+            capture.statements.append((elapsed, statement))
+
+    def query_failed(self, context):
+        """Drop a failed statement's start time (there's no finish_query)."""
+
+        if context.connection is not None:
+            starts = context.connection.info.get('profile_query_start')
+            if starts:
+                starts.pop()
+
+    # Output
+
+    def save(self, capture, duration, status):
+        """Write this capture's .folded and .sql files, then rotate."""
+
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        name = f"{stamp}-{request.endpoint or 'unmatched'}-{duration * 1000:.0f}ms"
+        path = os.path.join(self.directory, name)
+
+        with open(f"{path}.folded", 'w') as out:
+            for stack, count in capture.stacks.most_common():
+                out.write(f"{stack} {count}\n")
+
+        with open(f"{path}.sql", 'w') as out:
+            out.write(f"-- {request.method} {request.full_path} -> {status}, "
+                      f"{duration * 1000:.1f} ms, "
+                      f"{len(capture.statements)} statements\n\n")
+            for elapsed, statement in capture.statements:
+                out.write(f"-- {elapsed * 1000:.2f} ms\n")
+                out.write(f"{statement};\n\n")
+
+        self.rotate()
+
+    def rotate(self):
+        """Delete all but the newest `keep` captures."""
+
+        captures = sorted(glob(os.path.join(self.directory, '*.folded')))
+
+        for old in captures[:-self.keep]:
+            for path in (old, old[:-len('.folded')] + '.sql'):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+profiler = Profiler()
@@ -0,0 +1,262 @@
+"""Token-bucket rate limits for Warbler's expensive endpoints.
+
+Logging in, signing up and saving a profile each cost a bcrypt hash, and the
+user search is a table scan, so a single client can tie up a worker with
+little effort. RATELIMIT_RULES maps endpoint names to rules such as
+
+    "POST 10 per minute per ip"
+
+meaning each client IP gets a bucket of 10 tokens, refilled at 10 a minute,
+and each POST to that endpoint takes one. "per user" rules key on the
+logged-in user (read straight from the signed session, so no query) and
+fall back to the IP for anonymous requests.
+
+Behind reverse proxies every request arrives from a proxy's address, so
+set RATELIMIT_PROXIES to how many of them sit in front of the app: the
+client IP is then the address the outermost one saw, taken from
+X-Forwarded-For the way Werkzeug's ProxyFix does. Entries further left are
+whatever the client sent, and aren't trusted.
+
+Rules are checked in order, and the first empty bucket rejects the request
+without spending tokens from the rest. A request with an empty bucket gets a 429 with a Retry-After header (JSON
+inside the API), and is counted in /metrics as warbler_rate_limited_total.
+
+Buckets live in RATELIMIT_STORE. The default LocalStore keeps them in this
+process, which makes limits per worker. RedisStore shares them across
+workers and hosts, given a redis-py client.
+"""
+
+import os
+import re
+import threading
+from collections import namedtuple
+from math import ceil
+from time import monotonic, time
+
+from flask import Response, jsonify, request, session
+
+from metrics import metrics
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+RULE_RE = re.compile(
+    r'^(?:(?P<methods>[A-Z]+(?:,[A-Z]+)*) )?(?P<count>\d+) per '
+    r'(?P<period>second|minute|hour|day) per (?P<scope>ip|user)$')
+
+Rule = namedtuple('Rule', ['methods', 'count', 'period', 'scope'])
+
+DEFAULT_RULES = {
+    'login': ["POST 10 per minute per ip"],
+    'signup': ["POST 5 per minute per ip"],
+    'profile': ["POST 10 per minute per user"],
+    'list_users': ["30 per minute per ip"],
+    'export_account': ["5 per hour per user"],
+    'api.add_messages': ["POST 60 per minute per user"],
+}
+
+
+def parse_rule(text):
+    """Rule from "[METHODS] <count> per <period> per <ip|user>"."""
+
+    match = RULE_RE.match(text.strip())
+    if not match:
+        raise ValueError(f"Bad rate limit rule: {text!r}")
+
+    methods = match['methods']
+
+    return Rule(frozenset(methods.split(',')) if methods else None,
+                int(match['count']),
+                PERIODS[match['period']],
+                match['scope'])
+
+
+class LocalStore:
+    """In-process buckets, spread over independently locked shards.
+
+    Requests for different keys rarely wait on each other. Each shard holds
+    at most max_keys / shards buckets; when one fills up, buckets that
+    have refilled completely (and so act like new ones) are dropped first.
+    """
+
+    def __init__(self, shards=16, max_keys=100_000, clock=monotonic):
+        self.shards = [({}, threading.Lock()) for _ in range(shards)]
+        self.max_per_shard = max(1, max_keys // shards)
+        self.clock = clock
+
+    def take(self, key, rate, capacity):
+        """Take a token from `key`'s bucket.
+
+        Returns 0 if one was available, else how many seconds until one is.
+        """
+
+        buckets, lock = self.shards[hash(key) % len(self.shards)]
+        now = self.clock()
+
+        with lock:
+            tokens, updated, _ = buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+
+            if tokens >= 1:
+                wait = 0.0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+
+            if key not in buckets and len(buckets) >= self.max_per_shard:
+                self.evict(buckets, now)
+            buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+
+        return wait
+
+    def evict(self, buckets, now):
+        """Make room in a full shard. Caller holds its lock."""
+
+        # Buckets are (tokens, updated, full_at); a full bucket is
+        # indistinguishable from a missing one.
+        full = [key for key, (_, _, full_at) in buckets.items()
+                if full_at <= now]
+        for key in full:
+            del buckets[key]
+
+        # Still full: drop the oldest half (dicts keep insertion order).
+        if len(buckets) >= self.max_per_shard:
+            for key in list(buckets)[:len(buckets) // 2]:
+                del buckets[key]
+
+    def clear(self):
+        for buckets, lock in self.shards:
+            with lock:
+                buckets.clear()
+
+
+class RedisStore:
+    """Buckets shared through Redis, updated atomically by a Lua script."""
+
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HMSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, client, prefix='warbler:ratelimit:'):
+        self.prefix = prefix
+        self.script = client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, capacity):
+        # Wall-clock time, since it's compared across hosts.
+        return float(self.script(keys=[self.prefix + key],
+                                 args=[rate, capacity, time()]))
+
+
+class RateLimiter:
+    """Flask extension applying RATELIMIT_RULES before each request."""
+
+    def __init__(self, app=None):
+        self.rules = {}
+        self.store = None
+        self.session_key = None
+        self.proxies = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        if not config.setdefault('RATELIMIT_ENABLED', True):
+            return
+
+        config.setdefault('RATELIMIT_RULES', DEFAULT_RULES)
+        config.setdefault('RATELIMIT_SESSION_KEY', 'curr_user')
+        config.setdefault('RATELIMIT_PROXIES',
+                          int(os.environ.get('RATELIMIT_PROXIES', 0)))
+
+        self.rules = {endpoint: [parse_rule(text) for text in texts]
+                      for endpoint, texts in config['RATELIMIT_RULES'].items()}
+        self.store = config.get('RATELIMIT_STORE') or LocalStore()
+        self.session_key = config['RATELIMIT_SESSION_KEY']
+        self.proxies = config['RATELIMIT_PROXIES']
+
+        app.before_request(self.check)
+
+    def check(self):
+        """Take a token for every rule on this endpoint; 429 if any is empty."""
+
+        wait = self.wait_time(request.endpoint,
+                              request.method,
+                              self.client_ip(
+                                  request.remote_addr,
+                                  request.headers.get('X-Forwarded-For', '')),
+                              session.get(self.session_key))
+
+        return self.too_many_requests(wait) if wait else None
+
+    def client_ip(self, remote_addr, forwarded_for):
+        """The client's address, past RATELIMIT_PROXIES trusted proxies."""
+
+        if self.proxies:
+            forwarded = [ip.strip() for ip in forwarded_for.split(',')
+                         if ip.strip()]
+            if len(forwarded) >= self.proxies:
+                return forwarded[-self.proxies]
+
+        return remote_addr
+
+    def wait_time(self, endpoint, method, ip, user_id=None):
+        """Spend tokens for this request; seconds until allowed, 0 if it is.
+
+        "per user" rules use `user_id` when there is one, else `ip`. Stops
+        at the first rule that rejects, so later buckets aren't drained by
+        requests that never run.
+        """
+
+        for i, rule in enumerate(self.rules.get(endpoint, ())):
+            if rule.methods and method not in rule.methods:
+                continue
+
+            if rule.scope == 'user' and user_id is not None:
+                client = f"user:{user_id}"
+            else:
+                client = f"ip:{ip}"
+
+            rule_wait = self.store.take(f"{endpoint}:{i}:{client}",
+                                        rule.count / rule.period,
+                                        rule.count)
+
+            if rule_wait:
+                metrics.increment('warbler_rate_limited_total',
+                                  'Requests rejected by rate limits.',
+                                  route=endpoint,
+                                  scope=rule.scope)
+                return rule_wait
+
+        return 0.0
+
+    def too_many_requests(self, wait):
+        retry_after = max(1, ceil(wait))
+        message = f"Too many requests. Try again in {retry_after} seconds."
+
+        if request.blueprint == 'api':
+            response = jsonify(error=message)
+        else:
+            response = Response(message, mimetype='text/plain')
+
+        response.status_code = 429
+        response.headers['Retry-After'] = str(retry_after)
+
+        return response
+
+
+limiter = RateLimiter()
@@ -1,8 +1,10 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
+from datetime import datetime
 from app import db
 from models import User, Message, Follows, Likes
+from snowflake import id_for_datetime
 
 
 db.drop_all()
@@ -12,14 +14,19 @@ with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    # give each message the time-ordered id it would have got when posted
+    message_rows = list(DictReader(messages))
+    for i, row in enumerate(message_rows):
+        row['timestamp'] = datetime.fromisoformat(row['timestamp'])
+        row['id'] = id_for_datetime(row['timestamp'], sequence=i)
+    db.session.bulk_insert_mappings(Message, message_rows)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
 db.session.commit()
 
-like1 = Likes(user_id=2, message_id=222)
+like1 = Likes(user_id=2, message_id=message_rows[221]['id'])
 #like2 = Likes(user_id=301, message_id=588)
 
 db.session.add(like1)
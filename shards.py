@@ -0,0 +1,406 @@
+"""User-sharded storage for messages and likes.
+
+With MESSAGE_SHARDS set (shard name -> database URL), `messages` and
+`likes` rows live on those databases instead of the main one. Each message
+lives on its author's shard, and each like lives with the message it likes,
+so one person's profile is one shard's (user_id, id) index and a page's
+like counts are grouped where the messages are. Users, follows, tags,
+notifications and everything else stay on the main database.
+
+Authors are assigned to shards by a consistent-hash ring: every shard owns
+MESSAGE_SHARD_REPLICAS points on it, and a user belongs to the shard owning
+the first point at or after the hash of their id. Adding a shard takes
+points (and so users) from every existing shard, about 1/N of them in all,
+and moves nobody else. After changing MESSAGE_SHARDS, run
+
+    FLASK_APP=app flask create-shard-tables
+    FLASK_APP=app flask rebalance-shards
+
+to create the tables on new shards and move each user's messages (and their
+likes) to the shard the ring now gives them. Until that's done, a moving
+user's older messages are missing from their pages. Shard names are ring
+keys: renaming a shard moves its users too.
+
+Reads that need several shards (a home timeline of people spread across
+them, a person's likes, the like counts for a page) scatter one query per
+shard over a thread pool and merge the results; see feeds.py. Pages found
+through the main database's tag and mention indexes, and notifications,
+look their messages up on the shards by id. Every message and like read
+and write goes through here, except:
+
+- `flask archive-messages`, which refuses to run: shards keep all their
+  messages in their `messages` table
+- the ASGI app's async pages, which hand anything showing messages to
+  Flask
+
+Without MESSAGE_SHARDS, this does nothing and the main database holds it all.
+"""
+
+import bisect
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Column, Index, MetaData, Table, UniqueConstraint, \
+    create_engine, distinct, select
+from sqlalchemy.orm import sessionmaker
+
+from models import Message, Likes
+
+REPLICAS = 64
+REBALANCE_BATCH = 1000
+
+SHARDED_TABLES = (Message.__table__, Likes.__table__)
+
+
+def ring_hash(key):
+    """Position of `key` (a str) on the ring: 64 bits of its MD5."""
+
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent-hash map from user ids to shard names."""
+
+    def __init__(self, names, replicas=REPLICAS):
+        self.names = sorted(names)
+        points = sorted((ring_hash(f"{name}#{replica}"), name)
+                        for name in self.names
+                        for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.owners = [name for _, name in points]
+
+    def shard_for(self, user_id):
+        """Name of the shard holding this user's messages."""
+
+        index = bisect.bisect(self.hashes, ring_hash(str(user_id)))
+        return self.owners[index % len(self.owners)]
+
+
+def parse_shards(value):
+    """{name: url} from "name=url,name=url" (as in the environment)."""
+
+    return dict(item.split('=', 1) for item in value.split(',') if item)
+
+
+def shard_metadata():
+    """The sharded tables, without their foreign keys to the main database."""
+
+    metadata = MetaData()
+
+    for table in SHARDED_TABLES:
+        copy = Table(table.name, metadata,
+                     *[Column(column.name, column.type,
+                              primary_key=column.primary_key,
+                              nullable=column.nullable,
+                              autoincrement=column.autoincrement)
+                       for column in table.columns])
+
+        for constraint in table.constraints:
+            if isinstance(constraint, UniqueConstraint):
+                UniqueConstraint(*[copy.c[column.name]
+                                   for column in constraint.columns],
+                                 name=constraint.name)
+        for index in table.indexes:
+            Index(index.name,
+                  *[copy.c[column.name] for column in index.columns],
+                  unique=index.unique)
+
+    return metadata
+
+
+class MessageShards:
+    """Flask extension routing messages and likes to their author's shard."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.ring = None
+        self.engines = {}
+        self.sessions = {}
+        self.executor = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('MESSAGE_SHARDS',
+                          parse_shards(os.environ.get('MESSAGE_SHARDS', '')))
+        config.setdefault('MESSAGE_SHARD_REPLICAS', REPLICAS)
+        config.setdefault('MESSAGE_SHARD_WORKERS', 8)
+
+        self.configure(config['MESSAGE_SHARDS'],
+                       config['MESSAGE_SHARD_REPLICAS'],
+                       config['MESSAGE_SHARD_WORKERS'])
+
+    def configure(self, urls, replicas=REPLICAS, workers=8):
+        """(Re)connect to these shards; an empty `urls` turns sharding off."""
+
+        for engine in self.engines.values():
+            engine.dispose()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+        self.engines = {name: create_engine(url) for name, url in urls.items()}
+        self.sessions = {name: sessionmaker(bind=engine, expire_on_commit=False)
+                         for name, engine in self.engines.items()}
+        self.ring = HashRing(urls, replicas) if urls else None
+        self.executor = ThreadPoolExecutor(workers) if urls else None
+        self.enabled = bool(urls)
+
+    # Routing
+
+    def shard_for(self, user_id):
+        return self.ring.shard_for(user_id)
+
+    def by_author(self, user_ids):
+        """{shard name: [user ids]} for these authors."""
+
+        shards = {}
+        for user_id in user_ids:
+            shards.setdefault(self.shard_for(user_id), []).append(user_id)
+
+        return shards
+
+    @contextmanager
+    def session(self, name):
+        """A session on this shard; commits if the block succeeds."""
+
+        session = self.sessions[name]()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def scatter(self, calls):
+        """Run {shard name: fn(session)} in parallel; {name: result}.
+
+        Each call gets its own session on its shard, committed afterwards.
+        """
+
+        def run(name, fn):
+            with self.session(name) as session:
+                return fn(session)
+
+        futures = {name: self.executor.submit(run, name, fn)
+                   for name, fn in calls.items()}
+
+        return {name: future.result() for name, future in futures.items()}
+
+    def everywhere(self, fn):
+        """scatter() the same fn(session) to every shard."""
+
+        return self.scatter(dict.fromkeys(self.engines, fn))
+
+    def locate(self, message_ids):
+        """{message_id: shard name} for those of these messages that exist."""
+
+        ids = list(message_ids)
+
+        def found(session):
+            return [message_id for (message_id,) in (session
+                                                     .query(Message.id)
+                                                     .filter(Message.id.in_(ids)))]
+
+        return {message_id: name
+                for name, found_ids in self.everywhere(found).items()
+                for message_id in found_ids}
+
+    def messages(self, message_ids, *columns):
+        """Rows of these Message `columns` for those of these messages that
+        exist, from whichever shards have them (in no particular order).
+        """
+
+        ids = list(message_ids)
+        if not ids:
+            return []
+
+        def fetch(session):
+            return (session
+                    .query(*columns)
+                    .filter(Message.id.in_(ids))
+                    .all())
+
+        return list(chain.from_iterable(self.everywhere(fetch).values()))
+
+    # Messages
+
+    def add_message(self, user_id, text):
+        """Write a new message to its author's shard; returns it (detached)."""
+
+        with self.session(self.shard_for(user_id)) as session:
+            message = Message(text=text, user_id=user_id)
+            session.add(message)
+
+        return message
+
+    def insert_messages(self, user_id, rows):
+        """Insert message rows (dicts, ids included) by this author."""
+
+        with self.session(self.shard_for(user_id)) as session:
+            session.execute(Message.__table__.insert().values(rows))
+
+    def find(self, message_id):
+        """The Message with this id (detached), or None."""
+
+        found = self.everywhere(lambda session: session.query(Message)
+                                                .get(message_id))
+
+        return next((msg for msg in found.values() if msg is not None), None)
+
+    def delete_message(self, message_id):
+        """Delete a message and its likes from whichever shard has it."""
+
+        def delete(session):
+            session.execute(Likes.__table__.delete()
+                            .where(Likes.message_id == message_id))
+            session.execute(Message.__table__.delete()
+                            .where(Message.id == message_id))
+
+        self.everywhere(delete)
+
+    def delete_user(self, user_id):
+        """Delete this user's messages (with their likes) and likes.
+
+        Returns the ids of the deleted messages, whose rows on the main
+        database (see models.delete_message_rows) are the caller's to delete.
+        """
+
+        def delete(session):
+            ids = [message_id for (message_id,) in (session
+                                                    .query(Message.id)
+                                                    .filter(Message.user_id
+                                                            == user_id))]
+            session.execute(Likes.__table__.delete()
+                            .where(Likes.user_id == user_id))
+            if ids:
+                session.execute(Likes.__table__.delete()
+                                .where(Likes.message_id.in_(ids)))
+                session.execute(Message.__table__.delete()
+                                .where(Message.id.in_(ids)))
+            return ids
+
+        return list(chain.from_iterable(self.everywhere(delete).values()))
+
+    # Setup and rebalancing
+
+    def create_all(self):
+        """Create the sharded tables on every shard that lacks them."""
+
+        metadata = shard_metadata()
+        for engine in self.engines.values():
+            metadata.create_all(engine)
+
+    def misplaced_users(self, name):
+        """Authors with messages on shard `name` that the ring puts elsewhere."""
+
+        with self.session(name) as session:
+            authors = [user_id for (user_id,)
+                       in session.query(distinct(Message.user_id))]
+
+        return [user_id for user_id in authors
+                if self.shard_for(user_id) != name]
+
+    def move_batch(self, source, user_id, batch=REBALANCE_BATCH):
+        """Move up to `batch` of a user's messages, with their likes, off
+        `source` to the shard the ring gives them. Returns how many moved.
+
+        Copies, commits on the target, then deletes from the source, so an
+        interrupted move leaves copies on both and is finished by re-running.
+        """
+
+        messages = Message.__table__
+        likes = Likes.__table__
+
+        with self.session(source) as session:
+            rows = [dict(row) for row in session.execute(
+                messages.select()
+                .where(messages.c.user_id == user_id)
+                .order_by(messages.c.id)
+                .limit(batch))]
+            ids = [row['id'] for row in rows]
+            like_rows = [dict(row) for row in session.execute(
+                likes.select().where(likes.c.message_id.in_(ids)))] if ids else []
+
+        if not rows:
+            return 0
+
+        with self.session(self.shard_for(user_id)) as session:
+            copied = {message_id for (message_id,) in session.execute(
+                select([messages.c.id]).where(messages.c.id.in_(ids)))}
+            rows = [row for row in rows if row['id'] not in copied]
+            like_rows = [row for row in like_rows
+                         if row['message_id'] not in copied]
+
+            if rows:
+                session.execute(messages.insert(), rows)
+            for row in like_rows:
+                # Like ids are per database; let the target number them.
+                del row['id']
+            if like_rows:
+                session.execute(likes.insert(), like_rows)
+
+        with self.session(source) as session:
+            session.execute(likes.delete().where(likes.c.message_id.in_(ids)))
+            session.execute(messages.delete().where(messages.c.id.in_(ids)))
+
+        return len(ids)
+
+    def rebalance(self, batch=REBALANCE_BATCH, progress=None):
+        """Move every misplaced message to its author's shard; returns how
+        many moved. `progress`, if given, is called with the running total.
+        """
+
+        done = 0
+
+        for name in self.ring.names:
+            for user_id in self.misplaced_users(name):
+                while True:
+                    moved = self.move_batch(name, user_id, batch)
+                    if not moved:
+                        break
+                    done += moved
+                    if progress:
+                        progress(done)
+
+        return done
+
+
+message_shards = MessageShards()
+
+
+@click.command('create-shard-tables')
+@with_appcontext
+def create_shard_tables_command():
+    """Create the messages and likes tables on every message shard."""
+
+    if not message_shards.enabled:
+        raise click.ClickException("MESSAGE_SHARDS isn't set.")
+
+    message_shards.create_all()
+    click.echo(f"Shards ready: {', '.join(message_shards.ring.names)}.")
+
+
+@click.command('rebalance-shards')
+@click.option('--batch', default=REBALANCE_BATCH, show_default=True,
+              help="Messages moved per transaction.")
+@with_appcontext
+def rebalance_shards_command(batch):
+    """Move messages to the shard each author now hashes to."""
+
+    if not message_shards.enabled:
+        raise click.ClickException("MESSAGE_SHARDS isn't set.")
+
+    def progress(done):
+        click.echo(f"{done} messages...", err=True)
+
+    done = message_shards.rebalance(batch, progress)
+    click.echo(f"Moved {done} messages.")
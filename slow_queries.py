@@ -0,0 +1,267 @@
+"""Slow-query log with EXPLAIN plans and a top-N report.
+
+Any statement slower than SLOW_QUERY_MS is logged (to the
+`warbler.slow_queries` logger) along with:
+
+- its fingerprint: the SQL with literals and placeholders replaced by `?`
+  and `IN (...)` lists collapsed, so every call of the same query groups
+  together however many ids it was passed
+- the shape of its bound parameters (names and types, never values)
+- the line of our code that ran it
+- its EXPLAIN plan, fetched at most once per fingerprint every
+  SLOW_QUERY_EXPLAIN_EVERY seconds
+
+Slow statements are also aggregated per fingerprint; the worst
+SLOW_QUERY_TOP_N by total time are served as plain text at
+SLOW_QUERY_REPORT_URL, to the same requests as /metrics (METRICS_TOKEN
+or METRICS_ALLOWED_IPS, see metrics.py).
+"""
+
+import hashlib
+import logging
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from time import monotonic, perf_counter
+
+from flask import Response
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import check_access
+
+logger = logging.getLogger('warbler.slow_queries')
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+EXPLAINABLE = ('select', 'with')
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s|(?<!:):\w+|\$\d+|\?")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN \(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_SPACE = re.compile(r"\s+")
+_PARAM_SUFFIX = re.compile(r"_\d+$")
+
+
+def fingerprint(statement):
+    """Normalize a SQL statement so calls of the same query compare equal."""
+
+    sql = _STRING.sub('?', statement)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+
+    return _SPACE.sub(' ', sql).strip()
+
+
+def param_shape(parameters):
+    """Describe bound parameters by name and type, e.g. 'user_id:int×3'."""
+
+    if isinstance(parameters, dict):
+        kinds = Counter((_PARAM_SUFFIX.sub('', name), type(value).__name__)
+                        for name, value in parameters.items())
+        parts = [f"{name}:{kind}" + (f"×{n}" if n > 1 else '')
+                 for (name, kind), n in sorted(kinds.items())]
+    else:
+        kinds = Counter(type(value).__name__ for value in parameters or ())
+        parts = [kind + (f"×{n}" if n > 1 else '')
+                 for kind, n in sorted(kinds.items())]
+
+    return ', '.join(parts) or '-'
+
+
+def call_site():
+    """file:line function of the innermost frame in our own code."""
+
+    frame = sys._getframe(1)
+
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if (path.startswith(PROJECT_DIR)
+                and path != __file__
+                and 'site-packages' not in path):
+            return (f"{os.path.relpath(path, PROJECT_DIR)}:{frame.f_lineno} "
+                    f"{frame.f_code.co_name}")
+        frame = frame.f_back
+
+    return 'unknown'
+
+
+class QueryStats:
+    """Aggregated slow calls of one fingerprint."""
+
+    __slots__ = ('sql', 'calls', 'total', 'max', 'shapes', 'call_sites',
+                 'plan', 'explained_at')
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.shapes = Counter()
+        self.call_sites = Counter()
+        self.plan = None
+        self.explained_at = None
+
+
+class SlowQueryLog:
+    """Flask extension that logs and aggregates slow SQL statements."""
+
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('SLOW_QUERY_MS', 200)
+        config.setdefault('SLOW_QUERY_EXPLAIN_EVERY', 300)
+        config.setdefault('SLOW_QUERY_TOP_N', 20)
+        config.setdefault('SLOW_QUERY_REPORT_URL', '/metrics/slow-queries')
+
+        if config['SLOW_QUERY_MS'] is None:
+            return
+
+        self.threshold = config['SLOW_QUERY_MS'] / 1000
+        self.explain_every = config['SLOW_QUERY_EXPLAIN_EVERY']
+        self.top_n = config['SLOW_QUERY_TOP_N']
+
+        event.listen(Engine, 'before_cursor_execute', self.start_query)
+        event.listen(Engine, 'after_cursor_execute', self.finish_query)
+        event.listen(Engine, 'handle_error', self.query_failed)
+
+        app.add_url_rule(config['SLOW_QUERY_REPORT_URL'],
+                         'slow_queries',
+                         self.render)
+
+    def start_query(self, conn, cursor, statement, parameters, context,
+                    executemany):
+        conn.info.setdefault('slow_query_start', []).append(perf_counter())
+
+    def finish_query(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        elapsed = perf_counter() - conn.info['slow_query_start'].pop()
+
+        if elapsed >= self.threshold:
+            self.record(conn, statement, parameters, elapsed, executemany)
+
+    def query_failed(self, context):
+        """Drop a failed statement's start time (there's no finish_query)."""
+
+        if context.connection is not None:
+            starts = context.connection.info.get('slow_query_start')
+            if starts:
+                starts.pop()
+
+    def record(self, conn, statement, parameters, elapsed, executemany):
+        """Log one slow statement and fold it into its fingerprint's stats."""
+
+        sql = fingerprint(statement)
+        key = hashlib.md5(sql.encode()).hexdigest()[:12]
+        shape = 'executemany' if executemany else param_shape(parameters)
+        site = call_site()
+
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = QueryStats(sql)
+
+            stats.calls += 1
+            stats.total += elapsed
+            stats.max = max(stats.max, elapsed)
+            stats.shapes[shape] += 1
+            stats.call_sites[site] += 1
+
+            now = monotonic()
+            explain = (not executemany
+                       and (stats.explained_at is None
+                            or now - stats.explained_at >= self.explain_every))
+            if explain:
+                stats.explained_at = now
+
+        if explain:
+            stats.plan = self.explain(conn, statement, parameters)
+
+        plan = f"\n  plan:\n{indent(stats.plan)}" if explain and stats.plan else ''
+        logger.warning("slow query %s (%.1f ms) at %s\n  %s\n  params: %s%s",
+                       key, elapsed * 1000, site, sql, shape, plan)
+
+    def explain(self, conn, statement, parameters):
+        """EXPLAIN `statement` on the same connection; the plan as text.
+
+        Runs on a separate DBAPI cursor, so it doesn't disturb the results of
+        the query being explained, and (on PostgreSQL) inside a savepoint, so
+        a failing EXPLAIN can't abort the caller's transaction.
+        """
+
+        if not statement.lstrip().lower().startswith(EXPLAINABLE):
+            return None
+
+        dialect = conn.dialect.name
+        prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+        cursor = conn.connection.cursor()
+
+        try:
+            if dialect == 'postgresql':
+                cursor.execute('SAVEPOINT slow_query_explain')
+            try:
+                cursor.execute(prefix + statement, parameters)
+                rows = cursor.fetchall()
+            except Exception as exc:
+                if dialect == 'postgresql':
+                    cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                return f"(EXPLAIN failed: {exc})"
+            if dialect == 'postgresql':
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        finally:
+            cursor.close()
+
+        return '\n'.join(' '.join(str(col) for col in row) for row in rows)
+
+    def report(self, n=None):
+        """The worst `n` fingerprints by total time, as text."""
+
+        with self.lock:
+            worst = sorted(self.stats.items(),
+                           key=lambda item: item[1].total,
+                           reverse=True)[:n or self.top_n]
+
+        lines = [f"# slowest statements by total time "
+                 f"(threshold {self.threshold * 1000:.0f} ms)"]
+
+        for rank, (key, stats) in enumerate(worst, 1):
+            lines.append('')
+            lines.append(f"{rank}. [{key}] {stats.total:.3f} s total, "
+                         f"{stats.calls} calls, "
+                         f"{stats.total / stats.calls * 1000:.1f} ms avg, "
+                         f"{stats.max * 1000:.1f} ms max")
+            lines.append(f"   {stats.sql}")
+            for shape, calls in stats.shapes.most_common(3):
+                lines.append(f"   params: {shape} ({calls} calls)")
+            for site, calls in stats.call_sites.most_common(3):
+                lines.append(f"   from: {site} ({calls} calls)")
+            if stats.plan:
+                lines.append("   plan:")
+                lines.append(indent(stats.plan, '     '))
+
+        return '\n'.join(lines) + '\n'
+
+    def render(self):
+        """The report view."""
+
+        check_access()
+        return Response(self.report(), content_type='text/plain; charset=utf-8')
+
+
+def indent(text, prefix='    '):
+    """Indent every line of `text`."""
+
+    return '\n'.join(prefix + line for line in (text or '').splitlines())
+
+
+slow_queries = SlowQueryLog()
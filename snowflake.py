@@ -0,0 +1,185 @@
+"""Time-ordered 64-bit ids ("Snowflake" style) for messages.
+
+An id packs, from the most significant bit down:
+
+- 41 bits: milliseconds since EPOCH (good until 2084)
+- 10 bits: worker id, so processes never hand out the same id
+- 12 bits: per-millisecond sequence number within that worker
+
+so sorting by id sorts by creation time, and ids can be generated in-process
+with no round trip to the database.
+
+Two processes holding the same worker id would hand out the same ids, so
+each process claims its worker id explicitly, by taking an exclusive lock
+on `worker-<id>.lock` in WORKER_ID_DIR for as long as it lives:
+
+- WORKER_ID=n claims exactly n, and fails loudly if another process on
+  this host already holds it (e.g. forked workers sharing the variable).
+- Otherwise the process claims the lowest free id in WORKER_ID_RANGE
+  ("first-last", default 0-1023), so forked workers get one each.
+
+Locks only exclude processes on one host. Multi-host deployments must give
+every host its own, non-overlapping WORKER_ID_RANGE (or WORKER_ID).
+"""
+
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+EPOCH_MS = 1420070400000  # 2015-01-01T00:00:00Z, before any Warbler data
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+
+def pack(ms, worker_id, sequence):
+    """Build an id from its parts."""
+
+    return ((ms - EPOCH_MS) << TIMESTAMP_SHIFT
+            | worker_id << SEQUENCE_BITS
+            | sequence)
+
+
+def datetime_to_ms(when):
+    """Milliseconds since the Unix epoch for a naive UTC datetime."""
+
+    return (when - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+
+
+def id_for_datetime(when, sequence=0, worker_id=0):
+    """The id a message created at `when` (naive UTC) would have had.
+
+    For backfilling rows that predate snowflake ids.
+    """
+
+    return pack(datetime_to_ms(when), worker_id, sequence & MAX_SEQUENCE)
+
+
+def datetime_of(snowflake_id):
+    """Naive UTC creation time encoded in an id (to the millisecond)."""
+
+    ms = (snowflake_id >> TIMESTAMP_SHIFT) + EPOCH_MS
+    return datetime.utcfromtimestamp(ms / 1000)
+
+
+class IdGenerator:
+    """Thread-safe generator of ids for one worker."""
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be 0..{MAX_WORKER_ID}")
+
+        self.worker_id = worker_id
+        self.lock = threading.Lock()
+        self.last_ms = -1
+        self.sequence = 0
+
+    def __call__(self):
+        with self.lock:
+            ms = time.time_ns() // 1_000_000
+
+            # Never go back in time (NTP adjustments): reuse the last
+            # millisecond and keep counting instead.
+            if ms < self.last_ms:
+                ms = self.last_ms
+
+            if ms == self.last_ms:
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # 4096 ids this millisecond already; wait for the next.
+                    while ms <= self.last_ms:
+                        ms = time.time_ns() // 1_000_000
+            else:
+                self.sequence = 0
+
+            self.last_ms = ms
+            return pack(ms, self.worker_id, self.sequence)
+
+
+def parse_range(value):
+    """Worker ids in a "first-last" range (inclusive)."""
+
+    first, _, last = value.partition('-')
+    return range(int(first), int(last or first) + 1)
+
+
+def claim_worker_id(candidates, directory):
+    """Lock and return the first of `candidates` no live process holds.
+
+    The lock is kept (its file left open) until this process exits.
+    Raises RuntimeError if they're all taken.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+
+    for worker_id in candidates:
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be 0..{MAX_WORKER_ID}")
+
+        fd = os.open(os.path.join(directory, f"worker-{worker_id}.lock"),
+                     os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+
+        _claims.append(fd)
+        return worker_id
+
+    raise RuntimeError(f"No free worker id in {candidates} "
+                       f"(locks in {directory}); set WORKER_ID_RANGE")
+
+
+_claims = []
+_worker_id = None
+_worker_id_pid = None
+
+
+def default_worker_id():
+    """This process' worker id, claimed on first use (see module docs)."""
+
+    global _worker_id, _worker_id_pid
+
+    if _worker_id_pid != os.getpid():
+        directory = os.environ.get(
+            'WORKER_ID_DIR',
+            os.path.join(tempfile.gettempdir(), 'warbler-worker-ids'))
+
+        if os.environ.get('WORKER_ID') is not None:
+            candidates = [int(os.environ['WORKER_ID'])]
+        else:
+            candidates = parse_range(os.environ.get('WORKER_ID_RANGE',
+                                                    f"0-{MAX_WORKER_ID}"))
+
+        _worker_id = claim_worker_id(candidates, directory)
+        _worker_id_pid = os.getpid()
+
+    return _worker_id
+
+
+_generator = None
+_generator_pid = None
+
+
+def next_id():
+    """A fresh id from this process' generator.
+
+    The generator is (re)created per pid so forked workers don't inherit
+    their parent's worker id.
+    """
+
+    global _generator, _generator_pid
+
+    if _generator_pid != os.getpid():
+        _generator = IdGenerator(default_worker_id())
+        _generator_pid = os.getpid()
+
+    return _generator()
@@ -0,0 +1,255 @@
+"""Hashtag and mention index.
+
+Message text is opaque to the database, so finding every warble with
+`#python` or mentioning `@alice` would mean a LIKE scan of the whole
+messages table. Instead, when a message is written we pull out its
+hashtags and mentions and record them in two index tables:
+
+- message_tags:     (tag, message_id), tags lowercased
+- message_mentions: (user_id, message_id), for mentions of existing users
+
+whose primary keys are exactly the tag and mention timelines' access path:
+newest first by message id, seeking past the previous page's last id.
+
+Messages written before the index existed are filled in by
+
+    FLASK_APP=app flask backfill-tags --workers 4
+
+which splits the messages table and the archive into id ranges of
+--chunk messages and indexes them in parallel worker processes. It only
+ever inserts missing rows, so it can be re-run or interrupted safely. With message shards (see
+shards.py), it reads each shard in turn, then the archive, --chunk
+messages at a time, in one process.
+"""
+
+import re
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote
+
+import click
+from flask.cli import with_appcontext
+from jinja2 import Markup, escape
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import db, User, Message, ArchivedMessage, MessageTag, \
+    MessageMention
+from shards import message_shards
+
+# A tag or mention starts a word: "#tag", "(#tag", not "a#b" or "##b".
+# A tag is word characters, at most as many as message_tags.tag holds; a
+# longer one isn't a tag at all, rather than a different, truncated one.
+HASHTAG_RE = re.compile(r'(?<![\w#&])#(\w{1,100})(?!\w)')
+# Usernames aren't restricted, but a mention is taken to be word characters
+# with inner dots or dashes ("@bob.smith", "@bob-x"), so punctuation after
+# one ("@bob.", "@bob--") isn't part of it. Followed by "@" it's an address.
+MENTION_RE = re.compile(r'(?<![\w@])@(\w(?:[\w.-]*\w)?)(?![.-]*[\w@])')
+
+BACKFILL_CHUNK = 10000
+
+# Archived messages keep their tags and mentions too.
+BACKFILL_MODELS = {'messages': Message, 'archive': ArchivedMessage}
+
+
+def hashtags(text):
+    """Normalized (lowercase) hashtags in `text`."""
+
+    return {tag.lower() for tag in HASHTAG_RE.findall(text)}
+
+
+def mentions(text):
+    """Usernames mentioned in `text`, as written."""
+
+    return set(MENTION_RE.findall(text))
+
+
+def insert_new(table, rows):
+    """Insert index rows (dicts), skipping any that already exist."""
+
+    if not rows:
+        return
+
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        statement = pg_insert(table).values(rows).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE').values(rows)
+    else:
+        statement = table.insert().prefix_with('IGNORE').values(rows)
+
+    db.session.execute(statement)
+
+
+def index_messages(messages):
+    """Index the tags and mentions of (id, text) pairs. Doesn't commit."""
+
+    tag_rows = []
+    mentioned = {}
+
+    for message_id, text in messages:
+        tag_rows.extend(dict(tag=tag, message_id=message_id)
+                        for tag in hashtags(text))
+        for username in mentions(text):
+            mentioned.setdefault(username, []).append(message_id)
+
+    mention_rows = []
+    if mentioned:
+        users = (db.session
+                 .query(User.username, User.id)
+                 .filter(User.username.in_(list(mentioned))))
+        for username, user_id in users:
+            mention_rows.extend(dict(user_id=user_id, message_id=message_id)
+                                for message_id in mentioned[username])
+
+    insert_new(MessageTag.__table__, tag_rows)
+    insert_new(MessageMention.__table__, mention_rows)
+
+
+def tag_links(text):
+    """Jinja filter: message text, escaped, with hashtags linked."""
+
+    def link(match):
+        tag = match.group(1)
+        return f'<a href="/tags/{quote(tag.lower())}">#{tag}</a>'
+
+    return Markup(HASHTAG_RE.sub(link, str(escape(text))))
+
+
+##############################################################################
+# Backfill
+
+
+def chunk_bounds(chunk, model=Message):
+    """(after, through) id ranges of `model` of about `chunk` rows each."""
+
+    after = None
+
+    while True:
+        ids = db.session.query(model.id).order_by(model.id)
+        if after is not None:
+            ids = ids.filter(model.id > after)
+
+        last = ids.offset(chunk - 1).limit(1).scalar()
+
+        if last is None:
+            # The remainder, if any, is one last short chunk.
+            if ids.limit(1).scalar() is not None:
+                yield after, None
+            return
+
+        yield after, last
+        after = last
+
+
+def backfill_chunk(bounds):
+    """Index one chunk: a (table, after, through) of BACKFILL_MODELS' names
+    and an id range (after, through]. Returns how many messages it had.
+    """
+
+    table, after, through = bounds
+    model = BACKFILL_MODELS[table]
+    rows = db.session.query(model.id, model.text)
+    if after is not None:
+        rows = rows.filter(model.id > after)
+    if through is not None:
+        rows = rows.filter(model.id <= through)
+
+    messages = rows.all()
+    index_messages(messages)
+    db.session.commit()
+
+    return len(messages)
+
+
+def all_chunk_bounds(chunk, models=BACKFILL_MODELS):
+    """backfill_chunk() arguments covering every table in `models`."""
+
+    return [(table, after, through)
+            for table, model in models.items()
+            for after, through in chunk_bounds(chunk, model)]
+
+
+def worker_init():
+    """Per-process setup for backfill workers."""
+
+    from app import app  # here, since app.py imports this module
+
+    app.app_context().push()
+    # Connections inherited from the parent can't be shared across processes.
+    db.engine.dispose()
+
+
+def backfill(workers=4, chunk=BACKFILL_CHUNK, progress=None):
+    """Index every existing message; returns how many were processed.
+
+    `progress`, if given, is called with the running total after each chunk.
+    """
+
+    if message_shards.enabled:
+        return add_up(sharded_backfill_chunks(chunk), progress)
+
+    bounds = all_chunk_bounds(chunk)
+    db.session.remove()
+
+    if workers <= 1:
+        return add_up(map(backfill_chunk, bounds), progress)
+
+    with ProcessPoolExecutor(workers, initializer=worker_init) as executor:
+        return add_up(executor.map(backfill_chunk, bounds), progress)
+
+
+def sharded_backfill_chunks(chunk):
+    """Index each shard's messages, `chunk` at a time; yields each's size.
+
+    Then the archive, which stays in the main database (archiving isn't
+    done with shards, but may have been before them).
+    """
+
+    for name in message_shards.ring.names:
+        after = None
+
+        while True:
+            with message_shards.session(name) as session:
+                rows = session.query(Message.id, Message.text)
+                if after is not None:
+                    rows = rows.filter(Message.id > after)
+                rows = rows.order_by(Message.id).limit(chunk).all()
+
+            if not rows:
+                break
+
+            index_messages(rows)
+            db.session.commit()
+            after = rows[-1].id
+
+            yield len(rows)
+
+    archive = {'archive': ArchivedMessage}
+    yield from map(backfill_chunk, all_chunk_bounds(chunk, archive))
+
+
+def add_up(counts, progress=None):
+    done = 0
+
+    for count in counts:
+        done += count
+        if progress:
+            progress(done)
+
+    return done
+
+
+@click.command('backfill-tags')
+@click.option('--workers', default=4, show_default=True,
+              help="Worker processes.")
+@click.option('--chunk', default=BACKFILL_CHUNK, show_default=True,
+              help="Messages per unit of work.")
+@with_appcontext
+def backfill_tags_command(workers, chunk):
+    """Index hashtags and mentions of messages written before the index."""
+
+    def progress(done):
+        click.echo(f"{done} messages...", err=True)
+
+    done = backfill(workers, chunk, progress)
+    click.echo(f"Indexed {done} messages.")
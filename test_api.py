@@ -0,0 +1,160 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api.py
+
+
+import json
+import os
+from unittest import TestCase
+
+from models import db, Message, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+
+class APITestCase(TestCase):
+    """Test views under /api/v1"""
+
+    def setUp(self):
+        """testuser_one follows testuser_two, who has five messages."""
+
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User.signup("testuser_one", "test1@test.com", "testuser1", None)
+        u2 = User.signup("testuser_two", "test2@test.com", "testuser2", None)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u2.id,
+                               user_following_id=u1.id))
+        db.session.add_all([Message(text=f"warble {i}", user_id=u2.id)
+                            for i in range(5)])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def get_json(self, url, **params):
+        resp = self.client.get(url, query_string=params)
+        return resp.status_code, json.loads(resp.get_data(as_text=True))
+
+    def test_timeline_not_logged_in(self):
+        """/api/v1/timeline needs a session"""
+
+        status, body = self.get_json("/api/v1/timeline")
+        self.assertEqual(status, 401)
+        self.assertIn("error", body)
+
+    def test_timeline_pages(self):
+        """Following next_cursor visits every message exactly once"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        texts = []
+        cursor = ""
+
+        while cursor is not None:
+            status, body = self.get_json("/api/v1/timeline", limit=2, cursor=cursor)
+            self.assertEqual(status, 200)
+            self.assertLessEqual(len(body["data"]), 2)
+            texts += [item["text"] for item in body["data"]]
+            cursor = body["next_cursor"]
+
+        self.assertEqual(sorted(texts), [f"warble {i}" for i in range(5)])
+
+    def test_fields(self):
+        """?fields= limits each item to those fields"""
+
+        status, body = self.get_json(f"/api/v1/users/{self.u2_id}/messages",
+                                     fields="id,text")
+        self.assertEqual(status, 200)
+        self.assertEqual(set(body["data"][0]), {"id", "text"})
+
+        status, body = self.get_json(f"/api/v1/users/{self.u2_id}/messages",
+                                     fields="password")
+        self.assertEqual(status, 400)
+
+    def test_followers(self):
+        """/api/v1/users/<id>/followers lists followers"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        status, body = self.get_json(f"/api/v1/users/{self.u2_id}/followers")
+        self.assertEqual(status, 200)
+        self.assertEqual([u["username"] for u in body["data"]], ["testuser_one"])
+        self.assertIsNone(body["next_cursor"])
+
+    def test_batch_json(self):
+        """/api/v1/messages/batch saves every message, in order"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.post("/api/v1/messages/batch",
+                                json={"messages": [{"text": "one"},
+                                                   {"text": "two"}]})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(len(resp.get_json()["data"]), 2)
+
+        status, body = self.get_json(f"/api/v1/users/{self.u1_id}/messages")
+        self.assertEqual([m["text"] for m in body["data"]], ["two", "one"])
+
+    def test_batch_form(self):
+        """The batch endpoint also takes repeated form fields"""
+
+        self.addCleanup(app.config.__setitem__, 'WTF_CSRF_ENABLED',
+                        app.config.get('WTF_CSRF_ENABLED', True))
+        app.config['WTF_CSRF_ENABLED'] = False
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.post("/api/v1/messages/batch",
+                                data={"text": ["one", "two", "three"]})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(), 3)
+
+    def test_batch_invalid(self):
+        """One bad message rejects the whole batch"""
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.post("/api/v1/messages/batch",
+                                json={"messages": [{"text": "fine"},
+                                                   {"text": "x" * 141}]})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(list(resp.get_json()["errors"]), ["1"])
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(), 0)
+
+    def test_batch_not_text(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        resp = self.client.post("/api/v1/messages/batch",
+                                json={"messages": [{"text": 5},
+                                                   {"text": ["x"]},
+                                                   {},
+                                                   "fine"]})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(list(resp.get_json()["errors"]), ["0", "1", "2", "3"])
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(), 0)
+
+    def test_batch_not_logged_in(self):
+        resp = self.client.post("/api/v1/messages/batch",
+                                json={"messages": [{"text": "one"}]})
+        self.assertEqual(resp.status_code, 401)
@@ -0,0 +1,112 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_archive.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Message, ArchivedMessage, User, Likes, MessageTag
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import archive
+import feeds
+from snowflake import id_for_datetime
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class ArchiveTestCase(TestCase):
+    """Test moving old messages out and reading them back transparently"""
+
+    def setUp(self):
+        MessageTag.query.delete()
+        Likes.query.delete()
+        ArchivedMessage.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        user = User.signup("archivist", "archivist@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        # Three messages from two years ago, two from this week.
+        old = datetime.utcnow() - timedelta(days=730)
+        recent = datetime.utcnow() - timedelta(days=1)
+        self.old_ids = [id_for_datetime(old, sequence=i) for i in range(3)]
+        self.recent_ids = [id_for_datetime(recent, sequence=i) for i in range(2)]
+
+        db.session.add_all([Message(id=message_id, text=f"warble {message_id}",
+                                    timestamp=old, user_id=self.user_id)
+                            for message_id in self.old_ids]
+                           + [Message(id=message_id, text=f"warble {message_id}",
+                                      timestamp=recent, user_id=self.user_id)
+                              for message_id in self.recent_ids])
+        db.session.commit()
+
+    def login(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def test_archive_moves_old_messages(self):
+        progress = []
+        self.assertEqual(archive.archive_messages(days=365, batch=2,
+                                                  progress=progress.append), 3)
+
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual(sorted(m.id for m in Message.query), self.recent_ids)
+        self.assertEqual(sorted(m.id for m in ArchivedMessage.query),
+                         self.old_ids)
+
+        # Nothing left to move.
+        self.assertEqual(archive.archive_messages(days=365), 0)
+
+    def test_pagination_continues_into_archive(self):
+        archive.archive_messages(days=365)
+
+        first = feeds.user_messages(self.user_id, limit=3)
+        rest = feeds.user_messages(self.user_id, limit=3, before=first[-1].id)
+
+        self.assertEqual([m.id for m in first + rest],
+                         sorted(self.old_ids + self.recent_ids, reverse=True))
+
+    def test_archived_message_page(self):
+        archive.archive_messages(days=365)
+        resp = self.client.get(f"/messages/{self.old_ids[0]}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(f"warble {self.old_ids[0]}", resp.get_data(as_text=True))
+        self.assertEqual(self.client.get("/messages/1").status_code, 404)
+
+    def test_stats_and_likes(self):
+        db.session.add(Likes(user_id=self.user_id, message_id=self.old_ids[0]))
+        db.session.commit()
+        archive.archive_messages(days=365)
+
+        self.assertEqual(feeds.user_stats(self.user_id).messages, 5)
+        self.assertEqual([m.id for m in feeds.liked_messages(self.user_id).items],
+                         [self.old_ids[0]])
+
+    def test_deleting_archived_message(self):
+        db.session.add(Likes(user_id=self.user_id, message_id=self.old_ids[0]))
+        db.session.add(MessageTag(tag='old', message_id=self.old_ids[0]))
+        db.session.commit()
+        archive.archive_messages(days=365)
+
+        self.login()
+        self.client.post(f"/messages/{self.old_ids[0]}/delete")
+
+        self.assertIsNone(ArchivedMessage.query.get(self.old_ids[0]))
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(MessageTag.query.count(), 0)
@@ -0,0 +1,317 @@
+"""ASGI serving mode tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_asgi.py
+
+
+import asyncio
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Message, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import asgi
+from author_feeds import author_feeds
+import feeds
+from hot_cache import SharedStore, hot_cache
+from likes import like_buffer
+from shards import message_shards
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class SessionDatabase:
+    """Stand-in for asgi.Database running statements on db.session."""
+
+    async def fetch(self, statement):
+        return db.session.execute(statement).fetchall()
+
+
+def call(application, method, path, query=b'', cookie=None, body=b''):
+    """Make one request to an ASGI app; (status, headers, body)."""
+
+    headers = [(b'host', b'localhost')]
+    if cookie:
+        headers.append((b'cookie', cookie.encode()))
+    if body:
+        headers += [(b'content-type', b'application/x-www-form-urlencoded'),
+                    (b'content-length', str(len(body)).encode())]
+
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'query_string': query, 'headers': headers,
+             'client': ('127.0.0.1', 5000), 'server': ('localhost', 80)}
+    received = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        return received.pop(0)
+
+    async def send(event):
+        sent.append(event)
+
+    asyncio.run(application(scope, receive, send))
+
+    start = sent[0]
+    return (start['status'],
+            dict(start['headers']),
+            b''.join(event.get('body', b'') for event in sent[1:]))
+
+
+class ASGITestCase(TestCase):
+    """Test async pages and the hand-off to Flask"""
+
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("testuser_one", "test1@test.com", "testuser1", None)
+        u2 = User.signup("testuser_two", "test2@test.com", "testuser2", None)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u2.id,
+                               user_following_id=u1.id))
+        db.session.add(Message(text="async warble", user_id=u2.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.message_id = Message.query.one().id
+
+        self.application = asgi.AsyncWarbler(app)
+        self.application.db = SessionDatabase()
+        self.served = []
+
+        for endpoint, view in list(self.application.views.items()):
+            self.application.views[endpoint] = self.recording(endpoint, view)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def recording(self, endpoint, view):
+        async def wrapper(*args, **kwargs):
+            self.served.append(endpoint)
+            return await view(*args, **kwargs)
+        return wrapper
+
+    def cookie(self, session):
+        serializer = app.session_interface.get_signing_serializer(app)
+        return f"{app.session_cookie_name}={serializer.dumps(session)}"
+
+    def test_homepage_logged_in(self):
+        cookie = self.cookie({CURR_USER_KEY: self.u1_id})
+        status, headers, body = call(self.application, 'GET', '/', cookie=cookie)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.served, ['homepage'])
+        self.assertIn(b"async warble", body)
+        self.assertIn(b"@testuser_one", body)
+        self.assertEqual(headers[b'cache-control'], b'public, max-age=0')
+
+    def test_homepage_anon(self):
+        status, _, body = call(self.application, 'GET', '/')
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"Sign up", body)
+        self.assertEqual(self.served, ['homepage'])
+
+    def test_users_show(self):
+        status, _, body = call(self.application, 'GET', f'/users/{self.u2_id}')
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"@testuser_two", body)
+        self.assertIn(b"async warble", body)
+
+    def test_list_users_search(self):
+        status, _, body = call(self.application, 'GET', '/users', query=b'q=one')
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"testuser_one", body)
+        self.assertNotIn(b"testuser_two", body)
+
+    def test_messages_show(self):
+        status, _, body = call(self.application, 'GET',
+                               f'/messages/{self.message_id}')
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"async warble", body)
+        self.assertIn(b"testuser_two", body)
+
+    def test_missing_row_falls_back_to_flask(self):
+        status, _, _ = call(self.application, 'GET', '/users/999999')
+
+        self.assertEqual(self.served, ['users_show'])
+        self.assertEqual(status, 404)
+
+    def test_other_routes_use_flask(self):
+        status, _, body = call(self.application, 'GET', '/login')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.served, [])
+        self.assertIn(b"Welcome back", body)
+
+    def test_post_uses_flask(self):
+        cookie = self.cookie({CURR_USER_KEY: self.u1_id})
+        status, headers, _ = call(self.application, 'POST', '/messages/new',
+                                  cookie=cookie, body=b'text=posted+via+asgi')
+
+        self.assertEqual(status, 302)
+        self.assertEqual(self.served, [])
+        db.session.rollback()
+        self.assertEqual(Message.query.filter_by(text="posted via asgi").count(), 1)
+
+    def test_flashes_go_to_flask(self):
+        cookie = self.cookie({'_flashes': [('success', "Hello!")]})
+        status, _, body = call(self.application, 'GET', '/', cookie=cookie)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.served, [])
+        self.assertIn(b"Hello!", body)
+
+    def test_bad_cookie_is_anonymous(self):
+        cookie = f"{app.session_cookie_name}=not-a-session"
+        status, _, body = call(self.application, 'GET', '/', cookie=cookie)
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"Sign up", body)
+
+    def test_head(self):
+        cookie = self.cookie({CURR_USER_KEY: self.u1_id})
+        _, get_headers, _ = call(self.application, 'GET', '/', cookie=cookie)
+        status, headers, body = call(self.application, 'HEAD', '/',
+                                     cookie=cookie)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.served, ['homepage', 'homepage'])
+        self.assertEqual(body, b'')
+        self.assertEqual(headers[b'content-length'],
+                         get_headers[b'content-length'])
+
+    def test_merge_timeline_uses_flask(self):
+        self.addCleanup(app.config.__setitem__, 'TIMELINE_MODE',
+                        app.config['TIMELINE_MODE'])
+        app.config['TIMELINE_MODE'] = 'merge'
+
+        merged = []
+        timeline = author_feeds.timeline
+
+        def recording_timeline(author_ids):
+            merged.append(author_ids)
+            return timeline(author_ids)
+
+        author_feeds.timeline = recording_timeline
+        self.addCleanup(delattr, author_feeds, 'timeline')
+
+        cookie = self.cookie({CURR_USER_KEY: self.u1_id})
+        status, _, body = call(self.application, 'GET', '/', cookie=cookie)
+
+        self.assertEqual(status, 200)
+        self.assertIn(b"async warble", body)
+        self.assertEqual(merged, [{self.u1_id, self.u2_id}])
+
+    def test_deadline_degrades_timeline(self):
+        timeline_messages = asgi.timeline_messages
+
+        async def slow_timeline(db, user_ids, limit=100):
+            if len(user_ids) > 1:
+                raise asyncio.TimeoutError
+            return await timeline_messages(db, user_ids, limit)
+
+        asgi.timeline_messages = slow_timeline
+        self.addCleanup(setattr, asgi, 'timeline_messages', timeline_messages)
+
+        db.session.add(Message(text="my own warble", user_id=self.u1_id))
+        db.session.commit()
+
+        cookie = self.cookie({CURR_USER_KEY: self.u1_id})
+        status, _, body = call(self.application, 'GET', '/', cookie=cookie)
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.served, ['homepage'])
+        self.assertIn(b"taking longer than usual", body)
+        self.assertIn(b"my own warble", body)
+
+    def test_hot_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        hot_cache.store = SharedStore(os.path.join(directory, 'cache'),
+                                      sets=64, slot_bytes=1024, ttl=60)
+        hot_cache.enabled = True
+        self.addCleanup(setattr, hot_cache, 'enabled', False)
+
+        for path in (f'/users/{self.u2_id}', f'/messages/{self.message_id}'):
+            call(self.application, 'GET', path)
+
+        # Changed without invalidating: the cached rows are served.
+        users = User.__table__
+        messages = Message.__table__
+        db.session.execute(users.update().where(users.c.id == self.u2_id)
+                           .values(username="renamed"))
+        db.session.execute(messages.update()
+                           .where(messages.c.id == self.message_id)
+                           .values(text="edited"))
+        db.session.commit()
+
+        _, _, body = call(self.application, 'GET', f'/users/{self.u2_id}')
+        self.assertIn(b"@testuser_two", body)
+        _, _, body = call(self.application, 'GET',
+                          f'/messages/{self.message_id}')
+        self.assertIn(b"async warble", body)
+        self.assertIn(b"testuser_two", body)
+
+        hot_cache.invalidate(f"user:{self.u2_id}")
+        _, _, body = call(self.application, 'GET', f'/users/{self.u2_id}')
+        self.assertIn(b"@renamed", body)
+
+        self.assertEqual(call(self.application, 'GET', '/messages/999999')[0],
+                         404)
+
+    def test_sharded_message_pages_use_flask(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        message_shards.configure({'one': f"sqlite:///{directory}/one.db"})
+        self.addCleanup(message_shards.configure, {})
+        message_shards.create_all()
+        message_shards.add_message(self.u2_id, "sharded warble")
+
+        status, _, body = call(self.application, 'GET', f'/users/{self.u2_id}')
+        self.assertEqual(status, 200)
+        self.assertIn(b"sharded warble", body)
+        self.assertEqual(self.served, [])
+
+        call(self.application, 'GET', '/users')
+        self.assertEqual(self.served, ['list_users'])
+
+    def test_like_states_show_buffered_likes(self):
+        """Likes still in the write-behind buffer count, as in Flask"""
+
+        like_buffer.pending = {(self.u1_id, self.message_id):
+                               (True, datetime.utcnow())}
+        try:
+            states = asyncio.run(asgi.like_states(
+                SessionDatabase(), [self.message_id], self.u1_id))
+        finally:
+            like_buffer.pending = {}
+
+        self.assertEqual(states[self.message_id], feeds.LikeState(1, True))
+
+    def test_compile_statement(self):
+        statement = (asgi.message_select()
+                     .where(Message.user_id.in_([1, 2]))
+                     .limit(5))
+        sql, params = asgi.compile_statement(statement)
+
+        self.assertIn("$1", sql)
+        self.assertNotIn(":1", sql)
+        self.assertEqual(params, [1, 2, 5])
@@ -0,0 +1,200 @@
+"""Username/email Bloom filter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bloom.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, signup_conflict
+from bloom import BloomFilter, UserFilter, user_filter
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the bit-array filter itself"""
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        words = [f"user{i}" for i in range(1000)]
+
+        for word in words:
+            bloom.add(word)
+
+        self.assertTrue(all(word in bloom for word in words))
+
+    def test_error_rate(self):
+        """False positives stay near the configured rate at capacity"""
+
+        bloom = BloomFilter(10000, error_rate=0.01)
+        for i in range(10000):
+            bloom.add(f"in{i}")
+
+        false_positives = sum(f"out{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 200)
+
+
+class UserFilterTestCase(TestCase):
+    """Test the users-table filter"""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        User.signup("bloom_one", "bloom1@test.com", "password", None)
+        db.session.commit()
+
+        self.filter = UserFilter()
+        self.filter.refresh_every = 0
+        self.filter.load()
+
+    def test_load(self):
+        self.assertTrue(self.filter.might_exist('username', "bloom_one"))
+        self.assertTrue(self.filter.might_exist('email', "bloom1@test.com"))
+        self.assertFalse(self.filter.might_exist('username', "nobody"))
+        self.assertFalse(self.filter.might_exist('username', "bloom1@test.com"))
+
+    def test_catch_up(self):
+        """Users inserted behind the filter's back are found on a miss"""
+
+        User.signup("bloom_two", "bloom2@test.com", "password", None)
+        db.session.commit()
+
+        self.assertTrue(self.filter.might_exist('username', "bloom_two"))
+
+    def test_catch_up_rate_limit(self):
+        """Within USER_FILTER_REFRESH a miss is answered without a query"""
+
+        self.filter.refresh_every = 3600
+
+        User.signup("bloom_two", "bloom2@test.com", "password", None)
+        db.session.commit()
+
+        self.assertFalse(self.filter.might_exist('username', "bloom_two"))
+
+    def test_add(self):
+        self.filter.refresh_every = 3600
+        self.filter.add("renamed", "renamed@test.com")
+
+        self.assertTrue(self.filter.might_exist('username', "renamed"))
+
+
+class SignupConflictTestCase(TestCase):
+    """Test signup's duplicate pre-check"""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        User.signup("taken", "taken@test.com", "password", None)
+        db.session.commit()
+
+        user_filter.enabled = True
+        user_filter.refresh_every = 3600
+        user_filter.load()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        user_filter.enabled = False
+        user_filter.bloom = None
+        user_filter.refresh_every = 1.0
+
+    def count_queries(self, username, email):
+        """(signup_conflict's answer, how many statements it ran)."""
+
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            conflict = signup_conflict(username, email)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        return conflict, len(statements)
+
+    def test_duplicate_username(self):
+        resp = self.client.post("/signup",
+                                data={"username": "taken",
+                                      "email": "new@test.com",
+                                      "password": "password"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Username already taken", resp.data)
+
+    def test_duplicate_email(self):
+        resp = self.client.post("/signup",
+                                data={"username": "new",
+                                      "email": "taken@test.com",
+                                      "password": "password"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b"Email already taken", resp.data)
+        self.assertEqual(User.query.count(), 1)
+
+    def test_filter_miss_skips_query(self):
+        self.assertEqual(self.count_queries("new", "new@test.com"), (None, 0))
+        self.assertEqual(self.count_queries("taken", "new@test.com"),
+                         ("Username already taken", 1))
+        self.assertEqual(self.count_queries("new", "taken@test.com"),
+                         ("Email already taken", 1))
+
+    def test_disabled_filter_skips_query(self):
+        user_filter.enabled = False
+
+        self.assertEqual(self.count_queries("taken", "taken@test.com"),
+                         (None, 0))
+
+
+class LoginTestCase(TestCase):
+    """Test login works for users the filter hasn't seen"""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        user = User.signup("before", "before@test.com", "password", None)
+        db.session.commit()
+
+        user_filter.refresh_every = 3600
+        user_filter.load()
+
+        # Renamed by another worker: this worker's filter never sees it.
+        user.username = "after"
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        user_filter.bloom = None
+        user_filter.refresh_every = 1.0
+
+    def test_login_after_rename_elsewhere(self):
+        self.assertFalse(user_filter.might_exist('username', "after"))
+
+        resp = self.client.post("/login",
+                                data={"username": "after",
+                                      "password": "password"},
+                                follow_redirects=True)
+
+        self.assertIn(b"Hello, after!", resp.data)
@@ -0,0 +1,172 @@
+"""Query deadline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_deadlines.py
+
+
+import json
+import os
+from types import SimpleNamespace
+from unittest import TestCase
+
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from models import db, Message, User, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from author_feeds import author_feeds
+from deadlines import QueryDeadlines, exceeded
+import feeds
+from metrics import metrics
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.create_all()
+
+
+def timed_out(*args, **kwargs):
+    """Stand-in for a query cancelled by statement_timeout."""
+
+    error = Exception("canceling statement due to statement timeout")
+    error.pgcode = '57014'
+    raise OperationalError("SELECT ...", {}, error)
+
+
+class FakeConnection:
+    """Just enough of a SQLAlchemy Connection for QueryDeadlines.apply"""
+
+    def __init__(self):
+        self.dialect = SimpleNamespace(name='postgresql')
+        self.info = {}
+        self.executed = []
+        self.connection = self
+
+    def cursor(self):
+        return SimpleNamespace(execute=self.executed.append,
+                               close=lambda: None)
+
+
+class QueryDeadlinesTestCase(TestCase):
+    """Test deadline lookup and setting statement_timeout"""
+
+    def setUp(self):
+        self.deadlines = QueryDeadlines()
+        self.deadlines.deadlines = {'homepage': 1500}
+
+    def apply(self, conn):
+        self.deadlines.apply(conn, None, "SELECT 1", {}, None, False)
+
+    def test_exceeded(self):
+        with self.assertRaises(OperationalError) as cm:
+            timed_out()
+        self.assertTrue(exceeded(cm.exception))
+
+        other = Exception("server closed the connection")
+        other.pgcode = '08006'
+        self.assertFalse(exceeded(OperationalError("SELECT 1", {}, other)))
+        self.assertFalse(exceeded(IntegrityError("INSERT", {}, Exception())))
+
+    def test_current_by_route(self):
+        with app.test_request_context('/'):
+            self.assertEqual(self.deadlines.current(), 1500)
+
+        with app.test_request_context('/users'):
+            self.assertIsNone(self.deadlines.current())
+
+        self.assertIsNone(self.deadlines.current())
+
+    def test_sets_timeout_only_on_change(self):
+        conn = FakeConnection()
+
+        with app.test_request_context('/'):
+            self.apply(conn)
+            self.apply(conn)
+        with app.test_request_context('/users'):
+            self.apply(conn)
+
+        self.assertEqual(conn.executed, ["SET statement_timeout = 1500",
+                                         "SET statement_timeout = 0"])
+
+    def test_rollback_forgets_timeout(self):
+        conn = FakeConnection()
+
+        with app.test_request_context('/'):
+            self.apply(conn)
+            self.deadlines.forget(conn)
+            self.apply(conn)
+
+        self.assertEqual(len(conn.executed), 2)
+
+    def test_other_databases_untouched(self):
+        conn = FakeConnection()
+        conn.dialect.name = 'sqlite'
+
+        with app.test_request_context('/'):
+            self.apply(conn)
+
+        self.assertEqual(conn.executed, [])
+
+
+class DegradedTimelineTestCase(TestCase):
+    """Test the fallbacks when the timeline query runs out of time"""
+
+    def setUp(self):
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        author_feeds.clear()
+
+        self.client = app.test_client()
+
+        u1 = User.signup("deadline_one", "deadline1@test.com", "password", None)
+        u2 = User.signup("deadline_two", "deadline2@test.com", "password", None)
+        u3 = User.signup("deadline_three", "deadline3@test.com", "password", None)
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=u2.id, user_following_id=u1.id),
+            Follows(user_being_followed_id=u3.id, user_following_id=u1.id),
+            Message(text="my own warble", user_id=u1.id),
+            Message(text="cached warble", user_id=u2.id),
+            Message(text="uncached warble", user_id=u3.id),
+        ])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        author_feeds.get_many([u2.id])
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        # Only the multi-author timeline query is too slow.
+        original = feeds.timeline_messages
+
+        def timeline_messages(user_ids, *args, **kwargs):
+            if len(user_ids) > 1:
+                timed_out()
+            return original(user_ids, *args, **kwargs)
+
+        feeds.timeline_messages = timeline_messages
+        self.addCleanup(setattr, feeds, 'timeline_messages', original)
+
+    def test_homepage_degraded(self):
+        resp = self.client.get("/")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("taking longer than usual", html)
+        self.assertIn("my own warble", html)
+        self.assertIn("cached warble", html)
+        self.assertNotIn("uncached warble", html)
+
+        self.assertIn("warbler_degraded_timelines_total", metrics.exposition())
+
+    def test_api_timeline_unavailable(self):
+        resp = self.client.get("/api/v1/timeline")
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn("error", json.loads(resp.get_data(as_text=True)))
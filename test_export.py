@@ -0,0 +1,105 @@
+"""Account export tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import gzip
+import json
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from export import content_disposition, export_user_command
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExportTestCase(TestCase):
+    """Test the NDJSON export endpoint and command"""
+
+    def setUp(self):
+        """u1 wrote two messages, liked one of u2's and follows u2"""
+
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("export_one", "export1@test.com", "password", None)
+        u2 = User.signup("export_two", "export2@test.com", "password", None)
+        db.session.commit()
+
+        m1 = Message(text="first", user_id=u1.id)
+        m2 = Message(text="second", user_id=u1.id)
+        m3 = Message(text="theirs", user_id=u2.id)
+        db.session.add_all([m1, m2, m3])
+        db.session.add(Follows(user_being_followed_id=u2.id,
+                               user_following_id=u1.id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=u1.id, message_id=m3.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m3_id = m3.id
+        self.client = app.test_client()
+
+    def check_records(self, text):
+        records = [json.loads(line) for line in text.splitlines()]
+
+        self.assertEqual([r['type'] for r in records],
+                         ['user', 'message', 'message', 'like', 'following'])
+        self.assertEqual(records[0]['username'], "export_one")
+        self.assertNotIn('password', records[0])
+        self.assertEqual([r['text'] for r in records[1:3]], ["first", "second"])
+        self.assertEqual(str(records[3]['message_id']), str(self.m3_id))
+        self.assertEqual(records[4]['user_id'], self.u2_id)
+
+    def test_export(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users/export")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertIn('attachment', resp.headers['Content-Disposition'])
+        self.check_records(resp.get_data(as_text=True))
+
+    def test_export_gzip(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users/export?format=gzip")
+
+        self.assertEqual(resp.mimetype, 'application/gzip')
+        self.check_records(gzip.decompress(resp.data).decode())
+
+    def test_content_disposition(self):
+        self.assertEqual(
+            content_disposition('warbler-b\u00f6b";x.ndjson'),
+            'attachment; filename="warbler-b_b__x.ndjson"; '
+            "filename*=UTF-8''warbler-b%C3%B6b%22%3Bx.ndjson")
+
+    def test_export_unauthorized(self):
+        resp = self.client.get("/users/export")
+
+        self.assertEqual(resp.status_code, 302)
+
+    def test_export_command(self):
+        result = app.test_cli_runner().invoke(export_user_command,
+                                              [str(self.u1_id)])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.check_records(result.output)
@@ -0,0 +1,157 @@
+"""Feed read-model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_feeds.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from author_feeds import AuthorFeedCache
+import feeds
+from snowflake import next_id
+
+db.create_all()
+
+
+class FeedsTestCase(TestCase):
+    """Test the column-only feed queries."""
+
+    def setUp(self):
+        """Two users; u1 follows u2 and likes one of u2's messages."""
+
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("feeds_one", "feeds1@test.com", "password", None)
+        u2 = User.signup("feeds_two", "feeds2@test.com", "password", None)
+        db.session.commit()
+
+        now = datetime.utcnow()
+        m1 = Message(text="older", user_id=u2.id, timestamp=now - timedelta(1))
+        m2 = Message(text="newer", user_id=u2.id, timestamp=now)
+        db.session.add_all([m1, m2])
+        db.session.add(Follows(user_being_followed_id=u2.id,
+                               user_following_id=u1.id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=u1.id, message_id=m1.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.m1_id = m1.id
+        self.m2_id = m2.id
+
+    def test_timeline_messages(self):
+        """Rows come back newest first with author columns"""
+
+        rows = feeds.timeline_messages([self.u1_id, self.u2_id])
+
+        self.assertEqual([r.text for r in rows], ["newer", "older"])
+        self.assertIsInstance(rows[0], feeds.MessageRow)
+        self.assertEqual(rows[0].username, "feeds_two")
+        self.assertFalse(hasattr(rows[0], "password"))
+
+    def test_liked_messages(self):
+        """Likes page rows are the messages this user liked"""
+
+        page = feeds.liked_messages(self.u1_id)
+        self.assertEqual([r.text for r in page.items], ["older"])
+        self.assertIsNone(page.next_cursor)
+
+    def test_liked_messages_pagination(self):
+        """Cursor pages walk likes newest-first without gaps or repeats"""
+
+        db.session.add(Likes(user_id=self.u1_id,
+                             message_id=self.m2_id,
+                             created_at=datetime.utcnow() + timedelta(1)))
+        db.session.commit()
+
+        first = feeds.liked_messages(self.u1_id, limit=1)
+        self.assertEqual([r.text for r in first.items], ["newer"])
+
+        second = feeds.liked_messages(self.u1_id, before=first.next_cursor, limit=1)
+        self.assertEqual([r.text for r in second.items], ["older"])
+        self.assertIsNone(second.next_cursor)
+
+    def test_follow_rows(self):
+        """followers/following return the other side of the edge"""
+
+        self.assertEqual([u.username for u in feeds.following(self.u1_id)],
+                         ["feeds_two"])
+        self.assertEqual([u.username for u in feeds.followers(self.u2_id)],
+                         ["feeds_one"])
+        self.assertEqual(feeds.following_ids(self.u1_id), {self.u2_id})
+
+    def test_user_stats(self):
+        """Counts match the relationships"""
+
+        self.assertEqual(feeds.user_stats(self.u1_id), (0, 1, 0, 1))
+        self.assertEqual(feeds.user_stats(self.u2_id), (2, 0, 1, 0))
+
+    def test_like_states(self):
+        """Counts and viewer flags for a page of messages"""
+
+        u3 = User.signup("feeds_three", "feeds3@test.com", "password", None)
+        db.session.commit()
+        db.session.add(Likes(user_id=u3.id, message_id=self.m1_id))
+        db.session.commit()
+
+        states = feeds.like_states([self.m1_id, self.m2_id], self.u1_id)
+        self.assertEqual(states[self.m1_id], feeds.LikeState(2, True))
+        self.assertEqual(states[self.m2_id], feeds.NOT_LIKED)
+
+        states = feeds.like_states([self.m1_id], None)
+        self.assertEqual(states[self.m1_id], feeds.LikeState(2, False))
+
+
+class AuthorFeedCacheTestCase(TestCase):
+    """Test the merged per-author timeline."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        users = [User.signup(f"author{i}", f"author{i}@test.com", "password", None)
+                 for i in range(3)]
+        db.session.commit()
+
+        start = datetime.utcnow()
+        db.session.add_all([Message(text=f"m{i}",
+                                    user_id=users[i % 3].id,
+                                    timestamp=start + timedelta(minutes=i))
+                            for i in range(12)])
+        db.session.commit()
+
+        self.user_ids = [u.id for u in users]
+        self.cache = AuthorFeedCache(depth=5)
+
+    def test_matches_sql_timeline(self):
+        """Merged feeds give the same page as the SQL query"""
+
+        self.assertEqual(self.cache.timeline(self.user_ids, limit=5),
+                         feeds.timeline_messages(self.user_ids, limit=5))
+        self.assertEqual(self.cache.timeline(self.user_ids[:1], limit=5),
+                         feeds.timeline_messages(self.user_ids[:1], limit=5))
+
+    def test_add_message(self):
+        """New messages go to the front of a cached feed"""
+
+        self.cache.timeline(self.user_ids)
+        row = feeds.MessageRow(next_id(), "brand new", datetime.utcnow(),
+                               self.user_ids[0], "author0", None)
+        self.cache.add_message(row)
+
+        self.assertEqual(self.cache.timeline(self.user_ids)[0], row)
@@ -0,0 +1,165 @@
+"""In-memory follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from follow_graph import FollowGraph, adjacency, follow_graph
+import feeds
+
+db.create_all()
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the sorted-array adjacency maps"""
+
+    def setUp(self):
+        edges = [(1, 2), (1, 3), (2, 3), (3, 1), (1, 5)]
+
+        self.graph = FollowGraph()
+        self.graph.replace(adjacency(sorted(edges)),
+                           adjacency(sorted((b, a) for a, b in edges)))
+
+    def test_reads(self):
+        """Membership, counts, id sets and pages"""
+
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.assertFalse(self.graph.is_following(3, 2))
+        self.assertFalse(self.graph.is_following(42, 1))
+        self.assertEqual(self.graph.following_ids(1), {2, 3, 5})
+        self.assertEqual(self.graph.follower_ids(3), {1, 2})
+        self.assertEqual(self.graph.counts(1), (3, 1))
+        self.assertEqual(self.graph.counts(42), (0, 0))
+        self.assertEqual(self.graph.following_page(1, limit=2), [2, 3])
+        self.assertEqual(self.graph.following_page(1, after=3), [5])
+
+    def test_add_and_remove(self):
+        """Writes keep both directions sorted and in step"""
+
+        self.graph.add(2, 1)
+        self.graph.add(2, 1)
+        self.assertEqual(self.graph.following_page(2), [1, 3])
+        self.assertEqual(self.graph.followers_page(1), [2, 3])
+
+        self.graph.remove(1, 3)
+        self.assertFalse(self.graph.is_following(1, 3))
+        self.assertEqual(self.graph.follower_ids(3), {2})
+
+    def test_remove_user(self):
+        """Deleting a user drops their edges from everyone else's arrays"""
+
+        self.graph.remove_user(3)
+
+        self.assertEqual(self.graph.following_ids(1), {2, 5})
+        self.assertEqual(self.graph.following_ids(2), set())
+        self.assertEqual(self.graph.follower_ids(1), set())
+
+    def test_memory_usage(self):
+        usage = self.graph.memory_usage()
+
+        self.assertEqual(usage.edges, 5)
+        self.assertGreater(usage.bytes_per_million_edges, 0)
+
+
+class FollowGraphLoadTestCase(TestCase):
+    """Test loading the graph from the follows table"""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("graph_one", "graph1@test.com", "password", None)
+        u2 = User.signup("graph_two", "graph2@test.com", "password", None)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u2.id,
+                               user_following_id=u1.id))
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        follow_graph.ready = False
+        follow_graph.following = {}
+        follow_graph.followers = {}
+
+    def test_load(self):
+        """feeds answers follow questions from the loaded graph"""
+
+        follow_graph.load()
+
+        self.assertTrue(follow_graph.is_following(self.u1_id, self.u2_id))
+        self.assertEqual(feeds.following_ids(self.u1_id), {self.u2_id})
+        self.assertEqual(feeds.user_stats(self.u2_id).followers, 1)
+
+        # Reads now come from memory: a row written behind the graph's
+        # back isn't seen until the next load.
+        Follows.query.delete()
+        db.session.commit()
+        self.assertEqual(feeds.user_stats(self.u2_id).followers, 1)
+
+        follow_graph.load()
+        self.assertEqual(feeds.user_stats(self.u2_id).followers, 0)
+
+
+class StaleFollowButtonTestCase(TestCase):
+    """Test following and unfollowing are safe to repeat"""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("graph_one", "graph1@test.com", "password", None)
+        u2 = User.signup("graph_two", "graph2@test.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        follow_graph.load()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        follow_graph.ready = False
+        follow_graph.following = {}
+        follow_graph.followers = {}
+
+    def test_repeated_follow(self):
+        for _ in range(2):
+            resp = self.client.post(f"/users/follow/{self.u2_id}")
+            self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertTrue(follow_graph.is_following(self.u1_id, self.u2_id))
+
+    def test_unfollow_non_follow(self):
+        resp = self.client.post(f"/users/stop-following/{self.u2_id}")
+        self.assertEqual(resp.status_code, 302)
+
+        resp = self.client.post("/users/stop-following/999999")
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertFalse(follow_graph.is_following(self.u1_id, self.u2_id))
+
+    def test_follow_missing_user(self):
+        resp = self.client.post("/users/follow/999999")
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(Follows.query.count(), 0)
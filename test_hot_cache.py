@@ -0,0 +1,206 @@
+"""Shared hot row cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_hot_cache.py
+
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from hot_cache import SharedStore, WAYS, hot_cache
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+def invalidate_in_child(path):
+    """Run in another process: bump a key's version there."""
+
+    SharedStore(path, sets=1, slot_bytes=256, ttl=60).invalidate('user:1')
+
+
+class SharedStoreTestCase(TestCase):
+    """Test the memory-mapped table on its own"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, ttl=60):
+        return SharedStore(self.path, sets=1, slot_bytes=256, ttl=ttl)
+
+    def test_get_and_set(self):
+        store = self.store()
+        store.set('user:1', {'name': 'one'}, store.version('user:1'))
+
+        self.assertEqual(store.get('user:1'), {'name': 'one'})
+        self.assertIsNone(store.get('user:2'))
+        self.assertFalse(store.set('user:3', 'x' * 300, 0))
+
+    def test_invalidate(self):
+        store = self.store()
+        version = store.version('user:1')
+        store.set('user:1', 'old', version)
+        store.invalidate('user:1')
+
+        self.assertIsNone(store.get('user:1'))
+
+        # Loaded before an invalidation: stored, but never served.
+        version = store.version('user:1')
+        store.invalidate('user:1')
+        store.set('user:1', 'racing', version)
+        self.assertIsNone(store.get('user:1'))
+
+    def test_lru_eviction(self):
+        store = self.store()
+        for i in range(WAYS):
+            store.set(f"key:{i}", i, store.version(f"key:{i}"))
+        store.get('key:0')
+        store.set('key:new', 'new', store.version('key:new'))
+
+        self.assertEqual(store.get('key:0'), 0)
+        self.assertIsNone(store.get('key:1'))
+        self.assertEqual(store.get('key:new'), 'new')
+
+    def test_expiry(self):
+        store = self.store(ttl=-1)
+        store.set('user:1', 'expired', store.version('user:1'))
+
+        self.assertIsNone(store.get('user:1'))
+
+    def test_shared_between_processes(self):
+        store = self.store()
+        store.set('user:1', 'cached', store.version('user:1'))
+        self.assertEqual(self.store().get('user:1'), 'cached')
+
+        child = multiprocessing.get_context('fork').Process(
+            target=invalidate_in_child, args=(self.path,))
+        child.start()
+        child.join()
+
+        self.assertIsNone(store.get('user:1'))
+
+    def test_datetimes_round_trip(self):
+        store = self.store()
+        at = datetime(2020, 1, 2, 3, 4, 5, 6)
+        store.set('message:1', {'timestamp': at}, store.version('message:1'))
+
+        self.assertEqual(store.get('message:1'), {'timestamp': at})
+
+    def test_refuses_file_others_can_write(self):
+        self.store().set('user:1', 'cached', 0)
+        os.chmod(self.path, 0o666)
+
+        with self.assertRaises(RuntimeError):
+            self.store().get('user:1')
+
+    def test_refuses_symlink(self):
+        target = os.path.join(self.directory, 'target')
+        self.store().set('user:1', 'cached', 0)
+        os.rename(self.path, target)
+        os.symlink(target, self.path)
+
+        with self.assertRaises(OSError):
+            self.store().get('user:1')
+
+
+class HotCacheViewsTestCase(TestCase):
+    """Test the cache behind g.user, profiles and message pages"""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.directory = tempfile.mkdtemp()
+        hot_cache.store = SharedStore(os.path.join(self.directory, 'cache'),
+                                      sets=64, slot_bytes=1024, ttl=60)
+        hot_cache.enabled = True
+
+        self.client = app.test_client()
+
+        user = User.signup("cached", "cached@test.com", "password", None)
+        other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+        self.other_id = other.id
+
+        msg = Message(text="hot warble", user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+    def tearDown(self):
+        hot_cache.enabled = False
+        hot_cache.store = None
+        shutil.rmtree(self.directory)
+
+    def rename_behind_cache(self, username):
+        """Change the row without invalidating the cache."""
+
+        users = User.__table__
+        db.session.execute(users.update()
+                           .where(users.c.id == self.user_id)
+                           .values(username=username))
+        db.session.commit()
+
+    def test_profile_served_from_cache(self):
+        self.assertIn("@cached", self.client.get(f"/users/{self.user_id}")
+                      .get_data(as_text=True))
+        self.rename_behind_cache("renamed")
+
+        self.assertIn("@cached", self.client.get(f"/users/{self.user_id}")
+                      .get_data(as_text=True))
+
+        hot_cache.invalidate(f"user:{self.user_id}")
+        self.assertIn("@renamed", self.client.get(f"/users/{self.user_id}")
+                      .get_data(as_text=True))
+
+        self.assertEqual(self.client.get("/users/999999").status_code, 404)
+
+    def test_message_page(self):
+        resp = self.client.get(f"/messages/{self.message_id}")
+        self.assertIn("hot warble", resp.get_data(as_text=True))
+
+        resp = self.client.get(f"/messages/{self.message_id}")
+        html = resp.get_data(as_text=True)
+        self.assertIn("hot warble", html)
+        self.assertIn("@cached", html)
+
+    def test_cached_g_user_is_usable(self):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        self.client.get("/")  # caches the row
+        self.client.post(f"/users/follow/{self.other_id}")
+
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(User.query.get(self.user_id).following[0].id,
+                         self.other_id)
+
+    def test_deleting_message_invalidates(self):
+        self.client.get(f"/messages/{self.message_id}")
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+        self.client.post(f"/messages/{self.message_id}/delete")
+
+        self.assertEqual(self.client.get(f"/messages/{self.message_id}")
+                         .status_code, 404)
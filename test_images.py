@@ -0,0 +1,86 @@
+"""Image upload / thumbnail cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import os
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from PIL import Image
+
+from images import save_upload, thumbnail, variants_for, THUMBNAIL_SIZES
+
+
+def make_image_file(color="red", size=(800, 600), fmt="PNG"):
+    """Return an in-memory image file like a form upload."""
+
+    buf = BytesIO()
+    Image.new("RGB", size, color).save(buf, fmt)
+    buf.seek(0)
+    return buf
+
+
+class SaveUploadTestCase(TestCase):
+    """Test images.save_upload"""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.folder = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_writes_all_variants(self):
+        """Every avatar variant is written at its configured size"""
+
+        url = save_upload(make_image_file(), "avatar", self.folder, "/up")
+        out_dir = os.path.join(self.folder, *url.split("/")[2:4])
+
+        for name in variants_for("avatar"):
+            with Image.open(os.path.join(out_dir, f"{name}.jpg")) as img:
+                self.assertEqual(img.size, THUMBNAIL_SIZES[name])
+
+        self.assertFalse(any(name.startswith("header")
+                             for name in os.listdir(out_dir)))
+
+    def test_dedup(self):
+        """Identical uploads share one cache entry"""
+
+        url1 = save_upload(make_image_file(), "avatar", self.folder, "/up")
+        url2 = save_upload(make_image_file(), "avatar", self.folder, "/up")
+        url3 = save_upload(make_image_file("blue"), "avatar", self.folder, "/up")
+
+        self.assertEqual(url1, url2)
+        self.assertNotEqual(url1, url3)
+        self.assertEqual(len(os.listdir(self.folder)), 2)
+
+    def test_invalid_image(self):
+        """Non-image uploads raise ValueError"""
+
+        with self.assertRaises(ValueError):
+            save_upload(BytesIO(b"not an image"), "avatar", self.folder, "/up")
+
+
+class ThumbnailFilterTestCase(TestCase):
+    """Test images.thumbnail"""
+
+    def test_uploaded_url(self):
+        """Uploaded images resolve to the requested variant"""
+
+        base = "/static/uploads/ab/" + "ab" * 32
+        url = f"{base}/avatar-lg.jpg"
+
+        self.assertEqual(thumbnail(url, "avatar-sm"), f"{base}/avatar-sm.jpg")
+        self.assertEqual(thumbnail(url, "header-sm"), url,
+                         msg="Can't swap an avatar for a header variant")
+
+    def test_remote_url(self):
+        """Remote and default images are left alone"""
+
+        url = "https://randomuser.me/api/portraits/men/80.jpg"
+        self.assertEqual(thumbnail(url, "avatar-sm"), url)
+        self.assertEqual(thumbnail(None, "avatar-sm"), None)
@@ -0,0 +1,150 @@
+"""Like write path tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_likes.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import feeds
+import likes
+from likes import LikeBuffer
+
+db.create_all()
+
+
+class LikesTestCase(TestCase):
+    """Test idempotent likes and the write-behind buffer"""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("likes_one", "likes1@test.com", "password", None)
+        u2 = User.signup("likes_two", "likes2@test.com", "password", None)
+        db.session.commit()
+
+        m1 = Message(text="likeable", user_id=u2.id)
+        m2 = Message(text="also likeable", user_id=u2.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.m1_id = m1.id
+        self.m2_id = m2.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_like_twice(self):
+        """Liking twice leaves one row; unliking a missing like is fine"""
+
+        likes.like(self.u1_id, self.m1_id)
+        likes.like(self.u1_id, self.m1_id)
+        self.assertEqual(Likes.query.count(), 1)
+
+        likes.unlike(self.u1_id, self.m1_id)
+        likes.unlike(self.u1_id, self.m1_id)
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_insert_skips_missing_messages_in_one_statement(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        now = datetime.utcnow()
+        rows = [dict(user_id=self.u1_id, message_id=message_id, created_at=now)
+                for message_id in (self.m1_id, 12345, self.m2_id)]
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            likes.insert_likes(rows)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        db.session.commit()
+
+        self.assertEqual(len(statements), 1)
+        self.assertEqual({l.message_id for l in Likes.query},
+                         {self.m1_id, self.m2_id})
+
+    def make_buffer(self, log=None):
+        buffer = LikeBuffer()
+        buffer.app = app
+        buffer.enabled = True
+        buffer.max_pending = 1000
+        if log:
+            buffer.log_path = log
+            buffer.replay()
+            buffer.log = open(log, 'a')
+            self.addCleanup(buffer.log.close)
+        return buffer
+
+    def test_buffer_coalesces(self):
+        """Only the last toggle per (user, message) is written"""
+
+        buffer = self.make_buffer()
+        buffer.ensure_flusher = lambda: None
+
+        for liked in (True, False, True):
+            buffer.put(self.u1_id, self.m1_id, liked)
+        buffer.put(self.u1_id, self.m2_id, True)
+        buffer.put(self.u1_id, self.m2_id, False)
+
+        self.assertEqual(len(buffer.pending), 2)
+
+        states = feeds.like_states([self.m1_id, self.m2_id])
+        buffer.overlay(states, self.u1_id)
+        self.assertEqual(states[self.m1_id], feeds.LikeState(1, True))
+        self.assertEqual(states[self.m2_id], feeds.LikeState(0, False))
+
+        buffer.flush()
+        self.assertEqual([(l.user_id, l.message_id) for l in Likes.query],
+                         [(self.u1_id, self.m1_id)])
+        self.assertEqual(buffer.pending, {})
+
+    def test_buffer_drops_deleted_messages(self):
+        """A like of a since-deleted message doesn't sink the batch"""
+
+        buffer = self.make_buffer()
+        buffer.ensure_flusher = lambda: None
+
+        buffer.put(self.u1_id, self.m1_id, True)
+        buffer.put(self.u1_id, 12345, True)
+        buffer.flush()
+
+        self.assertEqual(Likes.query.count(), 1)
+
+    def test_log_replay(self):
+        """Unflushed writes survive a restart through the log"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "likes.log")
+
+            crashed = self.make_buffer(path)
+            crashed.ensure_flusher = lambda: None
+            crashed.put(self.u1_id, self.m1_id, True)
+            crashed.put(self.u1_id, self.m2_id, True)
+            crashed.put(self.u1_id, self.m2_id, False)
+
+            restarted = self.make_buffer(path)
+            self.assertEqual(set(restarted.pending),
+                             {(self.u1_id, self.m1_id),
+                              (self.u1_id, self.m2_id)})
+
+            restarted.flush()
+            self.assertEqual(Likes.query.count(), 1)
+            self.assertEqual(os.listdir(directory), ["likes.log"])
@@ -154,6 +154,18 @@ class MessageViewTestCase(TestCase):
             m2 = Message.query.first()
             self.assertIsNone(m2, msg="Message should be deleted")
 
+    def test_messages_destroy_missing(self):
+        """Delete a message that doesn't exist
+        /messages/<int:message_id>/delete POST"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/messages/999999/delete")
+
+            self.assertEqual(resp.status_code, 404)
+
     def test_messages_destroy_not_logged_in(self):
         """Delete a message while NOT logged in
         /messages/<int:message_id>/delete POST"""
@@ -0,0 +1,83 @@
+"""Metrics endpoint tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_metrics.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy.exc import DatabaseError
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['METRICS_TOKEN'] = "scrape-token"
+
+SCRAPER = {"Authorization": "Bearer scrape-token"}
+
+db.create_all()
+
+
+class MetricsTestCase(TestCase):
+    """Test the /metrics endpoint"""
+
+    def setUp(self):
+        self.client = app.test_client()
+
+    def test_metrics_records_routes(self):
+        """A request shows up in the latency, query and status series"""
+
+        self.client.get("/users")
+        resp = self.client.get("/metrics", headers=SCRAPER)
+        text = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        self.assertIn('warbler_request_duration_seconds_bucket{route="/users",method="GET",le="+Inf"}', text)
+        self.assertIn('warbler_requests_total{route="/users",method="GET",status="200"}', text)
+        self.assertIn('warbler_db_queries_total{route="/users",method="GET"}', text)
+        self.assertIn('warbler_template_duration_seconds_total{route="/users",method="GET"}', text)
+
+    def test_unmatched_route(self):
+        """404s are grouped under one label, not one per URL"""
+
+        self.client.get("/no/such/page")
+        text = self.client.get("/metrics", headers=SCRAPER).get_data(as_text=True)
+
+        self.assertIn('route="unmatched",method="GET",status="404"', text)
+        self.assertNotIn("/no/such/page", text)
+
+    def test_needs_token_or_allowed_ip(self):
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", headers={
+            "Authorization": "Bearer wrong"}).status_code, 403)
+
+        app.config['METRICS_ALLOWED_IPS'] = ["10.0.0.5"]
+        try:
+            resp = self.client.get("/metrics",
+                                   environ_base={"REMOTE_ADDR": "10.0.0.5"})
+            self.assertEqual(resp.status_code, 200)
+
+            # Only the connection's own address counts.
+            resp = self.client.get("/metrics",
+                                   headers={"X-Forwarded-For": "10.0.0.5"})
+            self.assertEqual(resp.status_code, 403)
+        finally:
+            app.config['METRICS_ALLOWED_IPS'] = []
+
+    def test_failed_query_forgets_start(self):
+        """A failed statement doesn't leave its start time on the connection"""
+
+        with db.engine.connect() as conn:
+            for _ in range(3):
+                with self.assertRaises(DatabaseError):
+                    conn.execute("SELECT nope FROM no_such_table")
+
+            self.assertEqual(conn.info.get('query_start'), [])
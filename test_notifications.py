@@ -0,0 +1,176 @@
+"""Notification digest tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_notifications.py
+
+
+import json
+import os
+from unittest import TestCase
+
+from models import db, Message, User, Follows, Likes, Notification, \
+    NotificationActor
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import notifications
+from notifications import notifier
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+# Flush by hand instead of from the background thread.
+notifier.ensure_flusher = lambda: None
+
+
+class NotificationsTestCase(TestCase):
+    """Test buffering, digests and the unread counter"""
+
+    def setUp(self):
+        NotificationActor.query.delete()
+        Notification.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        notifier.pending = []
+
+        self.client = app.test_client()
+
+        users = [User.signup(f"notified{i}", f"notified{i}@test.com",
+                             "password", None)
+                 for i in range(5)]
+        db.session.commit()
+        self.user_ids = [user.id for user in users]
+        self.author_id = self.user_ids[0]
+
+        message = Message(text="notable", user_id=self.author_id)
+        db.session.add(message)
+        db.session.commit()
+        self.message_id = message.id
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def like(self, user_id):
+        self.login(user_id)
+        self.client.post(f"/messages/{self.message_id}/like",
+                         data={"curr_user": user_id})
+
+    def unread(self, user_id):
+        db.session.expire_all()
+        return User.query.get(user_id).unread_notifications
+
+    def test_likes_collapse_into_one_digest(self):
+        for user_id in self.user_ids[1:]:
+            self.like(user_id)
+        self.like(self.user_ids[1])  # a double-click
+
+        self.assertEqual(Notification.query.count(), 0)
+        notifier.flush()
+
+        digest = Notification.query.one()
+        self.assertEqual(digest.recipient_id, self.author_id)
+        self.assertEqual(digest.actor_count, 4)
+        self.assertEqual(digest.actor_id, self.user_ids[1])
+        self.assertEqual(self.unread(self.author_id), 1)
+
+    def test_later_batch_joins_unread_digest(self):
+        self.like(self.user_ids[1])
+        notifier.flush()
+        self.like(self.user_ids[2])
+        notifier.flush()
+
+        self.assertEqual(Notification.query.one().actor_count, 2)
+        self.assertEqual(self.unread(self.author_id), 1)
+
+    def test_liking_again_counts_once(self):
+        self.like(self.user_ids[1])
+        notifier.flush()
+
+        self.login(self.user_ids[1])
+        self.client.post(f"/messages/{self.message_id}/like/delete",
+                         data={"curr_user": self.user_ids[1]})
+        self.like(self.user_ids[1])
+        notifier.flush()
+        self.like(self.user_ids[1])
+        self.like(self.user_ids[2])
+        notifier.flush()
+
+        self.assertEqual(Notification.query.one().actor_count, 2)
+        self.assertEqual(self.unread(self.author_id), 1)
+
+    def test_own_like_ignored(self):
+        self.like(self.author_id)
+        notifier.flush()
+
+        self.assertEqual(Notification.query.count(), 0)
+
+    def test_follows(self):
+        for user_id in self.user_ids[1:3]:
+            self.login(user_id)
+            self.client.post(f"/users/follow/{self.author_id}")
+        self.like(self.user_ids[3])
+        notifier.flush()
+
+        self.assertEqual(Notification.query.count(), 2)
+        self.assertEqual(self.unread(self.author_id), 2)
+
+        self.login(self.author_id)
+        html = self.client.get("/notifications").get_data(as_text=True)
+
+        self.assertIn("and 1 other", html)
+        self.assertIn("followed you", html)
+        self.assertIn("liked your warble", html)
+
+    def test_viewing_marks_read(self):
+        self.like(self.user_ids[1])
+        notifier.flush()
+
+        self.login(self.author_id)
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn('<span class="badge badge-primary">1</span>', html)
+
+        self.client.get("/notifications")
+        self.assertEqual(self.unread(self.author_id), 0)
+        self.assertFalse(Notification.query.one().unread)
+
+        # New activity starts a fresh digest.
+        self.like(self.user_ids[2])
+        notifier.flush()
+
+        self.assertEqual(Notification.query.count(), 2)
+        self.assertEqual(self.unread(self.author_id), 1)
+
+    def test_unread_api(self):
+        self.like(self.user_ids[1])
+        notifier.flush()
+
+        self.login(self.author_id)
+        resp = self.client.get("/api/v1/notifications/unread")
+
+        self.assertEqual(json.loads(resp.get_data(as_text=True)), {"unread": 1})
+
+    def test_failed_flush_keeps_events(self):
+        self.like(self.user_ids[1])
+        pending = list(notifier.pending)
+
+        original = notifications.write
+
+        def broken(events):
+            raise RuntimeError("database went away")
+
+        notifications.write = broken
+        try:
+            with self.assertRaises(RuntimeError):
+                notifier.flush()
+        finally:
+            notifications.write = original
+
+        self.assertEqual(notifier.pending, pending)
@@ -0,0 +1,133 @@
+"""Anonymous full-page cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_page_cache.py
+
+
+import threading
+from time import sleep
+from unittest import TestCase
+
+from flask import Flask, flash, session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import Metrics
+from page_cache import PageCache
+
+
+class PageCacheTestCase(TestCase):
+    """Test PageCache on a small app of its own"""
+
+    def setUp(self):
+        self.renders = 0
+
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = "test"
+        app.config['PAGE_CACHE_ENABLED'] = True
+        app.config['PAGE_CACHE_ENDPOINTS'] = ['page', 'slow']
+        app.config['PAGE_CACHE_MAX_BYTES'] = 1000
+        self.cache = cache = PageCache(app)
+
+        @app.route('/page/<int:page_id>')
+        def page(page_id):
+            self.renders += 1
+            cache.depends_on(f"page:{page_id}")
+            return f"page {page_id} render {self.renders}"
+
+        @app.route('/slow')
+        def slow():
+            sleep(0.2)
+            self.renders += 1
+            return "x" * 600
+
+        @app.route('/login')
+        def login():
+            session['curr_user'] = 1
+            return "ok"
+
+        @app.route('/flash')
+        def flash_something():
+            flash("hello")
+            return "ok"
+
+        self.client = app.test_client()
+
+    def test_hit(self):
+        first = self.client.get("/page/1")
+        second = self.client.get("/page/1")
+
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(self.renders, 1)
+
+    def test_hits_reach_earlier_extensions(self):
+        """Hooks registered before the cache (as metrics is) see hits"""
+
+        app = Flask(__name__)
+        app.config['PAGE_CACHE_ENABLED'] = True
+        app.config['PAGE_CACHE_ENDPOINTS'] = ['page']
+        metrics = Metrics(app)
+        self.addCleanup(event.remove, Engine, 'before_cursor_execute',
+                        metrics.start_query)
+        self.addCleanup(event.remove, Engine, 'after_cursor_execute',
+                        metrics.finish_query)
+        PageCache(app)
+
+        app.add_url_rule('/page', 'page', lambda: "page")
+        client = app.test_client()
+        for _ in range(2):
+            client.get("/page")
+
+        self.assertIn('warbler_requests_total{route="/page",method="GET",'
+                      'status="200"} 2',
+                      metrics.exposition())
+
+    def test_invalidate(self):
+        self.client.get("/page/1")
+        self.client.get("/page/2")
+        self.cache.invalidate("page:1")
+
+        self.assertEqual(self.client.get("/page/1").headers['X-Cache'], 'MISS')
+        self.assertEqual(self.client.get("/page/2").headers['X-Cache'], 'HIT')
+
+    def test_sessions_bypass(self):
+        """Logged-in users and pending flashes never see cached pages"""
+
+        self.client.get("/page/1")
+        self.client.get("/login")
+
+        self.assertNotIn('X-Cache', self.client.get("/page/1").headers)
+
+        other = self.client.application.test_client()
+        other.get("/flash")
+        self.assertNotIn('X-Cache', other.get("/page/1").headers)
+
+    def test_size_bound(self):
+        """Least recently used pages go once over PAGE_CACHE_MAX_BYTES"""
+
+        self.client.get("/slow")
+        self.client.get("/slow?again=1")
+
+        self.assertLessEqual(self.cache.size, 1000)
+        self.assertEqual(list(self.cache.entries), ["/slow?again=1"])
+
+    def test_stampede(self):
+        """Concurrent misses for one page render it once"""
+
+        statuses = []
+
+        def fetch():
+            statuses.append(self.client.application.test_client()
+                            .get("/slow").headers['X-Cache'])
+
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(sorted(statuses), ['HIT'] * 4 + ['MISS'])
@@ -0,0 +1,140 @@
+"""Message partitioning tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_partitions.py
+#
+# The partition tests need the PostgreSQL test database; on anything else
+# they're skipped.
+
+
+import os
+from datetime import datetime
+from unittest import TestCase, skipUnless
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import feeds
+import partitions
+from snowflake import id_for_datetime
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+ON_POSTGRESQL = db.engine.dialect.name == 'postgresql'
+
+
+class MonthTestCase(TestCase):
+    """Test partition bounds"""
+
+    def test_add_months(self):
+        month = datetime(2026, 11, 1)
+
+        self.assertEqual(partitions.add_months(month, 1), datetime(2026, 12, 1))
+        self.assertEqual(partitions.add_months(month, 2), datetime(2027, 1, 1))
+        self.assertEqual(partitions.add_months(month, 14), datetime(2028, 1, 1))
+
+    def test_bounds_are_contiguous(self):
+        month = datetime(2026, 12, 1)
+        low, high = partitions.month_bounds(month)
+
+        self.assertEqual(low, id_for_datetime(month))
+        self.assertEqual(high,
+                         partitions.month_bounds(datetime(2027, 1, 1))[0])
+        self.assertEqual(partitions.partition_name(month), "messages_2026_12")
+
+    def test_message_ranges(self):
+        before_id = id_for_datetime(datetime(2026, 10, 19))
+        (_, floor, first_before), (_, rest_after, rest_before), _ = \
+            feeds.message_ranges(before_id)
+
+        self.assertEqual(floor, id_for_datetime(datetime(2026, 9, 19)))
+        self.assertEqual((first_before, rest_after, rest_before),
+                         (before_id, None, floor))
+
+    def test_not_partitioned(self):
+        if not ON_POSTGRESQL:
+            self.assertIsNone(partitions.ensure_partitions())
+
+
+@skipUnless(ON_POSTGRESQL, "needs PostgreSQL")
+class PartitionTestCase(TestCase):
+    """Test creating partitions and pruning on a scratch partitioned table"""
+
+    TABLE = 'messages_partition_test'
+
+    def setUp(self):
+        with db.engine.begin() as connection:
+            connection.execute(f"DROP TABLE IF EXISTS {self.TABLE}")
+            connection.execute(f"CREATE TABLE {self.TABLE} "
+                               f"(LIKE messages) PARTITION BY RANGE (id)")
+
+    def tearDown(self):
+        with db.engine.begin() as connection:
+            connection.execute(f"DROP TABLE IF EXISTS {self.TABLE}")
+
+    def create(self, first, last):
+        with db.engine.begin() as connection:
+            return partitions.create_partitions(connection, first, last,
+                                                table=self.TABLE)
+
+    def test_create_partitions(self):
+        created = self.create(datetime(2026, 11, 1), datetime(2027, 1, 1))
+
+        self.assertEqual(created, [f"{self.TABLE}_2026_11",
+                                   f"{self.TABLE}_2026_12",
+                                   f"{self.TABLE}_2027_01"])
+
+        # Existing months are left alone.
+        self.assertEqual(self.create(datetime(2026, 12, 1),
+                                     datetime(2027, 2, 1)),
+                         [f"{self.TABLE}_2027_02"])
+
+        with db.engine.begin() as connection:
+            self.assertTrue(partitions.is_partitioned(connection, self.TABLE))
+            self.assertEqual(len(partitions.partition_names(connection,
+                                                            self.TABLE)), 4)
+
+    def test_rows_land_in_their_month(self):
+        self.create(datetime(2026, 9, 1), datetime(2026, 10, 1))
+        user = User.signup("partitioned", "partitioned@test.com", "password",
+                           None)
+        db.session.commit()
+
+        with db.engine.begin() as connection:
+            for when in (datetime(2026, 9, 30, 23, 59), datetime(2026, 10, 1)):
+                connection.execute(
+                    f"INSERT INTO {self.TABLE} (id, text, timestamp, user_id) "
+                    f"VALUES (%s, 'hi', %s, %s)",
+                    id_for_datetime(when), when, user.id)
+
+            counts = [connection.execute(
+                          f"SELECT count(*) FROM {self.TABLE}_2026_{month}"
+                      ).scalar()
+                      for month in ('09', '10')]
+
+        self.assertEqual(counts, [1, 1])
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_bounded_query_is_pruned(self):
+        self.create(datetime(2026, 7, 1), datetime(2026, 10, 1))
+        floor = id_for_datetime(datetime(2026, 9, 15))
+
+        with db.engine.begin() as connection:
+            plan = "\n".join(row[0] for row in connection.execute(
+                f"EXPLAIN SELECT * FROM {self.TABLE} "
+                f"WHERE user_id IN (1, 2) AND id >= {floor} "
+                f"ORDER BY id DESC LIMIT 50"))
+
+        self.assertIn(f"{self.TABLE}_2026_09", plan)
+        self.assertIn(f"{self.TABLE}_2026_10", plan)
+        self.assertNotIn(f"{self.TABLE}_2026_08", plan)
+        self.assertNotIn(f"{self.TABLE}_2026_07", plan)
@@ -0,0 +1,116 @@
+"""Sampling profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import os
+import shutil
+import tempfile
+from glob import glob
+from unittest import TestCase
+
+from flask import Flask, g
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DatabaseError
+
+from profiler import Profiler
+
+
+class ProfilerTestCase(TestCase):
+    """Test which requests are kept, what's written and rotation"""
+
+    def make_app(self, sample_rate=0.0, slow_ms=60000, keep=100):
+        app = Flask(__name__)
+        app.config.update(PROFILE_ENABLED=True,
+                          PROFILE_SAMPLE_RATE=sample_rate,
+                          PROFILE_SLOW_MS=slow_ms,
+                          PROFILE_DIR=self.directory,
+                          PROFILE_KEEP=keep)
+
+        self.profiler = Profiler()
+        # Stacks are recorded by hand below, not by the sampler thread.
+        self.profiler.ensure_sampler = lambda: None
+        self.profiler.init_app(app)
+
+        engine = create_engine('sqlite://')
+
+        @app.route('/work')
+        def work():
+            g.profile_capture.stacks['view (app.py:1);query (db.py:2)'] += 3
+            g.profile_capture.stacks['view (app.py:1)'] += 1
+            engine.execute("SELECT 42")
+            return "done"
+
+        return app.test_client()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = None
+
+    def tearDown(self):
+        if self.profiler is not None:
+            event.remove(Engine, 'before_cursor_execute',
+                         self.profiler.start_query)
+            event.remove(Engine, 'after_cursor_execute',
+                         self.profiler.finish_query)
+            event.remove(Engine, 'handle_error', self.profiler.query_failed)
+        shutil.rmtree(self.directory)
+
+    def captures(self, extension='folded'):
+        return sorted(glob(os.path.join(self.directory, f"*.{extension}")))
+
+    def test_fast_unsampled_request_discarded(self):
+        self.make_app(sample_rate=0.0, slow_ms=60000).get('/work')
+
+        self.assertEqual(self.captures(), [])
+        self.assertEqual(self.profiler.active, {})
+
+    def test_sampled_request_kept(self):
+        self.make_app(sample_rate=1.0, slow_ms=60000).get('/work')
+
+        self.assertEqual(len(self.captures()), 1)
+        self.assertEqual(len(self.captures('sql')), 1)
+
+    def test_slow_request_kept(self):
+        self.make_app(sample_rate=0.0, slow_ms=0).get('/work')
+
+        [capture] = self.captures()
+        self.assertIn("-work-", os.path.basename(capture))
+
+    def test_capture_contents(self):
+        self.make_app(slow_ms=0).get('/work?q=1')
+
+        [folded] = self.captures()
+        with open(folded) as f:
+            self.assertEqual(f.read().splitlines(),
+                             ["view (app.py:1);query (db.py:2) 3",
+                              "view (app.py:1) 1"])
+
+        [sql] = self.captures('sql')
+        with open(sql) as f:
+            text = f.read()
+        self.assertTrue(text.startswith("-- GET /work?q=1 -> 200, "))
+        self.assertIn("1 statements", text)
+        self.assertIn("SELECT 42;", text)
+
+    def test_failed_query_forgets_start(self):
+        self.make_app()
+        engine = create_engine('sqlite://')
+
+        with engine.connect() as conn:
+            for _ in range(3):
+                with self.assertRaises(DatabaseError):
+                    conn.execute("SELECT nope FROM no_such_table")
+
+            self.assertEqual(conn.info['profile_query_start'], [])
+
+    def test_rotation(self):
+        client = self.make_app(slow_ms=0, keep=2)
+        for _ in range(4):
+            client.get('/work')
+
+        self.assertEqual(len(self.captures()), 2)
+        self.assertEqual(len(self.captures('sql')), 2)
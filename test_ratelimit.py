@@ -0,0 +1,132 @@
+"""Rate limiting tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from metrics import metrics
+from ratelimit import LocalStore, limiter, parse_rule
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class RuleTestCase(TestCase):
+    """Test parse_rule"""
+
+    def test_parse(self):
+        rule = parse_rule("POST,PUT 10 per minute per user")
+
+        self.assertEqual(rule.methods, {'POST', 'PUT'})
+        self.assertEqual((rule.count, rule.period, rule.scope),
+                         (10, 60, 'user'))
+        self.assertIsNone(parse_rule("3 per second per ip").methods)
+
+    def test_bad_rule(self):
+        with self.assertRaises(ValueError):
+            parse_rule("lots per minute")
+
+
+class LocalStoreTestCase(TestCase):
+    """Test the in-process token buckets"""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = LocalStore(shards=2, max_keys=4, clock=self.clock)
+
+    def test_bucket(self):
+        """A bucket allows a burst of `capacity`, then refills at `rate`"""
+
+        for _ in range(3):
+            self.assertEqual(self.store.take('k', 1.0, 3), 0)
+
+        self.assertAlmostEqual(self.store.take('k', 1.0, 3), 1.0)
+
+        self.clock.now += 1
+        self.assertEqual(self.store.take('k', 1.0, 3), 0)
+        self.assertEqual(self.store.take('other', 1.0, 3), 0)
+
+    def test_eviction(self):
+        """Full shards stay bounded"""
+
+        for i in range(100):
+            self.store.take(f'k{i}', 1.0, 3)
+
+        self.assertLessEqual(sum(len(b) for b, _ in self.store.shards), 4)
+
+
+class RateLimitViewTestCase(TestCase):
+    """Test 429 responses"""
+
+    def setUp(self):
+        self.rules = limiter.rules
+        limiter.rules = {'login': [parse_rule("POST 2 per minute per ip")]}
+        limiter.store.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        limiter.rules = self.rules
+        limiter.store.clear()
+
+    def test_too_many_requests(self):
+        data = {"username": "nobody", "password": "password"}
+
+        for _ in range(2):
+            self.assertEqual(self.client.post("/login", data=data).status_code,
+                             200)
+
+        resp = self.client.post("/login", data=data)
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], "30")
+        self.assertIn('warbler_rate_limited_total{route="login",scope="ip"}',
+                      metrics.exposition())
+
+        # GETs don't spend tokens under a POST rule.
+        self.assertEqual(self.client.get("/login").status_code, 200)
+
+    def test_rejected_requests_spare_later_rules(self):
+        limiter.rules = {'login': [parse_rule("POST 1 per minute per ip"),
+                                   parse_rule("POST 2 per minute per ip")]}
+
+        self.assertEqual(limiter.wait_time('login', 'POST', '1.2.3.4'), 0)
+        for _ in range(3):
+            self.assertTrue(limiter.wait_time('login', 'POST', '1.2.3.4'))
+
+        # The second bucket still has the token the first one saved.
+        self.assertEqual(limiter.store.take('login:1:ip:1.2.3.4', 2 / 60, 2),
+                         0)
+
+    def test_proxies(self):
+        data = {"username": "nobody", "password": "password"}
+        limiter.proxies = 1
+
+        try:
+            for client in ("10.0.0.1", "10.0.0.2", "10.0.0.1"):
+                resp = self.client.post(
+                    "/login", data=data,
+                    headers={"X-Forwarded-For": f"6.6.6.6, {client}"})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = self.client.post("/login", data=data,
+                                    headers={"X-Forwarded-For": "10.0.0.1"})
+            self.assertEqual(resp.status_code, 429)
+        finally:
+            limiter.proxies = 0
@@ -0,0 +1,278 @@
+"""Message sharding tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_shards.py
+#
+# The shards are SQLite files in a temporary directory.
+
+
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, MessageTag, \
+    MessageMention, Notification, NotificationActor
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from archive import archive_messages_command
+from author_feeds import author_feeds
+import export
+import feeds
+import notifications
+from shards import HashRing, message_shards
+import tags
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class HashRingTestCase(TestCase):
+    """Test the consistent-hash map"""
+
+    def test_adding_a_shard_moves_a_fair_share(self):
+        old = HashRing(['a', 'b', 'c'])
+        new = HashRing(['a', 'b', 'c', 'd'])
+        moved = [user_id for user_id in range(10000)
+                 if old.shard_for(user_id) != new.shard_for(user_id)]
+
+        self.assertTrue(1500 < len(moved) < 3500)
+        self.assertEqual({new.shard_for(user_id) for user_id in moved}, {'d'})
+
+    def test_stable(self):
+        self.assertEqual([HashRing(['b', 'a']).shard_for(i) for i in range(50)],
+                         [HashRing(['a', 'b']).shard_for(i) for i in range(50)])
+
+
+class ShardsTestCase(TestCase):
+    """Test routing, scatter-gather reads and rebalancing"""
+
+    def setUp(self):
+        NotificationActor.query.delete()
+        Notification.query.delete()
+        MessageTag.query.delete()
+        MessageMention.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.directory = tempfile.mkdtemp()
+        self.configure('one', 'two', 'three')
+
+        self.client = app.test_client()
+
+        users = [User.signup(f"sharded{i}", f"sharded{i}@test.com",
+                             "password", None)
+                 for i in range(6)]
+        db.session.commit()
+        self.user_ids = [user.id for user in users]
+
+        db.session.add_all([Follows(user_being_followed_id=user_id,
+                                    user_following_id=self.user_ids[0])
+                            for user_id in self.user_ids[1:]])
+        db.session.commit()
+
+    def tearDown(self):
+        message_shards.configure({})
+        shutil.rmtree(self.directory)
+
+    def configure(self, *names):
+        message_shards.configure({name: f"sqlite:///{self.directory}/{name}.db"
+                                  for name in names})
+        message_shards.create_all()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        self.login(user_id)
+        self.client.post("/messages/new", data={"text": text})
+
+    def on_shard(self, name):
+        with message_shards.session(name) as session:
+            return {(msg.user_id, msg.text) for msg in session.query(Message)}
+
+    def test_messages_go_to_author_shard(self):
+        for user_id in self.user_ids:
+            self.post(user_id, f"from {user_id}")
+
+        self.assertEqual(Message.query.count(), 0)
+        for user_id in self.user_ids:
+            self.assertIn((user_id, f"from {user_id}"),
+                          self.on_shard(message_shards.shard_for(user_id)))
+
+    def test_timeline_merges_shards(self):
+        self.assertGreater(len(message_shards.by_author(self.user_ids)), 1)
+
+        for n in range(3):
+            for user_id in self.user_ids:
+                self.post(user_id, f"{n} from {user_id}")
+
+        messages = feeds.timeline_messages(set(self.user_ids), limit=10)
+
+        self.assertEqual([m.id for m in messages],
+                         sorted((m.id for m in messages), reverse=True))
+        self.assertEqual([m.text for m in messages[:6]],
+                         [f"2 from {user_id}"
+                          for user_id in reversed(self.user_ids)])
+        self.assertEqual(messages[0].username, "sharded5")
+
+        self.login(self.user_ids[0])
+        html = self.client.get("/").get_data(as_text=True)
+        self.assertIn("2 from", html)
+
+        page = feeds.timeline_messages(set(self.user_ids), limit=10,
+                                       before=str(messages[-1].id))
+        self.assertEqual(len(page), 8)
+
+    def test_likes_follow_their_message(self):
+        author_id, fan_id = self.user_ids[1], self.user_ids[2]
+        self.post(author_id, "likeable")
+        message_id = feeds.user_messages(author_id)[0].id
+
+        self.login(fan_id)
+        self.client.post(f"/messages/{message_id}/like",
+                         data={"curr_user": fan_id})
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(feeds.like_states([message_id], fan_id),
+                         {message_id: feeds.LikeState(1, True)})
+        self.assertEqual(feeds.user_stats(fan_id).likes, 1)
+        self.assertEqual(feeds.user_stats(author_id).messages, 1)
+
+        resp = self.client.get(f"/messages/{message_id}")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("likeable", resp.get_data(as_text=True))
+
+        self.login(author_id)
+        self.client.post(f"/messages/{message_id}/delete")
+
+        self.assertEqual(feeds.user_messages(author_id), [])
+        self.assertEqual(feeds.like_states([message_id], fan_id),
+                         {message_id: feeds.NOT_LIKED})
+
+    def test_rebalance(self):
+        for user_id in self.user_ids:
+            self.post(user_id, f"before from {user_id}")
+        before = feeds.timeline_messages(set(self.user_ids))
+
+        self.configure('one', 'two', 'three', 'four', 'five')
+        progress = []
+        moved = message_shards.rebalance(batch=1, progress=progress.append)
+
+        self.assertGreater(moved, 0)
+        self.assertEqual(moved, len(progress))
+        for name in message_shards.ring.names:
+            for user_id, _ in self.on_shard(name):
+                self.assertEqual(message_shards.shard_for(user_id), name)
+        self.assertEqual(feeds.timeline_messages(set(self.user_ids)), before)
+
+        # Nothing left to move.
+        self.assertEqual(message_shards.rebalance(), 0)
+
+    def like(self, user_id, message_id):
+        self.login(user_id)
+        self.client.post(f"/messages/{message_id}/like",
+                         data={"curr_user": user_id})
+
+    def test_batch_api_and_index_pages(self):
+        author_id = self.user_ids[1]
+        self.login(author_id)
+        resp = self.client.post("/api/v1/messages/batch",
+                                json={"messages": [{"text": "one #sharded"},
+                                                   {"text": "two #sharded"},
+                                                   {"text": "hi @sharded3"}]})
+        self.assertEqual(resp.status_code, 201)
+
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(len(self.on_shard(message_shards.shard_for(author_id))),
+                         3)
+
+        page = feeds.tag_messages("sharded", limit=1)
+        self.assertEqual([m.text for m in page.items], ["two #sharded"])
+        self.assertEqual(page.items[0].username, "sharded1")
+        page = feeds.tag_messages("sharded", before=page.next_cursor, limit=1)
+        self.assertEqual([m.text for m in page.items], ["one #sharded"])
+
+        page = feeds.mention_messages(self.user_ids[3])
+        self.assertEqual([m.text for m in page.items], ["hi @sharded3"])
+
+    def test_liked_messages_and_export(self):
+        fan_id = self.user_ids[0]
+        authors = [user_id for user_id in self.user_ids[1:]
+                   if message_shards.shard_for(user_id)
+                   != message_shards.shard_for(self.user_ids[1])][:1]
+        authors.insert(0, self.user_ids[1])
+
+        for author_id in authors:
+            self.post(author_id, f"by {author_id}")
+            self.like(fan_id, feeds.user_messages(author_id)[0].id)
+        self.post(fan_id, "my own")
+
+        page = feeds.liked_messages(fan_id, limit=1)
+        self.assertEqual([m.text for m in page.items], [f"by {authors[1]}"])
+        page = feeds.liked_messages(fan_id, before=page.next_cursor)
+        self.assertEqual([m.text for m in page.items], [f"by {authors[0]}"])
+        self.assertIsNone(page.next_cursor)
+
+        records = list(export.records(fan_id))
+        self.assertEqual([r['text'] for r in records if r['type'] == 'message'],
+                         ["my own"])
+        self.assertEqual(len([r for r in records if r['type'] == 'like']), 2)
+
+    def test_like_notifications(self):
+        author_id, fan_id = self.user_ids[1], self.user_ids[2]
+        self.post(author_id, "notable")
+        message_id = feeds.user_messages(author_id)[0].id
+
+        notifications.write([notifications.Event(
+            notifications.LIKE, fan_id, None, message_id, datetime.utcnow())])
+
+        [digest] = notifications.notification_page(author_id).items
+        self.assertEqual((digest.actor_id, digest.message_text),
+                         (fan_id, "notable"))
+
+    def test_author_feeds(self):
+        for user_id in self.user_ids:
+            self.post(user_id, f"from {user_id}")
+
+        loaded = author_feeds.load(self.user_ids)
+
+        for user_id in self.user_ids:
+            self.assertEqual([row.text for row in loaded[user_id]],
+                             [f"from {user_id}"])
+
+    def test_delete_user_removes_index_rows(self):
+        user_id = self.user_ids[1]
+        self.post(user_id, "going #away")
+        self.assertEqual(MessageTag.query.count(), 1)
+
+        self.login(user_id)
+        self.client.post("/users/delete")
+
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(self.on_shard(message_shards.shard_for(user_id)),
+                         set())
+
+    def test_backfill_tags(self):
+        for user_id in self.user_ids:
+            message_shards.add_message(user_id, f"#backfilled by {user_id}")
+
+        self.assertEqual(tags.backfill(workers=1, chunk=2), 6)
+        self.assertEqual(len(feeds.tag_messages("backfilled").items), 6)
+
+    def test_archive_refuses(self):
+        result = app.test_cli_runner().invoke(archive_messages_command)
+
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("MESSAGE_SHARDS", result.output)
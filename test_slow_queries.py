@@ -0,0 +1,216 @@
+"""Slow-query log tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slow_queries.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from slow_queries import SlowQueryLog, fingerprint, param_shape, slow_queries
+
+
+class FingerprintTestCase(TestCase):
+    """Test slow_queries.fingerprint"""
+
+    def test_literals_and_placeholders(self):
+        """Literals and every paramstyle normalize to ?"""
+
+        self.assertEqual(
+            fingerprint("SELECT * FROM users WHERE username = 'it''s' "
+                        "AND id = 5 AND email = %(email_1)s"),
+            "SELECT * FROM users WHERE username = ? AND id = ? AND email = ?")
+
+    def test_in_lists_collapse(self):
+        """IN lists of any length share one fingerprint"""
+
+        short = fingerprint("SELECT 1 FROM messages WHERE user_id IN (%(u_1)s)")
+        long = fingerprint("SELECT 1 FROM messages WHERE user_id IN "
+                           "(%(u_1)s, %(u_2)s,\n %(u_3)s)")
+
+        self.assertEqual(short, long)
+        self.assertIn("IN (...)", short)
+
+    def test_identifiers_kept(self):
+        """Numbered identifiers like count_1 aren't mistaken for literals"""
+
+        self.assertIn("count_1", fingerprint("SELECT count(*) AS count_1 FROM likes"))
+
+
+class ParamShapeTestCase(TestCase):
+    """Test slow_queries.param_shape"""
+
+    def test_dict_params(self):
+        """Expanded IN params group by base name; values never appear"""
+
+        shape = param_shape({"user_id_1": 1, "user_id_2": 2, "param_1": "secret"})
+
+        self.assertEqual(shape, "param:str, user_id:int×2")
+        self.assertNotIn("secret", shape)
+
+    def test_positional_params(self):
+        self.assertEqual(param_shape((1, 2, "x")), "int×2, str")
+        self.assertEqual(param_shape(()), "-")
+
+
+class FakeCursor:
+    """DBAPI cursor that records statements and fails EXPLAINs on request."""
+
+    def __init__(self, executed, fail_explain):
+        self.executed = executed
+        self.fail_explain = fail_explain
+
+    def execute(self, statement, parameters=None):
+        self.executed.append(statement)
+        if statement.startswith('EXPLAIN') and self.fail_explain:
+            raise RuntimeError("bad plan")
+
+    def fetchall(self):
+        return [("Seq Scan on users",)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """Just enough of a PostgreSQL Connection for SlowQueryLog.explain."""
+
+    def __init__(self, fail_explain=False):
+        self.executed = []
+        self.dialect = type('Dialect', (), {'name': 'postgresql'})
+        cursor = FakeCursor(self.executed, fail_explain)
+        self.connection = type('DBAPIConnection', (), {
+            'cursor': lambda _: cursor})()
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test the cursor hooks, EXPLAIN and the report"""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.engine.execute("CREATE TABLE users (id INTEGER PRIMARY KEY)")
+
+        self.log = SlowQueryLog()
+        self.log.threshold = 0
+        self.log.explain_every = 300
+        self.log.top_n = 20
+
+        event.listen(self.engine, 'before_cursor_execute', self.log.start_query)
+        event.listen(self.engine, 'after_cursor_execute', self.log.finish_query)
+        event.listen(self.engine, 'handle_error', self.log.query_failed)
+
+    def test_slow_statement_recorded(self):
+        self.engine.execute(text("SELECT id FROM users WHERE id = :id"), id=1)
+
+        [stats] = self.log.stats.values()
+        self.assertEqual(stats.sql, "SELECT id FROM users WHERE id = ?")
+        self.assertEqual(stats.calls, 1)
+        self.assertEqual(list(stats.shapes), ["int"])  # sqlite's are positional
+        self.assertIn("users", stats.plan)
+
+    def test_threshold(self):
+        self.log.threshold = 60
+
+        self.engine.execute("SELECT id FROM users")
+
+        self.assertEqual(self.log.stats, {})
+
+    def test_explained_once_per_interval(self):
+        explained = []
+        self.log.explain = lambda *args: explained.append(args) or "plan"
+
+        for _ in range(3):
+            self.engine.execute("SELECT id FROM users")
+        self.assertEqual(len(explained), 1)
+
+        self.log.explain_every = 0
+        self.engine.execute("SELECT id FROM users")
+        self.assertEqual(len(explained), 2)
+
+        [stats] = self.log.stats.values()
+        self.assertEqual(stats.calls, 4)
+
+    def test_failed_statement_forgets_start(self):
+        with self.engine.connect() as conn:
+            for _ in range(3):
+                with self.assertRaises(OperationalError):
+                    conn.execute("SELECT nope FROM users")
+
+            self.assertEqual(conn.info['slow_query_start'], [])
+
+    def test_explain_in_savepoint(self):
+        conn = FakeConnection()
+
+        plan = self.log.explain(conn, "SELECT * FROM users", {})
+
+        self.assertEqual(plan, "Seq Scan on users")
+        self.assertEqual(conn.executed,
+                         ['SAVEPOINT slow_query_explain',
+                          'EXPLAIN SELECT * FROM users',
+                          'RELEASE SAVEPOINT slow_query_explain'])
+
+    def test_failed_explain_rolls_back_to_savepoint(self):
+        conn = FakeConnection(fail_explain=True)
+
+        plan = self.log.explain(conn, "SELECT * FROM users", {})
+
+        self.assertEqual(plan, "(EXPLAIN failed: bad plan)")
+        self.assertEqual(conn.executed,
+                         ['SAVEPOINT slow_query_explain',
+                          'EXPLAIN SELECT * FROM users',
+                          'ROLLBACK TO SAVEPOINT slow_query_explain'])
+
+    def test_failed_explain_keeps_transaction(self):
+        """A broken EXPLAIN mid-transaction doesn't lose the caller's work"""
+
+        with self.engine.connect() as conn:
+            with conn.begin():
+                conn.execute("INSERT INTO users (id) VALUES (1)")
+                plan = self.log.explain(conn, "SELECT nope FROM users", ())
+                conn.execute("INSERT INTO users (id) VALUES (2)")
+
+        self.assertTrue(plan.startswith("(EXPLAIN failed"))
+        self.assertEqual(self.engine.execute("SELECT count(*) FROM users")
+                         .scalar(), 2)
+
+    def test_report(self):
+        for _ in range(2):
+            self.engine.execute("SELECT id FROM users WHERE id = 1")
+        self.engine.execute("SELECT count(*) FROM users")
+
+        report = self.log.report()
+
+        self.assertIn("threshold 0 ms", report)
+        self.assertIn("SELECT id FROM users WHERE id = ?", report)
+        self.assertIn("2 calls", report)
+        self.assertIn("   from: ", report)
+
+
+class SlowQueryReportViewTestCase(TestCase):
+    """Test the report URL"""
+
+    def test_view(self):
+        slow_queries.record(FakeConnection(), "SELECT * FROM users", {},
+                            0.5, False)
+
+        url = app.config['SLOW_QUERY_REPORT_URL']
+        client = app.test_client()
+        self.assertEqual(client.get(url).status_code, 403)
+
+        app.config['METRICS_TOKEN'] = "scrape-token"
+        try:
+            resp = client.get(url, headers={
+                "Authorization": "Bearer scrape-token"})
+        finally:
+            app.config['METRICS_TOKEN'] = None
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'text/plain; charset=utf-8')
+        self.assertIn("SELECT * FROM users", resp.get_data(as_text=True))
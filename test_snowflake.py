@@ -0,0 +1,76 @@
+"""Snowflake id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+import shutil
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from snowflake import IdGenerator, claim_worker_id, datetime_of, \
+    id_for_datetime, parse_range
+
+
+class SnowflakeTestCase(TestCase):
+    """Test time-ordered id generation"""
+
+    def test_ids_increase(self):
+        """Ids from one generator are unique and strictly increasing"""
+
+        generate = IdGenerator(worker_id=3)
+        ids = [generate() for _ in range(10000)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertLess(ids[-1], 2 ** 63)
+
+    def test_workers_differ(self):
+        """Two workers never hand out the same id"""
+
+        a = [IdGenerator(1)() for _ in range(100)]
+        b = [IdGenerator(2)() for _ in range(100)]
+
+        self.assertFalse(set(a) & set(b))
+
+    def test_datetime_round_trip(self):
+        """An id records its creation time to the millisecond"""
+
+        when = datetime(2017, 1, 21, 11, 4, 53, 522000)
+
+        self.assertEqual(datetime_of(id_for_datetime(when)), when)
+        self.assertLess(id_for_datetime(when), id_for_datetime(datetime(2018, 1, 1)))
+
+    def test_bad_worker_id(self):
+        with self.assertRaises(ValueError):
+            IdGenerator(worker_id=1024)
+
+
+class WorkerIdTestCase(TestCase):
+    """Test claiming worker ids"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_claims_are_exclusive(self):
+        """Each claim gets an id no one else holds; none left is an error"""
+
+        ids = [claim_worker_id(range(3), self.directory) for _ in range(3)]
+        self.assertEqual(ids, [0, 1, 2])
+
+        with self.assertRaises(RuntimeError):
+            claim_worker_id(range(3), self.directory)
+
+    def test_explicit_id_taken(self):
+        claim_worker_id([7], self.directory)
+
+        with self.assertRaises(RuntimeError):
+            claim_worker_id([7], self.directory)
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("16-31"), range(16, 32))
+        self.assertEqual(parse_range("5"), range(5, 6))
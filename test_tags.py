@@ -0,0 +1,171 @@
+"""Hashtag and mention index tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_tags.py
+
+
+import json
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Message, ArchivedMessage, User, Follows, MessageTag, \
+    MessageMention
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import feeds
+import tags
+
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.create_all()
+
+
+class ExtractionTestCase(TestCase):
+    """Test pulling tags and mentions out of message text"""
+
+    def test_hashtags(self):
+        self.assertEqual(tags.hashtags("Loving #Python and #flask! #python"),
+                         {'python', 'flask'})
+        self.assertEqual(tags.hashtags("a#b ##c & #d"), {'d'})
+
+    def test_mentions(self):
+        self.assertEqual(tags.mentions("hi @alice, cc @bob_2 me@example.com"),
+                         {'alice', 'bob_2'})
+
+    def test_overlong_hashtag_is_not_truncated(self):
+        self.assertEqual(tags.hashtags("#" + "a" * 101 + " #" + "b" * 100),
+                         {"b" * 100})
+        self.assertEqual(tags.hashtags("#python. #flask, (#jinja)"),
+                         {'python', 'flask', 'jinja'})
+
+    def test_mention_is_the_whole_name(self):
+        self.assertEqual(tags.mentions("@bob.smith and @bob-x"),
+                         {'bob.smith', 'bob-x'})
+        self.assertEqual(tags.mentions("@bob. @carol, @dave! @erin--"),
+                         {'bob', 'carol', 'dave', 'erin'})
+        self.assertEqual(tags.mentions("@bob@example.com @.bob"), set())
+
+    def test_tag_links(self):
+        html = tags.tag_links("<b>#Fun</b> it's #1")
+
+        self.assertIn('<a href="/tags/fun">#Fun</a>', html)
+        self.assertIn('<a href="/tags/1">#1</a>', html)
+        self.assertIn("&lt;b&gt;", html)
+        self.assertNotIn('/tags/39', html)
+
+
+class TagIndexTestCase(TestCase):
+    """Test indexing at write time, the timelines and the backfill"""
+
+    def setUp(self):
+        MessageTag.query.delete()
+        MessageMention.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        ArchivedMessage.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User.signup("tagger", "tagger@test.com", "password", None)
+        u2 = User.signup("tagged", "tagged@test.com", "password", None)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def post(self, text):
+        return self.client.post("/messages/new", data={"text": text})
+
+    def test_indexed_on_write(self):
+        self.post("Hello @tagged and @nobody #Greetings")
+
+        msg = Message.query.one()
+        self.assertEqual([(t.tag, t.message_id) for t in MessageTag.query],
+                         [('greetings', msg.id)])
+        self.assertEqual([(m.user_id, m.message_id) for m in MessageMention.query],
+                         [(self.u2_id, msg.id)])
+
+    def test_tag_timeline_pages(self):
+        for i in range(5):
+            self.post(f"warble {i} #paging")
+        self.post("untagged")
+
+        first = feeds.tag_messages('paging', limit=3)
+        second = feeds.tag_messages('paging', before=first.next_cursor, limit=3)
+
+        self.assertEqual([m.text for m in first.items + second.items],
+                         [f"warble {i} #paging" for i in range(4, -1, -1)])
+        self.assertIsNone(second.next_cursor)
+
+    def test_tag_page(self):
+        self.post("Shown on #Warbler")
+        resp = self.client.get("/tags/WARBLER")
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("#warbler", html)
+        self.assertIn('<a href="/tags/warbler">#Warbler</a>', html)
+
+    def test_mentions_page(self):
+        self.post("Thanks @tagged")
+        resp = self.client.get(f"/users/{self.u2_id}/mentions")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Thanks @tagged", resp.get_data(as_text=True))
+
+    def test_api(self):
+        self.post("API #tagged @tagged")
+
+        resp = self.client.get("/api/v1/tags/tagged/messages")
+        self.assertEqual(len(json.loads(resp.get_data(as_text=True))['data']), 1)
+
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}/mentions")
+        self.assertEqual(len(json.loads(resp.get_data(as_text=True))['data']), 1)
+
+    def test_backfill(self):
+        db.session.add_all([Message(text=f"old #backfill {i} @tagged",
+                                    user_id=self.u1_id)
+                            for i in range(7)])
+        db.session.commit()
+
+        self.assertEqual(tags.backfill(workers=1, chunk=3), 7)
+        self.assertEqual(MessageTag.query.filter_by(tag='backfill').count(), 7)
+        self.assertEqual(MessageMention.query.count(), 7)
+
+        # Running it again changes nothing.
+        self.assertEqual(tags.backfill(workers=1, chunk=3), 7)
+        self.assertEqual(MessageTag.query.count(), 7)
+
+    def test_backfill_archive(self):
+        db.session.add_all([Message(text="live #both", user_id=self.u1_id)])
+        db.session.add_all([ArchivedMessage(id=10 ** 12 + i,
+                                            text=f"archived #both {i} @tagged",
+                                            timestamp=datetime(2019, 1, 1),
+                                            user_id=self.u1_id)
+                            for i in range(5)])
+        db.session.commit()
+
+        for workers in (1, 2):
+            self.assertEqual(tags.backfill(workers=workers, chunk=2), 6)
+            self.assertEqual(MessageTag.query.filter_by(tag='both').count(), 6)
+            self.assertEqual(MessageMention.query.count(), 5)
+
+    def test_backfill_parallel(self):
+        db.session.add_all([Message(text=f"parallel #p{i % 2}",
+                                    user_id=self.u1_id)
+                            for i in range(10)])
+        db.session.commit()
+
+        self.assertEqual(tags.backfill(workers=2, chunk=4), 10)
+        self.assertEqual(MessageTag.query.filter_by(tag='p0').count(), 5)
+        self.assertEqual(MessageTag.query.filter_by(tag='p1').count(), 5)